@@ -0,0 +1,176 @@
+#!/bin/python
+
+# Convert whole directories of Medley Sound files in parallel.
+#
+# Files are converted by a pool of worker processes.  A broken file
+# gets an error record and the batch carries on.  Outputs are written
+# to a temporary file first and renamed into place, so an interrupted
+# batch never leaves half-written files behind.
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from add_sample_header import createHunk
+from mso2pvms import createPVMS
+from msob import MsobReader, atomicOpen, huntMagic, mappedFile
+from pvms import PVMS
+import pvms2mso
+
+# output file name suffix of each job
+SUFFIXES = {"mso2pvms": ".pvms", "pvms2mso": ".mso", "hunk": ".hunk"}
+
+
+def expand(patterns, suffix: str = "") -> list:
+    """Return the files named by a list of files, directories and glob
+    patterns.  Directories are searched recursively.  Files ending with
+    suffix, ie. earlier outputs, are skipped when searching."""
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                dirs.sort()
+                files += [os.path.join(root, n) for n in sorted(names)
+                          if not (suffix and n.endswith(suffix)) and not n.endswith(".tmp")]
+        elif glob.has_magic(pattern):
+            files += [f for f in sorted(glob.glob(pattern, recursive=True))
+                      if os.path.isfile(f) and not (suffix and f.endswith(suffix))]
+        else:
+            files.append(pattern)
+    return list(dict.fromkeys(files))
+
+
+def msoToPvms(filename: str, outName: str, options: dict) -> int:
+    with mappedFile(filename) as in_buf:
+        base = huntMagic(in_buf)
+        if base < 0:
+            raise ValueError('Magic bytes "MSOB" not found.')
+        mso = MsobReader(in_buf, base)
+        try:
+            with atomicOpen(outName) as f_out:
+                return createPVMS(mso, f_out, quiet=True)
+        finally:
+            mso.buf.release() # let the mapping close
+
+
+def pvmsToMso(filename: str, outName: str, options: dict) -> int:
+    with open(filename, "rb") as f_in:
+        source = PVMS(f_in.read())
+    scores = pvms2mso.parseScores(source, options.get("scores") or "")
+    if not scores:
+        raise ValueError("project has no scores to export.")
+    with atomicOpen(outName) as f_out:
+        return pvms2mso.export(source, scores, f_out, options.get("names", True), options.get("partial", True))
+
+
+def sampleToHunk(filename: str, outName: str, options: dict) -> int:
+    with open(filename, "rb") as f_in:
+        out_bytes, truncated = createHunk(f_in.read())
+    with atomicOpen(outName) as f_out:
+        f_out.write(out_bytes)
+    return len(out_bytes)
+
+
+JOBS = {"mso2pvms": msoToPvms, "pvms2mso": pvmsToMso, "hunk": sampleToHunk}
+
+
+def convert(task: tuple) -> dict:
+    """Run one conversion and return its record.  Never raises."""
+    job, filename, outName, options = task
+    record = {"file": filename, "output": outName, "ok": False}
+    start = time.perf_counter()
+    try:
+        record["in_bytes"] = os.path.getsize(filename)
+        with contextlib.redirect_stdout(io.StringIO()): # per-entry progress is noise in a batch
+            record["out_bytes"] = JOBS[job](filename, outName, options)
+        record["ok"] = True
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def outputNames(files: list, suffix: str, outDir: str = None) -> list:
+    """Return the output file name of each file.  In outDir, the files
+    keep their paths relative to the directory all of them are in.
+    Raises ValueError if two files would have the same output."""
+    names = [filename + suffix for filename in files]
+    if outDir and files:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(filename)) for filename in files])
+        names = [os.path.join(outDir, os.path.relpath(os.path.abspath(name), root)) for name in names]
+    seen = {}
+    for filename, name in zip(files, names):
+        key = os.path.normcase(os.path.abspath(name))
+        if key in seen:
+            raise ValueError(f"{filename} and {seen[key]} would both be written to {name}.")
+        seen[key] = filename
+    return names
+
+
+def run(job: str, files: list, outDir: str = None, options: dict = None, workers: int = None):
+    """Convert files and yield a record per file as they complete, in
+    input order.  Raises ValueError if two files would have the same
+    output."""
+    options = options or {}
+    tasks = []
+    for filename, outName in zip(files, outputNames(files, SUFFIXES[job], outDir)):
+        if outDir:
+            os.makedirs(os.path.dirname(outName), exist_ok=True)
+        tasks.append((job, filename, outName, options))
+    if workers == 1 or len(tasks) < 2:
+        yield from map(convert, tasks)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(convert, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch converter for Medley Sound objects, projects and samples.",
+                                     epilog="Jobs: mso2pvms (MSOB to PVMS), pvms2mso (PVMS to MSOB, all scores), hunk (raw sample to HUNK).")
+    parser.add_argument("job", choices=sorted(JOBS), help="conversion to run")
+    parser.add_argument("paths", nargs="+", help="files, directories (searched recursively) or glob patterns")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("-o", "--output-dir", help="write outputs here instead of next to the sources, keeping the paths below the common directory")
+    parser.add_argument("-l", "--log", help="write a JSON record per file to this file")
+    parser.add_argument("-n", "--strip-names", action="store_true", help="pvms2mso: leave names out of the objects")
+    parser.add_argument("-f", "--full-tables", action="store_true", help="pvms2mso: write full tables")
+    args = parser.parse_args()
+
+    files = expand(args.paths, SUFFIXES[args.job])
+    try:
+        outputNames(files, SUFFIXES[args.job], args.output_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    options = {"names": not args.strip_names, "partial": not args.full_tables}
+
+    log = open(args.log, "w") if args.log else None
+    start = time.perf_counter()
+    done = failed = in_bytes = 0
+    for record in run(args.job, files, args.output_dir, options, args.jobs):
+        done += 1
+        in_bytes += record.get("in_bytes", 0)
+        if not record["ok"]:
+            failed += 1
+            print(f"{record['file']}: {record['error']}")
+        if log:
+            log.write(json.dumps(record) + "\n")
+    if log:
+        log.close()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"{done:d} files, {done - failed:d} converted, {failed:d} failed in {elapsed:.2f} s "
+          f"({done / elapsed:.1f} files/s, {in_bytes / elapsed / 1e6:.2f} MB/s).")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
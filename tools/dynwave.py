@@ -0,0 +1,91 @@
+#!/bin/python
+
+# Generate the waves of the <bsm> and <dyn> sound modes, with a bounded
+# cache of the results.
+#
+# The player rebuilds the wave in sch_ChipBuf whenever the base shift,
+# the dynamic shift or the dynamic frequencies change (sch_DynWaveValid,
+# sch_LastDShift, sch_DynFreq, sch_DynPerLsr).  Modulated instruments
+# cycle through the same few values over and over, so the generated
+# waves are kept in an LRU cache keyed on what they depend on: the
+# wave, the octave shift, the shift and the frequencies.
+#
+# The docs only say that <bsm> plays a "window" of the wave offset by
+# the base shift, and that <dyn> mixes two copies of the wave that can
+# be shifted and sped up.  The window size, the mix and the use of the
+# frequency nybbles below are placeholders until the routines are
+# disassembled from msplay, so the waves here, cached or not, are
+# approximations and not what the player outputs.
+
+from collections import OrderedDict
+
+from waveops import mix
+
+
+class WaveCache:
+    """A bounded least recently used cache of generated waves.
+
+    hits and misses count the lookups."""
+
+    def __init__(self, maxsize: int = 0x400):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, make, *args) -> bytes:
+        """Return the cached wave for key, or make(*args) if there's
+        none and cache it."""
+        entries = self._entries
+        data = entries.get(key)
+        if data is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return data
+        self.misses += 1
+        data = entries[key] = make(*args)
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        return data
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0.0
+        return f"{len(self):d} waves cached, {self.hits:d} hits, {self.misses:d} misses ({rate:.1f}% hit rate)"
+
+
+def bsmWave(data: bytes, shift: int) -> bytes:
+    """Return the <bsm> window of a wave.
+
+    The window is half of the wave, starting shift bytes in and
+    wrapping around.  A placeholder, see the top of the file."""
+    window = max(len(data) // 2, 1)
+    start = shift % len(data)
+    return (data + data)[start:start + window]
+
+
+def dynWave(data: bytes, shift: int, freq: int, lsr: int) -> bytes:
+    """Return the <dyn> mode mix of two copies of a wave.
+
+    The first copy is offset by shift.  The nybbles of freq are the
+    speeds the copies advance at, $0 meaning $10.  The result is
+    shortened by lsr octaves, down to two bytes.  A placeholder, see
+    the top of the file."""
+    size = len(data)
+    n = max(size >> lsr, 2)
+    step = size // n or 1
+    stepA = step * ((freq >> 4) or 0x10)
+    stepB = step * ((freq & 0xf) or 0x10)
+    shift %= size
+    tiled = data * -(-(shift + n * max(stepA, stepB)) // size)
+    return mix(tiled[shift:shift + n * stepA:stepA], tiled[0:n * stepB:stepB], 0x80)
+
+# EOF
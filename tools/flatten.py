@@ -0,0 +1,357 @@
+#!/bin/python
+
+# Compile the tracks of a score into a flat, timed event stream per
+# channel.
+#
+# The compiler follows the player logic described under "Track Data"
+# and "msplay internals / Player logic" in medley_sound_internals.org:
+# TRACK calls nest up to eight levels, RPEAT/LOOP nest up to eight
+# levels, UDATA jumps to a random track of the following lines, and
+# INSTR, DYNLV and TRNSP change the channel state.  Events are kept in
+# typed arrays, one column per field, and the tick column doubles as
+# the seek index.
+#
+# A track called with TRACK is compiled once per nesting depth.  Its
+# events are memoized and spliced in on later calls, unless the track
+# uses UDATA or loops across its boundaries.
+
+import argparse
+import random
+import sys
+from array import array
+from bisect import bisect_right
+
+from msob import loadFile
+from pvms import decodeName, loadProject
+from track import (SC_DYNLV, SC_END, SC_INSTR, SC_LOOP, SC_RPEAT, SC_TRACK, SC_TRNSP, SC_TSIGN, SC_UDATA,
+                   lines)
+
+MAX_NESTING = 8
+MAX_LOOPS = 8
+# lines processed without any time passing before a channel is
+# considered stuck, eg. a repeating track calling only empty tracks
+IDLE_LIMIT = 0x10000
+
+
+def _signed(byte: int) -> int:
+    return byte - 0x100 if byte & 0x80 else byte
+
+
+class EventStream:
+    """The note and rest events of one channel.
+
+    Each column is an array with one item per event.  tick is the start
+    tick of the event and duration its length in ticks.  note is $00
+    for a rest.  instrument, volume (DYNLV operand / 2) and transpose
+    (TRNSP) are the channel state when the event starts.  tied is
+    non-zero when the note doesn't retrigger the envelopes and MGs."""
+
+    __slots__ = ("channel", "tick", "duration", "note", "instrument", "volume", "transpose", "tied",
+                 "length", "loopTick", "error")
+
+    def __init__(self, channel: int):
+        self.channel = channel
+        self.tick = array("L")
+        self.duration = array("B")
+        self.note = array("B")
+        self.instrument = array("B")
+        self.volume = array("B")
+        self.transpose = array("b")
+        self.tied = array("B")
+        self.length = 0        # ticks compiled
+        self.loopTick = None   # tick the channel restarts from, if the score repeats
+        self.error = None      # reason the channel stopped early
+
+    def __len__(self) -> int:
+        return len(self.tick)
+
+    def event(self, i: int) -> tuple:
+        return (self.tick[i], self.duration[i], self.note[i], self.instrument[i], self.volume[i],
+                self.transpose[i], self.tied[i])
+
+    def seek(self, tick: int) -> int:
+        """Return the index of the event playing at tick, or -1 if the
+        channel hasn't started any event yet."""
+        return bisect_right(self.tick, tick) - 1
+
+
+class _Fragment:
+    """The memoized events of one TRACK call, with ticks relative to
+    the call.  The *At fields give the index of the first event after
+    the state was set within the call, or None if it wasn't set."""
+
+    __slots__ = ("ticks", "events", "instrAt", "volAt", "trnAt", "instrument", "volume", "transpose")
+
+
+class _Recording:
+    __slots__ = ("key", "event", "tick", "loops", "pure", "instrAt", "volAt", "trnAt")
+
+    def __init__(self, key, event, tick, loops):
+        self.key = key
+        self.event = event
+        self.tick = tick
+        self.loops = loops
+        self.pure = True
+        self.instrAt = None
+        self.volAt = None
+        self.trnAt = None
+
+
+class Compiler:
+    """Compile scores of one project.  tracks is a list of 256 track
+    data buffers, None for undefined tracks.  seed seeds the random
+    number generator used by UDATA."""
+
+    def __init__(self, tracks: list, seed=None):
+        self.tracks = tracks
+        self.rng = random.Random(seed)
+        self.memo = {}
+        self.hits = 0
+        self._lines = {}
+
+    @classmethod
+    def forProject(cls, project, seed=None):
+        return cls([None if t is None else t.data for t in project.tracks], seed)
+
+    def _trackLines(self, index: int) -> array:
+        words = self._lines.get(index)
+        if words is None:
+            words = self._lines[index] = lines(self.tracks[index])
+        return words
+
+    def compileScore(self, score, maxTicks: int = None) -> list:
+        """Return an EventStream for each of the four channels.
+
+        If the score repeats, compilation stops when a channel restarts
+        and its loopTick is set, unless maxTicks is given, in which
+        case channels keep restarting until maxTicks."""
+        instrs = score.instrs
+        volumes = score.volumes
+        return [self.compileChannel(ch, t, instrs[ch] or score.defInstr, volumes[ch], score.repeat, maxTicks)
+                for ch, t in enumerate(score.tracks)]
+
+    def compileChannel(self, channel: int, initial: int, instrument: int, volume: int,
+                       repeat: bool = False, maxTicks: int = None) -> EventStream:
+        out = EventStream(channel)
+        if self.tracks[initial] is None:
+            return out
+        ev = out.tick, out.duration, out.note, out.instrument, out.volume, out.transpose, out.tied
+        tracks = self.tracks
+        transpose = 0
+        tick = 0
+        trk = initial
+        words = self._trackLines(trk)
+        i = 0
+        gosub = []      # return positions (track, line)
+        loops = []      # [track, line, count]
+        recordings = [] # one per gosub level
+        idle = 0
+        while maxTicks is None or tick < maxTicks:
+            if i < len(words):
+                word = words[i]
+            else:
+                word = SC_END << 8 # ran past the data without an end marker
+            i += 1
+            op = word >> 8
+            arg = word & 0xff
+            if op < 0x80:
+                duration = arg & 0x7f
+                if duration == 0: # the player ignores zero length notes
+                    continue
+                for column, value in zip(ev, (tick, duration, op, instrument, volume, transpose, arg >> 7)):
+                    column.append(value)
+                tick += duration
+                idle = 0
+                continue
+            idle += 1
+            if idle > IDLE_LIMIT:
+                out.error = "track data doesn't advance time"
+                break
+            if op == SC_END:
+                if gosub:
+                    trk, i = gosub.pop()
+                    words = self._trackLines(trk)
+                    self._finish(recordings.pop(), out, tick, loops, instrument, volume, transpose)
+                    continue
+                if repeat:
+                    if maxTicks is None:
+                        out.loopTick = 0
+                        break
+                    trk = initial
+                    words = self._trackLines(trk)
+                    i = 0
+                    loops.clear()
+                    continue
+                break
+            elif op == SC_TSIGN:
+                pass
+            elif op == SC_DYNLV:
+                volume = arg >> 1
+                for rec in recordings:
+                    if rec.volAt is None:
+                        rec.volAt = len(out)
+            elif op == SC_INSTR:
+                instrument = arg
+                for rec in recordings:
+                    if rec.instrAt is None:
+                        rec.instrAt = len(out)
+            elif op == SC_UDATA:
+                for rec in recordings:
+                    rec.pure = False
+                if arg == 0:
+                    continue
+                line = i + (self.rng.getrandbits(8) & (arg - 1))
+                if line < len(words):
+                    target = words[line] & 0xff
+                    if tracks[target] is not None:
+                        # jump without touching the nesting tables
+                        trk = target
+                        words = self._trackLines(trk)
+                        i = 0
+                # an undefined track continues with the following lines
+            elif op == SC_TRACK:
+                if tracks[arg] is None or len(gosub) >= MAX_NESTING:
+                    continue # the player skips these
+                key = (arg, len(gosub), len(loops))
+                fragment = self.memo.get(key)
+                if fragment is not None:
+                    self.hits += 1
+                    instrument, volume, transpose = self._splice(fragment, out, tick, recordings,
+                                                                 instrument, volume, transpose)
+                    tick += fragment.ticks
+                    if fragment.ticks:
+                        idle = 0
+                    continue
+                gosub.append((trk, i))
+                recordings.append(_Recording(key, len(out), tick, len(loops)))
+                trk = arg
+                words = self._trackLines(trk)
+                i = 0
+            elif op == SC_RPEAT:
+                if len(loops) < MAX_LOOPS:
+                    loops.append([trk, i, arg])
+            elif op == SC_LOOP:
+                if not loops:
+                    continue
+                entry = loops[-1]
+                entry[2] = (entry[2] - 1) & 0xff
+                for rec in recordings:
+                    if rec.loops >= len(loops): # the loop was started outside the call
+                        rec.pure = False
+                if entry[2]:
+                    if entry[0] != trk:
+                        trk = entry[0]
+                        words = self._trackLines(trk)
+                    i = entry[1]
+                else:
+                    loops.pop()
+            elif op == SC_TRNSP:
+                transpose = _signed(arg)
+                for rec in recordings:
+                    if rec.trnAt is None:
+                        rec.trnAt = len(out)
+            else:
+                out.error = f"undefined SCODE ${op:02x} in track {trk:02x}"
+                break
+        out.length = tick if maxTicks is None else min(tick, maxTicks)
+        if maxTicks is not None:
+            self._truncate(out, maxTicks)
+        return out
+
+    def _finish(self, rec, out, tick, loops, instrument, volume, transpose):
+        """Memoize the events of a completed TRACK call if it's pure."""
+        if not rec.pure or len(loops) != rec.loops or rec.key in self.memo:
+            return
+        fragment = _Fragment()
+        fragment.ticks = tick - rec.tick
+        start = rec.event
+        fragment.events = [array(column.typecode, column[start:]) for column in
+                           (out.tick, out.duration, out.note, out.instrument, out.volume, out.transpose, out.tied)]
+        base = rec.tick
+        fragment.events[0] = array("L", (t - base for t in fragment.events[0]))
+        fragment.instrAt = None if rec.instrAt is None else rec.instrAt - start
+        fragment.volAt = None if rec.volAt is None else rec.volAt - start
+        fragment.trnAt = None if rec.trnAt is None else rec.trnAt - start
+        fragment.instrument = instrument
+        fragment.volume = volume
+        fragment.transpose = transpose
+        self.memo[rec.key] = fragment
+
+    def _splice(self, fragment, out, tick, recordings, instrument, volume, transpose) -> tuple:
+        """Append the events of a memoized call and return the channel
+        state after it."""
+        start = len(out)
+        ticks, durations, notes, instrs, volumes, transposes, tied = fragment.events
+        n = len(ticks)
+        out.tick.extend(array("L", (t + tick for t in ticks)))
+        out.duration.extend(durations)
+        out.note.extend(notes)
+        out.tied.extend(tied)
+        for column, values, at, current in ((out.instrument, instrs, fragment.instrAt, instrument),
+                                            (out.volume, volumes, fragment.volAt, volume),
+                                            (out.transpose, transposes, fragment.trnAt, transpose)):
+            inherited = n if at is None else at
+            column.extend(array(column.typecode, [current]) * inherited)
+            column.extend(values[inherited:])
+        for rec in recordings:
+            if rec.instrAt is None and fragment.instrAt is not None:
+                rec.instrAt = start + fragment.instrAt
+            if rec.volAt is None and fragment.volAt is not None:
+                rec.volAt = start + fragment.volAt
+            if rec.trnAt is None and fragment.trnAt is not None:
+                rec.trnAt = start + fragment.trnAt
+        return (fragment.instrument if fragment.instrAt is not None else instrument,
+                fragment.volume if fragment.volAt is not None else volume,
+                fragment.transpose if fragment.trnAt is not None else transpose)
+
+    @staticmethod
+    def _truncate(out, maxTicks: int):
+        """Drop events spliced in past maxTicks."""
+        n = bisect_right(out.tick, maxTicks - 1)
+        if n < len(out):
+            for column in (out.tick, out.duration, out.note, out.instrument, out.volume, out.transpose, out.tied):
+                del column[n:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a score of a Medley Sound object or project into timed events per channel.")
+    parser.add_argument("filename", help="MSOB or PVMS file")
+    parser.add_argument("-s", "--score", type=lambda n: int(n, 16), default=None, help="score number in hex (default: first score)")
+    parser.add_argument("-r", "--seed", type=int, default=None, help="random seed for UDATA")
+    parser.add_argument("-t", "--max-ticks", type=int, default=None, help="compile this many ticks, following repeats")
+    parser.add_argument("-d", "--dump", action="store_true", help="list every event")
+    args = parser.parse_args()
+
+    try:
+        project = loadProject(loadFile(args.filename))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    number = args.score
+    if number is None:
+        number = next((i for i, s in enumerate(project.scores) if s is not None), 0)
+    score = project.scores[number] if 0 < number < 256 else None
+    if score is None:
+        print(f"Error: score {number:02x} is undefined.")
+        sys.exit(1)
+
+    compiler = Compiler.forProject(project, args.seed)
+    streams = compiler.compileScore(score, args.max_ticks)
+    print(f"Score {number:02x} : {decodeName(score.name)}")
+    for out in streams:
+        note = f", restarts at tick {out.loopTick:d}" if out.loopTick is not None else ""
+        if out.error:
+            note += f", stopped: {out.error}"
+        print(f" -- Channel {out.channel + 1:d}: {len(out):d} events, {out.length:d} ticks{note}")
+        if args.dump:
+            for i in range(len(out)):
+                tick, duration, n, instrument, volume, transpose, tied = out.event(i)
+                print(f"    {tick:8d} {n:02x} {duration:02x}{' tied' if tied else '     '} "
+                      f"ins {instrument:02x} vol {volume:02x} trn {transpose:+d}")
+    print(f"{len(compiler.memo):d} track calls memoized, {compiler.hits:d} memo hits.")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,215 @@
+#!/bin/python
+
+# Typed instrument parameters and precomputed envelope and MG curves.
+#
+# See "Instrument structure" and "MG structure" in
+# medley_sound_internals.org for the layout, and "Player logic" for the
+# envelope and MG state machines.  The state machines are deterministic
+# from their trigger, so they're run once per instrument and stored as
+# arrays of values per update: a lead-in followed by a cycle that
+# repeats forever.  Playing an instrument is then an index into the
+# arrays instead of stepping the state machines.
+
+import struct
+from array import array
+
+MG_OFF = 0
+MG_FM = 1
+MG_AM = 2
+MG_BSHIFT = 3
+MG_DSHIFT = 4
+MG_FMUP = 5
+MG_FMDOWN = 6
+MG_DYNFREQ = 7
+
+# MG start levels after a trigger, see Mg.start()
+START_ZERO = 0
+START_HALF = 1
+START_FULL = 2
+
+_envelope = struct.Struct(">BBBBHHHHH")        # ins_EnvTrig .. ins_EnvRSlope
+_mg = struct.Struct(">BBBBBBBBBBBxHHH")        # mg_Destination .. mg_Slope2
+
+
+class Curve:
+    """Values of a state machine per update.  value(0) is the value
+    when triggered, value(k) the value after k updates."""
+
+    __slots__ = ("lead", "cycle")
+
+    def __init__(self, lead: array, cycle: array):
+        self.lead = lead
+        self.cycle = cycle
+
+    def value(self, k: int) -> int:
+        lead = self.lead
+        if k < len(lead):
+            return lead[k]
+        return self.cycle[(k - len(lead)) % len(self.cycle)]
+
+    @classmethod
+    def run(cls, state, step, output, typecode: str = "H"):
+        """Run step() from state until a state repeats and return the
+        curve of output(state)."""
+        seen = {}
+        values = array(typecode)
+        while state not in seen:
+            seen[state] = len(values)
+            values.append(output(state))
+            state = step(state)
+        start = seen[state]
+        return cls(values[:start], values[start:])
+
+
+class Envelope:
+    """The volume envelope (ADSR) parameters."""
+
+    __slots__ = ("trig", "aTime", "dTime", "rTime", "tLevel", "sLevel", "aSlope", "dSlope", "rSlope",
+                 "_curve", "_peakAt")
+
+    def __init__(self, body):
+        (self.trig, self.aTime, self.dTime, self.rTime, self.tLevel, self.sLevel,
+         self.aSlope, self.dSlope, self.rSlope) = _envelope.unpack_from(body, 0x14)
+        self._curve = None
+        self._peakAt = None
+
+    def step(self, state: tuple) -> tuple:
+        """Return the (level, status) after one update with the gate
+        open.  status is sch_EnvStatus, True once the peak is reached."""
+        level, status = state
+        if not status:
+            level += self.aSlope
+            if level >= self.tLevel:
+                return self.tLevel, True
+            return level, False
+        if level > self.sLevel:
+            return max(level - self.dSlope, self.sLevel), True
+        return state
+
+    def release(self, level: int) -> int:
+        return max(level - self.rSlope, 0)
+
+    @property
+    def curve(self) -> Curve:
+        """The attack, decay and sustain levels after a trigger.  The
+        first value is the level after the first update."""
+        if self._curve is None:
+            self._curve = Curve.run(self.step((0, False)), self.step, lambda state: state[0])
+        return self._curve
+
+    @property
+    def peakAt(self) -> int:
+        """The index of the curve where the peak is reached."""
+        if self._peakAt is None:
+            level, status = 0, False
+            k = 0
+            while not status and k <= len(self.curve.lead) + len(self.curve.cycle):
+                level, status = self.step((level, status))
+                k += 1
+            self._peakAt = k - 1 if status else -1
+        return self._peakAt
+
+
+class Mg:
+    """The parameters of one modulation generator."""
+
+    __slots__ = ("destination", "shape", "trigMode", "singleShot", "sg", "rvsOut", "delayTime", "halfShift",
+                 "quarterShift", "s1", "s2", "level", "slope1", "slope2", "_curves")
+
+    def __init__(self, body, n: int):
+        (self.destination, self.shape, self.trigMode, self.singleShot, self.sg, self.rvsOut, self.delayTime,
+         self.halfShift, self.quarterShift, self.s1, self.s2, self.level, self.slope1,
+         self.slope2) = _mg.unpack_from(body, 0x22 + n * _mg.size)
+        self._curves = [None, None, None]
+
+    def start(self, flagLR: bool, flagLH: bool) -> int:
+        """Return the start level after a trigger on a channel with the
+        given sch_FlagLR and sch_FlagLH.  Quarter shift wins over half
+        shift and is forced for delayed FM."""
+        def applies(shift):
+            return (shift == 1 and flagLR) or (shift == 2 and flagLH)
+        if applies(self.quarterShift) or (self.destination == MG_FM and self.delayTime):
+            return START_HALF
+        if applies(self.halfShift):
+            return START_FULL
+        return START_ZERO
+
+    def step(self, state: tuple) -> tuple:
+        """Return the (level, status) after one update.  status is
+        mgPar_StatusUD, False going up and True going down, or None once
+        a single-shot cycle is over."""
+        level, status = state
+        if status is None:
+            return state
+        if not status:
+            level += self.slope1
+            if level >= self.level:
+                return self.level, True
+            return level, False
+        level -= self.slope2
+        if level <= 0:
+            return 0, None if self.singleShot else False
+        return level, True
+
+    def output(self, state: tuple) -> int:
+        """Return the modulation value of a state, after the block wave
+        and reverse settings."""
+        level, status = state
+        if self.shape:
+            level = self.level if status else 0
+        if self.rvsOut:
+            level = self.level - level
+        return level
+
+    def curve(self, start: int) -> Curve:
+        """The modulation values from a trigger.  The first value is
+        the value at the trigger."""
+        curve = self._curves[start]
+        if curve is None:
+            level = (0, self.level >> 1, self.level)[start]
+            curve = self._curves[start] = Curve.run((level, False), self.step, self.output)
+        return curve
+
+
+class Patch:
+    """An instrument structure parsed into typed parameters.  body is
+    the 0x6a bytes following ins_Name."""
+
+    __slots__ = ("soundMode", "bShift", "dShift", "transpose", "waveRefs", "dynFreq", "envelope", "mgs",
+                 "active")
+
+    def __init__(self, body):
+        self.soundMode = body[0x0]
+        self.bShift = body[0x1]
+        self.dShift = body[0x2]
+        self.transpose = body[0x3] - 0x100 if body[0x3] & 0x80 else body[0x3]
+        self.waveRefs = bytes(body[0x4:0xc])
+        self.dynFreq = body[0xc]
+        self.envelope = Envelope(body)
+        self.mgs = [Mg(body, n) for n in range(4)]
+        # the MGs the player processes, with their slot numbers
+        self.active = [(n, mg) for n, mg in enumerate(self.mgs) if mg.destination != MG_OFF]
+
+
+class PatchCache:
+    """Parsed instruments by number.  An entry is parsed again if the
+    instrument bytes have changed since it was cached, eg. after an
+    edit."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, number: int, body) -> Patch:
+        body = bytes(body)
+        entry = self._entries.get(number)
+        if entry is None or entry[0] != body:
+            entry = self._entries[number] = (body, Patch(body))
+        return entry[1]
+
+    def invalidate(self, number: int = None):
+        if number is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(number, None)
+
+# EOF
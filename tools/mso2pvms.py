@@ -1,203 +1,205 @@
 #!/bin/python
 
+import argparse
+import struct
 import sys
 
+from msob import MsobReader, atomicOpen, huntMagic, loadFile
+from probe import NULL, Probe
+from pvms import INS, SCO, TRK, WAV2, PvmsWriter
 
-def getBoolean(inBuf: bytes, offset: int) -> bool:
-    if inBuf[offset] == 0:
-        return False
-    return True
-
-
-def getPointer(inBuf: bytes, offset: int) -> int:
-    # calculate an absolute pointer from a relative vector.
-    vector = int(inBuf[offset:offset+4].hex(), base=16)
-    if vector != 0:
-        return vector + offset
-    return 0
-
-
-def getTable(inBuf: bytes, offset: int, partial: bool) -> list:
-    count = 255
-    if partial:
-        count = inBuf[offset - 1]
-        if count == 0:
-            return [0]
-    tbl = [count]
-    for i in range(1, count + 1):
-        tbl.append(getPointer(inBuf, 4 * i + offset))
-    return tbl
-
-
-def huntMagic(inBuf: bytes) -> int:
-    i = 0
-    while (i < len(inBuf)):
-        if inBuf[i] == 77:
-            if inBuf[i:i+4] == b'MSOB':
-                return i
-        i += 1
-    return -1
-
-def createInsData(inBuf: bytes) -> bytes:
-    outBuf = bytes.fromhex('49 4e 53 3a 00 7a') # 'INS:.z'
-
-    pntr = getPointer(inBuf, 12)
-    count = 255
-    if getBoolean(inBuf, 37):
-        count = inBuf[pntr-1]
-    print(f'{count} instruments - table at {pntr:#010x}')
-
-    if count > 1:
-        for i in range(1, 1 + count):
-            pntr += 4 # we're working sequentially, let's do it the old-fashioned way!
-            data = getPointer(inBuf, pntr)
-            if data == 0:
+
+def insBlock(mso: MsobReader, i: int, pointer: int) -> tuple:
+    """Return the name and data of instrument i at pointer for a PVMS
+    block."""
+    if not mso.names: # generate generic name if names are stripped
+        insName = b'Instrument ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(3)
+    else:
+        insName = mso.name(pointer)
+    data = mso.data(pointer)
+    return insName, mso.buf[data:data + 106] # copy instrument data
+
+def scoBlock(mso: MsobReader, i: int, pointer: int) -> tuple:
+    """Return the name and data of score i at pointer for a PVMS
+    block."""
+    if not mso.names: # generate name, if names are stripped
+        scoName = b'Score ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(8)
+    else:
+        scoName = mso.name(pointer)
+    data = mso.data(pointer)
+    return scoName, mso.buf[data:data + 34]
+
+def trkBlock(mso: MsobReader, i: int, pointer: int) -> tuple:
+    """Return the name, header and data of track i at pointer for a
+    PVMS block."""
+    if not mso.names: # generate name, if names are stripped
+        trkName = b'Track ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(8)
+    else:
+        trkName = mso.name(pointer)
+    trkLen = mso.trackLength(pointer)
+    data = mso.data(pointer)
+    return (trkName,
+            struct.pack('>4xH8xH', trkLen, 0xffff), # trk_SizeOf and unmarked trk_BlockMark
+            mso.buf[data:data + trkLen])
+
+def wavBlock(mso: MsobReader, i: int, pointer: int) -> tuple:
+    """Return the name, header and data of wave i at pointer for a PVMS
+    block."""
+    if not mso.names: # generate generic name if names not in MSOB
+        wavName = b'Wave ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(9)
+    else:
+        wavName = mso.name(pointer)
+    data = mso.data(pointer)
+    waveData = mso.wave(pointer)[5] # raises ValueError if the wave is cut off
+    header = bytearray(12)
+    header[4:8] = mso.buf[data:data + 4] # copy ww_CycleSize and ww_Dummy
+    header[8] = mso.buf[data + 6]        # ww_IsDoubleBufd
+    header[9] = mso.buf[data + 5]        # ww_FragFactor
+    header[10] = mso.buf[data + 4]       # ww_Octave
+                                         # ww_DataPtr and ww_Pad stay zero
+    return wavName, header, waveData # copy wave data
+
+
+def createInsData(mso: MsobReader, out: PvmsWriter, section, quiet: bool = False):
+    out.chunk(INS) # 'INS:.z'
+
+    if not quiet:
+        print(f'{len(mso.instruments)} instruments - table at {mso.instruments.offset:#010x}')
+
+    for i in range(1, 1 + len(mso.instruments)):
+        data = mso.instruments[i]
+        if data == 0:
+            if not quiet:
                 print(f' -- Instrument {i:2x} is undefined.')
-                continue
-            if not getBoolean(inBuf, 36): # generate generic name if names are stripped
-                insName += b'Instrument ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(3)
-            else:
-                insName = inBuf[data:data+16]
-                data += 16
-            outBuf += bytes.fromhex(f'{i:04x}') # counter
-            outBuf += insName
-            outBuf += inBuf[data:data + 106] # copy instrument data
+            continue
+        insName, body = insBlock(mso, i, data)
+        out.block(i, insName, body)
+        section.entries += 1
+        section.bytesIn += 106
+        if not quiet:
             print(f' -- Instrument {i:2x} : {insName.decode(encoding="latin_1")}')
 
-    outBuf += bytes.fromhex('ff ff')
-    return outBuf
+    out.endChunk()
 
-def createScoData(inBuf: bytes) -> bytes:
-    outBuf = bytes.fromhex('53 43 4f 3a 00 32') # 'SCO: 2'
+def createScoData(mso: MsobReader, out: PvmsWriter, section, quiet: bool = False):
+    out.chunk(SCO) # 'SCO: 2'
 
-    pntr = getPointer(inBuf, 4) # dig out the pointer to the table
-    count = 255
-    if getBoolean(inBuf, 37): # if we have partial tables
-        count = inBuf[pntr-1] # there's a length in the byte before it
-    print(f'{count} scores - table at {pntr:#010x}')
+    if not quiet:
+        print(f'{len(mso.scores)} scores - table at {mso.scores.offset:#010x}')
 
-    if count > 1:
-        for i in range(1, 1 + count):
-            pntr += 4 # we're working sequentially, let's do it the old-fashioned way!
-            data = getPointer(inBuf, pntr)
-            if data == 0:
+    for i in range(1, 1 + len(mso.scores)):
+        data = mso.scores[i]
+        if data == 0:
+            if not quiet:
                 print(f' -- Score {i} is undefined.')
-                continue
-            if not getBoolean(inBuf, 36): # generate name, if names are stripped
-                scoName = b'Score ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(8)
-            else:
-                scoName = inBuf[data:data+16]
-                data += 16
-            outBuf += bytes.fromhex(f'{i:04x}') # counter
-            outBuf += scoName
-            outBuf += inBuf[data:data + 34]
+            continue
+        scoName, body = scoBlock(mso, i, data)
+        out.block(i, scoName, body)
+        section.entries += 1
+        section.bytesIn += 34
+        if not quiet:
             print(f' -- Score {i:2x} : {scoName.decode(encoding="latin_1")}')
-    
-    outBuf += bytes.fromhex('ff ff')
-    return outBuf
-
-def createTrkData(inBuf: bytes) -> bytes:
-    outBuf = bytes.fromhex('54 52 4b 3a 00 20') # 'TRK:. '
-
-    pntr = getPointer(inBuf, 8)
-    count = 255
-    if getBoolean(inBuf, 37):
-        count = inBuf[pntr-1]
-    print(f'{count} tracks - table at {pntr:#010x}')
-
-    if count > 1:
-        for i in range(1, 1 + count):
-            pntr += 4 # we're working sequentially, let's do it the old-fashioned way!
-            data = getPointer(inBuf, pntr)
-            if data == 0:
+
+    out.endChunk()
+
+def createTrkData(mso: MsobReader, out: PvmsWriter, section, quiet: bool = False):
+    out.chunk(TRK) # 'TRK:. '
+
+    if not quiet:
+        print(f'{len(mso.tracks)} tracks - table at {mso.tracks.offset:#010x}')
+
+    for i in range(1, 1 + len(mso.tracks)):
+        data = mso.tracks[i]
+        if data == 0:
+            if not quiet:
                 print(f' -- Track {i} is undefined.')
-                continue
-            if not getBoolean(inBuf, 36): # generate name, if names are stripped
-                trkName = b'Track ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(8)
-            else:
-                trkName = inBuf[data:data+16]
-                data += 16
-            trkLen = 0
-            while inBuf[data + trkLen:data + trkLen + 2] != b'\x80\x00':
-                trkLen +=2
-            trkLen += 2
-            outBuf += bytes.fromhex(f'{i:04x}') # counter
-            outBuf += trkName
-            outBuf += bytes(4) + bytes.fromhex(f'{trkLen:04x}') + bytes(8) + b'\xff\xff'
-            outBuf += inBuf[data:data + trkLen]
+            continue
+        trkName, header, body = trkBlock(mso, i, data)
+        out.block(i, trkName, header, body)
+        trkLen = len(body)
+        section.entries += 1
+        section.bytesIn += trkLen
+        if not quiet:
             print(f' -- Track {i:2x} : {int(trkLen/2):03} lines – {trkName.decode(encoding="latin_1")}')
 
-    outBuf += bytes.fromhex('ff ff')
-    return outBuf
+    out.endChunk()
 
-def createWavData(inBuf: bytes) -> bytes:
-    outBuf = bytes.fromhex('57 41 56 32 00 1c') # 'WAV2..'
+def createWavData(mso: MsobReader, out: PvmsWriter, section, quiet: bool = False):
+    out.chunk(WAV2) # 'WAV2..'
 
-    pntr = getPointer(inBuf, 16)
-    count = 255
-    if getBoolean(inBuf, 37):
-        count = inBuf[pntr-1]
-    print(f'{count} waves - table at {pntr:#010x}')
+    if not quiet:
+        print(f'{len(mso.waves)} waves - table at {mso.waves.offset:#010x}')
 
-    if count > 0:
-        for i in range(1, 1 + count):
-            pntr += 4 # we're working sequentially, let's do it the old-fashioned way!
-            data = getPointer(inBuf, pntr)
-            if data == 0:
+    for i in range(1, 1 + len(mso.waves)):
+        data = mso.waves[i]
+        if data == 0:
+            if not quiet:
                 print(f' -- Wave {i:2x} is undefined.')
-                continue
-            if not getBoolean(inBuf, 36): # generate generic name if names not in MSOB
-                wavName += b'Wave ' + bytes(f'{i:2x}', encoding='latin_1') + bytes(9)
-            else:
-                wavName = inBuf[data:data+16]
-                data += 16
-            waveStart = data + 8
-            waveLen = int(inBuf[data:data + 2].hex(), base=16)
-            outBuf += bytes.fromhex(f'{i:04x}') # counter
-            outBuf += wavName
-            outBuf += bytes(4) # pointer to wave data, gets overwritten during load
-            outBuf += inBuf[data:data + 4] # copy ww_CycleSize and ww_Dummy
-            outBuf += inBuf[data + 6:data + 7] # ww_IsDoubleBufd
-            outBuf += inBuf[data + 5:data + 6] # ww_FragFactor
-            outBuf += inBuf[data + 4:data + 5] # ww_Octave
-            outBuf += bytes(1)                 # ww_Pad
-            outBuf += inBuf[waveStart:waveStart + waveLen] # copy wave data
+            continue
+        wavName, header, body = wavBlock(mso, i, data)
+        out.block(i, wavName, header, body)
+        waveLen = len(body)
+        section.entries += 1
+        section.bytesIn += 8 + waveLen
+        if not quiet:
             print(f' -- Wave {i:2x} : {waveLen:04x} - {wavName.decode(encoding="latin_1")}')
 
-    outBuf += bytes.fromhex('ff ff')
-    return outBuf
+    out.endChunk()
 
 
-def createPVMS(inBuf: bytes) -> bytes:
-    outBuf = bytes.fromhex('50 56 4d 53')    # magic bytes, 'PVMS'
-    outBuf += createWavData(inBuf)
-    outBuf += createInsData(inBuf)
-    outBuf += createTrkData(inBuf)
-    outBuf += createScoData(inBuf)
-    outBuf += bytes.fromhex('45 4e 44 2e')   # terminator, 'END.'
-    return outBuf
+def createPVMS(mso: MsobReader, f_out, probe=NULL, quiet: bool = False):
+    # Chunks are streamed to f_out, which can be a file or a ByteSink.
+    # Each chunk is measured as a section of probe, and quiet leaves
+    # out the listing of the entries.
+    out = PvmsWriter(f_out)  # magic bytes, 'PVMS'
+    for chunk, create in ((WAV2, createWavData), (INS, createInsData), (TRK, createTrkData), (SCO, createScoData)):
+        with probe.section(chunk[0].decode()) as section:
+            written = out.written
+            create(mso, out, section, quiet)
+            section.bytesOut = out.written - written
+    out.close()              # terminator, 'END.'
+    return out.written
 
 
 def main():
-    print('MSOB-to-PVMS converter 0.1 by Archyx.\n')
+    parser = argparse.ArgumentParser(description="Convert a Medley Sound Object back to a Medley Sound Editor project (PVMS).")
+    parser.add_argument("filename", nargs="?", help="file containing the object; the output file name is appended with '.pvms'")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't list the entries")
+    parser.add_argument("-p", "--profile", action="store_true", help="print the time, bytes, entries and allocations of each chunk")
+    parser.add_argument("-t", "--trace", help="write each chunk's measurements to this file as NDJSON")
+    args = parser.parse_args()
 
-    if len(sys.argv) > 1:
-        with open(sys.argv[1], 'rb') as f_in:
-            in_bytes = f_in.read()
+    if not args.quiet:
+        print('MSOB-to-PVMS converter 0.1 by Archyx.\n')
+
+    if args.filename:
+        in_bytes = loadFile(args.filename)
 
         # check magic bytes
         msoMagic = huntMagic(in_bytes)
         if msoMagic < 0:
             print('Error: Magic bytes not found!\n')
             sys.exit(1)
-        if msoMagic > 0: # scrap everything before the magic bytes
-            in_bytes = in_bytes[msoMagic:-1]
-        
-        out_bytes = createPVMS(in_bytes)
-#        print(out_bytes)
-
-        with open(sys.argv[1] + '.pvms', 'wb') as f_out:
-            f_out.write(out_bytes)
+
+        try:
+            mso = MsobReader(in_bytes, msoMagic)
+        except ValueError as e:
+            print(f'Error: {e}\n')
+            sys.exit(1)
+
+        trace = open(args.trace, 'w') if args.trace else None
+        probe = Probe(trace) if args.profile or trace else NULL
+        try:
+            with atomicOpen(args.filename + '.pvms') as f_out:
+                createPVMS(mso, f_out, probe, args.quiet)
+        except (ValueError, IndexError, struct.error) as e:
+            print(f'Error: {e}\n')
+            sys.exit(1)
+        finally:
+            if trace:
+                trace.close()
+        if args.profile:
+            print(probe.summary())
     else:
         print('No filename given.')
 
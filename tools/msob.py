@@ -0,0 +1,305 @@
+#!/bin/python
+
+# Shared reader and writer for Medley Sound Objects (MSOB).
+#
+# The reader works on a memoryview of the source buffer, so the
+# object is never copied, and table entries are resolved only when
+# they are accessed.  See "File formats / MSOB" in
+# medley_sound_internals.org for the layout.
+
+import contextlib
+import mmap
+import os
+import struct
+
+from track import findEnd
+
+MAGIC = b"MSOB"
+HEADER_SIZE = 0x28
+
+_long = struct.Struct(">L")
+
+
+def getBoolean(inBuf, offset: int) -> bool:
+    if inBuf[offset] == 0:
+        return False
+    return True
+
+
+def getPointer(inBuf, offset: int) -> int:
+    # calculate an absolute pointer from a relative vector.
+    vector = _long.unpack_from(inBuf, offset)[0]
+    if vector != 0:
+        return vector + offset
+    return 0
+
+
+def huntMagic(inBuf, start: int = 0) -> int:
+    """Return the offset of the first magic bytes at or after start, or -1.
+
+    inBuf must support find(), ie. bytes, bytearray or mmap."""
+    return inBuf.find(MAGIC, start)
+
+
+def scanMagic(inBuf, start: int = 0):
+    """Yield the offset of every magic bytes occurrence in inBuf."""
+    pos = inBuf.find(MAGIC, start)
+    while pos >= 0:
+        yield pos
+        pos = inBuf.find(MAGIC, pos + 1)
+
+
+def loadFile(filename: str):
+    """Map a file read-only into memory.
+
+    Returns an mmap, or an empty bytes object for an empty file, as
+    zero-length files can't be mapped."""
+    with open(filename, "rb") as f_in:
+        try:
+            return mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""
+
+
+@contextlib.contextmanager
+def mappedFile(filename: str):
+    """loadFile() for a with block, closing the mapping at its end.
+
+    Views into the buffer must be released before the block ends,
+    otherwise the mapping is left to the garbage collector."""
+    buf = loadFile(filename)
+    try:
+        yield buf
+    finally:
+        if isinstance(buf, mmap.mmap):
+            with contextlib.suppress(BufferError):
+                buf.close()
+
+
+@contextlib.contextmanager
+def atomicOpen(path: str):
+    """Open a temporary file for writing and rename it to path once
+    the block completes without an exception."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f_out:
+            yield f_out
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def writeMsob(out, tables, names: bool = True, partial: bool = True) -> int:
+    """Write a Medley Sound Object to out and return its size.
+
+    tables holds the score, track, instrument and wave tables in that
+    order.  Each is a list indexed from 1, where None is an undefined
+    entry and a defined entry is a tuple (name, *parts) of the 16-byte
+    name and the buffers making up the entry data.  The name is left
+    out if names is false."""
+    nameSize = 16 if names else 0
+    pos = HEADER_SIZE
+    layout = []
+    for tbl in tables:
+        count = 255
+        if partial:
+            count = max((i for i, entry in enumerate(tbl) if entry is not None), default=0)
+            pos += 2
+        layout.append((pos, count))
+        pos += 4 + 4 * count
+    entries = []
+    for tbl in tables:
+        offsets = [0] * len(tbl)
+        for i, entry in enumerate(tbl):
+            if entry is not None:
+                offsets[i] = pos
+                size = nameSize + sum(len(part) for part in entry[1:])
+                pos += size + (size & 1) # keep entries word aligned
+        entries.append(offsets)
+
+    out.write(MAGIC)
+    out.write(struct.pack(">4L", *(offset - 4 * (k + 1) for k, (offset, count) in enumerate(layout))))
+    out.write(bytes(16))
+    out.write(bytes((0xff if names else 0x00, 0xff if partial else 0x00, 0, 0)))
+    for (offset, count), offsets in zip(layout, entries):
+        if partial:
+            out.write(struct.pack(">H", count))
+        vectors = [0] * (count + 1)
+        for i in range(1, min(count + 1, len(offsets))):
+            if offsets[i]:
+                vectors[i] = offsets[i] - (offset + 4 * i)
+        out.write(struct.pack(f">{count + 1}L", *vectors))
+    for tbl in tables:
+        for entry in tbl:
+            if entry is not None:
+                size = 0
+                if names:
+                    out.write(bytes(entry[0][:16]).ljust(16, b"\x00"))
+                for part in entry[1:]:
+                    out.write(part)
+                    size += len(part)
+                if size & 1:
+                    out.write(b"\x00")
+    return pos
+
+
+class Table:
+    """A lazily resolved view of a score/track/instrument/wave table.
+
+    Indexing with 1..len(table) returns the absolute offset of an entry
+    within the object, or 0 for an undefined entry.  Index 0 is always
+    undefined in Medley Sound."""
+
+    __slots__ = ("_buf", "offset", "count")
+
+    def __init__(self, buf, offset: int, partial: bool):
+        self._buf = buf
+        self.offset = offset
+        if offset == 0:
+            self.count = 0
+        elif partial:
+            self.count = buf[offset - 1]
+        else:
+            self.count = 255
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> int:
+        if index < 0 or index > self.count:
+            raise IndexError(f"table index {index:#04x} out of range")
+        if index == 0:
+            return 0
+        return getPointer(self._buf, self.offset + 4 * index)
+
+    def defined(self):
+        """Yield (index, pointer) for every defined entry."""
+        buf = self._buf
+        base = self.offset
+        for index, vector in enumerate(struct.iter_unpack(">L", buf[base + 4:base + 4 + 4 * self.count]), 1):
+            if vector[0] != 0:
+                yield index, vector[0] + base + 4 * index
+
+
+class MsobReader:
+    """Zero-copy access to a single Medley Sound Object.
+
+    inBuf can be any buffer (bytes, bytearray, mmap, memoryview) and
+    base is the offset of the magic bytes within it.  All offsets
+    returned by the reader are relative to the magic bytes."""
+
+    def __init__(self, inBuf, base: int = 0):
+        self.base = base
+        self.buf = memoryview(inBuf)[base:]
+        if len(self.buf) < HEADER_SIZE:
+            raise ValueError(f"Truncated object header at {base:#010x}.")
+        if self.buf[0:4] != MAGIC:
+            raise ValueError(f'Magic bytes "MSOB" not found at {base:#010x}.')
+        self.names = getBoolean(self.buf, 0x24)
+        self.partTables = getBoolean(self.buf, 0x25)
+        tables = []
+        for label, field in (("score", 0x4), ("track", 0x8), ("instrument", 0xc), ("wave", 0x10)):
+            offset = getPointer(self.buf, field)
+            # A partial table's length is in the word before it.
+            if offset != 0 and not HEADER_SIZE + (2 if self.partTables else 0) <= offset <= len(self.buf) - 4:
+                raise ValueError(f"{label.capitalize()} table displacement at {base + field:#010x} points outside the object.")
+            table = Table(self.buf, offset, self.partTables)
+            if offset + 4 + 4 * table.count > len(self.buf):
+                raise ValueError(f"{label.capitalize()} table at {base + offset:#010x} runs past the end of the object.")
+            tables.append(table)
+        self.scores, self.tracks, self.instruments, self.waves = tables
+
+    def reserved(self) -> list:
+        """Return (offset, value) of every non-zero reserved header field."""
+        return [(i, v) for i, v in zip((0x14, 0x18, 0x1c, 0x20), struct.unpack_from(">4L", self.buf, 0x14)) if v != 0]
+
+    def validate(self) -> list:
+        """Check the object against the documented header layout.
+
+        Returns a list of problems found, empty for a sane object."""
+        problems = [f"reserved field at {i:#04x} is {v:#010x}" for i, v in self.reserved()]
+        if self.buf[0x26] != 0 or self.buf[0x27] != 0:
+            problems.append("reserved bytes at 0x26 are not zero")
+        for flag in (0x24, 0x25):
+            if self.buf[flag] not in (0x00, 0xff):
+                problems.append(f"flag at {flag:#04x} is {self.buf[flag]:#04x}")
+        for label, table in (("score", self.scores), ("track", self.tracks),
+                             ("instrument", self.instruments), ("wave", self.waves)):
+            if table.offset == 0:
+                problems.append(f"{label} table is missing")
+            elif table.offset < HEADER_SIZE or table.offset + 4 + 4 * table.count > len(self.buf):
+                problems.append(f"{label} table at {table.offset:#010x} is out of bounds")
+        if problems:
+            return problems
+        for label, table in (("score", self.scores), ("track", self.tracks),
+                             ("instrument", self.instruments), ("wave", self.waves)):
+            for i, p in table.defined():
+                if p >= len(self.buf):
+                    problems.append(f"{label} {i:#04x} at {p:#010x} is out of bounds")
+                elif label != "track" and self._entryEnd(label, p) > len(self.buf):
+                    problems.append(f"{label} {i:#04x} at {p:#010x} runs past the end of the object")
+        return problems
+
+    def _entryEnd(self, label: str, pointer: int) -> int:
+        # end of a score, instrument or wave entry; a wave whose header
+        # is cut off ends past the buffer
+        data = self.data(pointer)
+        if label == "score":
+            return data + 0x22
+        if label == "instrument":
+            return data + 0x6a
+        if data + 8 > len(self.buf):
+            return data + 8
+        return data + 8 + struct.unpack_from(">H", self.buf, data)[0]
+
+    def size(self) -> int:
+        """Return the extent of the object in bytes, from magic bytes to
+        the end of the last table or entry."""
+        end = HEADER_SIZE
+        for table in (self.scores, self.tracks, self.instruments, self.waves):
+            end = max(end, table.offset + 4 + 4 * table.count)
+        for i, p in self.scores.defined():
+            end = max(end, self.data(p) + 0x22)
+        for i, p in self.instruments.defined():
+            end = max(end, self.data(p) + 0x6a)
+        for i, p in self.tracks.defined():
+            end = max(end, self.data(p) + self.trackLength(p))
+        for i, p in self.waves.defined():
+            end = max(end, self.data(p) + 8 + struct.unpack_from(">H", self.buf, self.data(p))[0])
+        return min(end, len(self.buf))
+
+    def name(self, pointer: int) -> bytes:
+        """Return the raw 16-byte name of an entry, or b"" if names are stripped."""
+        if not self.names:
+            return b""
+        return self.buf[pointer:pointer + 16].tobytes()
+
+    def data(self, pointer: int) -> int:
+        """Return the offset of entry data following the optional name."""
+        if self.names:
+            return pointer + 16
+        return pointer
+
+    def trackLength(self, pointer: int) -> int:
+        """Return the length of track data in bytes, including the end marker."""
+        start = self.data(pointer)
+        end = findEnd(self.buf, start)
+        if end < 0:
+            raise IndexError(f"track at {pointer:#010x} has no end marker")
+        return end - start
+
+    def wave(self, pointer: int) -> tuple:
+        """Return the wave header fields and data of a wave entry.
+
+        The result is (CycleSize, Dummy, Octave, FragFactor,
+        IsDoubleBufd, data), where data is a memoryview.  Raises
+        ValueError if the data runs past the end of the object."""
+        data = self.data(pointer)
+        cycleSize, dummy, octave, fragFactor, isDoubleBufd = struct.unpack_from(">HHBBB", self.buf, data)
+        if data + 8 + cycleSize > len(self.buf):
+            raise ValueError(f"wave at {pointer:#010x} runs past the end of the object")
+        return cycleSize, dummy, octave, fragFactor, isDoubleBufd, self.buf[data + 8:data + 8 + cycleSize]
+
+# EOF
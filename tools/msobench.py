@@ -0,0 +1,229 @@
+#!/bin/python
+
+# Benchmark the MSOB and PVMS code paths on generated data.
+#
+# Each profile is a project made by msogen with fixed sizes and seed, so
+# every run measures the same bytes.  The cases are:
+#
+#   decode  - msodecode.decode_msob() on the object, without the listing
+#   hunt    - msob.huntMagic() for an object at the end of 16 MiB
+#   convert - mso2pvms.createPVMS() from the object, without the listing
+#   load    - pvms.PVMS() from the project file
+#   export  - pvms2mso.export() of every score of the project
+#
+# Every case is timed in batches of calls lasting at least BATCH
+# seconds, like timeit does, and the median batch is kept, as the
+# fastest one is as much luck as the slowest.  The spread of the
+# batches around the median is kept as the noise of the case.
+# Throughput is input bytes per second of a call in the median batch.
+# Peak memory is measured with tracemalloc in a separate call, because
+# tracing slows the code down.
+#
+# Results can be saved as a baseline and later runs compared against
+# it.  The speed of the interpreter varies over time and from one
+# machine to the next, so a fixed reference workload is timed right
+# before each case and the comparison is made relative to it.  A case
+# is only reported as slower if the change exceeds both the tolerance
+# and the noise measured for it in the two runs.  Baselines only make
+# sense on the machine they were made on, so make one with -s before
+# changing the code.
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+
+from msob import MsobReader, huntMagic
+from msodecode import decode_msob
+from mso2pvms import createPVMS
+from msogen import Sizes, generate, msobBytes, pvmsBytes
+from pvms import PVMS, ByteSink
+from pvms2mso import export
+
+# name: (sizes, names, partial tables)
+PROFILES = {
+    "small": (Sizes(waves=8, instruments=8, tracks=16, trackLines=32, depth=2, scores=2), True, True),
+    "medium": (Sizes(waves=64, waveSizes=(0x40, 0x80, 0x100), instruments=64, tracks=128, trackLines=128,
+                     depth=4, scores=16), True, True),
+    "large": (Sizes(waves=255, waveSizes=(0x80, 0x100, 0x1000, 0x4000), instruments=255, tracks=255,
+                    trackLines=1024, depth=8, scores=64), True, False),
+    "stripped": (Sizes(waves=255, waveSizes=(0x80,), instruments=255, tracks=255, trackLines=256, depth=8,
+                       scores=255), False, False),
+}
+CASES = ("decode", "hunt", "convert", "load", "export")
+HUNT_SIZE = 0x1000000
+BATCH = 0.05
+MEMORY_SLACK = 0x10000 # peak memory growth too small to report, from allocator noise
+NOISE_MARGIN = 3       # multiple of the measured noise a slowdown must exceed
+SEED = 0x4d534f42
+
+
+class Corpus:
+    """The inputs of one profile."""
+
+    def __init__(self, name: str):
+        sizes, names, partial = PROFILES[name]
+        self.name = name
+        self.project = generate(sizes, SEED, names)
+        self.msob = msobBytes(self.project, names, partial)
+        self.pvms = pvmsBytes(self.project)
+        self.scores = [i for i, s in enumerate(self.project.scores) if s is not None]
+        self._haystack = None
+
+    @property
+    def haystack(self) -> bytes:
+        if self._haystack is None:
+            self._haystack = bytes(HUNT_SIZE - len(self.msob)) + self.msob
+        return self._haystack
+
+    def case(self, name: str) -> tuple:
+        """Return the function running a case and its input size."""
+        if name == "decode":
+            return lambda: decode_msob(self.msob, len(self.msob), quiet=True), len(self.msob)
+        if name == "hunt":
+            haystack = self.haystack
+            return lambda: huntMagic(haystack), len(haystack)
+        if name == "convert":
+            return lambda: createPVMS(MsobReader(self.msob, 0), ByteSink(len(self.pvms)), quiet=True), len(self.msob)
+        if name == "load":
+            return lambda: PVMS(self.pvms), len(self.pvms)
+        if name == "export":
+            project = PVMS(self.pvms)
+            return lambda: export(project, self.scores, ByteSink()), len(self.pvms)
+        raise ValueError(f"unknown case {name}.")
+
+
+def measure(run, repeat: int) -> tuple:
+    """Return the median time per call of repeat batches, the noise as
+    the median deviation from it relative to it, and the peak traced
+    memory of one more call."""
+    times = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        run() # also warms up caches and imports
+        number = max(int(BATCH / max(time.perf_counter() - start, 1e-9)), 1)
+        calls = range(number)
+        gc.collect()
+        gc.disable()
+        try:
+            for n in range(repeat):
+                start = time.perf_counter()
+                for call in calls:
+                    run()
+                times.append((time.perf_counter() - start) / number)
+        finally:
+            gc.enable()
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    median = statistics.median(times)
+    noise = statistics.median(abs(t - median) for t in times) / median if median else 0.0
+    return median, noise, peak
+
+
+def _reference():
+    """The reference workload: Python loops over struct unpacking and
+    buffer searches, the mix the cases are made of."""
+    buf = bytes(range(256)) * 64
+    total = 0
+    for i in range(0, len(buf) - 4, 4):
+        total += struct.unpack_from(">L", buf, i)[0] & 0xff
+        total += buf.find(b"\xff\x00", i & 0xff)
+    return total
+
+
+def runSuite(profiles, cases, repeat: int, report=print) -> dict:
+    """Run the cases on the profiles and return the results by
+    "profile/case".  relative is the time of a case divided by the time
+    of the reference workload measured right before it, and noise the
+    combined noise of both."""
+    results = {}
+    for profile in profiles:
+        corpus = Corpus(profile)
+        report(f"{profile}: object {len(corpus.msob):d} bytes, project {len(corpus.pvms):d} bytes")
+        for name in cases:
+            run, size = corpus.case(name)
+            reference, referenceNoise = measure(_reference, repeat)[:2]
+            seconds, noise, peak = measure(run, repeat)
+            result = {"seconds": seconds, "relative": seconds / reference, "noise": noise + referenceNoise,
+                      "bytes": size, "mbps": size / seconds / 1e6 if seconds else 0.0, "peak": peak}
+            results[f"{profile}/{name}"] = result
+            report(f" -- {name:<8} {seconds * 1e3:10.3f} ms ±{100 * result['noise']:4.1f}% "
+                   f"{result['mbps']:10.2f} MB/s {peak / 1024:10.1f} KiB peak")
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float, report=print) -> list:
+    """Report the results against a baseline and return the keys of
+    the cases slower or bigger than the baseline by more than
+    tolerance.  Speeds are compared relative to the reference
+    workload, and a slowdown must also exceed NOISE_MARGIN times the
+    noise of the case in both runs."""
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            report(f" -- {key:<20} not in the baseline")
+            continue
+        speed = old["relative"] / result["relative"]
+        memory = result["peak"] / old["peak"] if old["peak"] else 1.0
+        margin = max(tolerance, NOISE_MARGIN * (result["noise"] + old.get("noise", 0.0)))
+        flag = ""
+        if speed < 1 - min(margin, 0.9) or (memory > 1 + tolerance and result["peak"] - old["peak"] > MEMORY_SLACK):
+            regressions.append(key)
+            flag = "  REGRESSION"
+        report(f" -- {key:<20} {speed:6.2f}x speed ±{100 * margin:3.0f}% {memory:6.2f}x peak memory{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding, converting, loading and exporting generated Medley Sound data.",
+                                     epilog=f"Profiles: {', '.join(PROFILES)}.  Cases: {', '.join(CASES)}.")
+    parser.add_argument("-p", "--profiles", default="small,medium,large", help="profiles to run, separated by commas (default: small,medium,large)")
+    parser.add_argument("-c", "--cases", default=",".join(CASES), help="cases to run, separated by commas (default: all)")
+    parser.add_argument("-n", "--repeat", type=int, default=7, help="timed batches per case (default: 7)")
+    parser.add_argument("-s", "--save", help="save the results as a baseline to this JSON file")
+    parser.add_argument("-b", "--baseline", help="compare the results against this baseline JSON file")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25,
+                        help="slowdown or memory growth reported as a regression (default: 0.25)")
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(",")
+    cases = args.cases.split(",")
+    for profile in profiles:
+        if profile not in PROFILES:
+            print(f"Error: unknown profile {profile}.")
+            sys.exit(1)
+    for case in cases:
+        if case not in CASES:
+            print(f"Error: unknown case {case}.")
+            sys.exit(1)
+
+    results = runSuite(profiles, cases, max(args.repeat, 1))
+    if args.save:
+        with open(args.save, "w") as f_out:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f_out, indent=1, sort_keys=True)
+            f_out.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f_in:
+            baseline = json.load(f_in)
+        print(f"Against {args.baseline} (Python {baseline.get('python', '?')}, {baseline.get('machine', '?')}), "
+              f"relative to the reference workload:")
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
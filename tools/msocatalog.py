@@ -0,0 +1,261 @@
+#!/bin/python
+
+# Keep a searchable SQLite index of a library of Medley Sound objects
+# and projects.
+#
+# Files whose size and modification time are unchanged since the last
+# scan are skipped without reading them.  If only the time has
+# changed, the content hash decides whether the file is parsed again.
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import struct
+import sys
+
+from batch import expand
+from msob import loadFile
+from msoscan import scan
+from pvms import MAGIC as PVMS_MAGIC, PVMS, decodeName
+from pvmsdedup import digest
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    offset INTEGER NOT NULL,
+    format TEXT NOT NULL,          -- 'MSOB' or 'PVMS'
+    names INTEGER,                 -- MSOB header flag 0x24
+    partial INTEGER,               -- MSOB header flag 0x25
+    scores INTEGER NOT NULL,       -- defined entries per table
+    tracks INTEGER NOT NULL,
+    instruments INTEGER NOT NULL,
+    waves INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    object_id INTEGER NOT NULL REFERENCES objects(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,            -- 'score', 'track', 'instrument' or 'wave'
+    idx INTEGER NOT NULL,
+    name TEXT,
+    hash TEXT NOT NULL,
+    cycle_size INTEGER,            -- waves only
+    octave INTEGER                 -- waves only
+);
+CREATE TABLE IF NOT EXISTS errors (
+    path TEXT PRIMARY KEY,         -- files that couldn't be indexed
+    mtime INTEGER,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_name ON entries(kind, name);
+CREATE INDEX IF NOT EXISTS entries_hash ON entries(hash);
+CREATE INDEX IF NOT EXISTS entries_object ON entries(object_id);
+CREATE INDEX IF NOT EXISTS objects_file ON objects(file_id);
+"""
+
+QUERIES = {
+    "wave": ("SELECT f.path, o.offset, e.idx, e.name, e.cycle_size, e.octave FROM entries e "
+             "JOIN objects o ON o.id = e.object_id JOIN files f ON f.id = o.file_id "
+             "WHERE e.kind = 'wave' AND e.name LIKE ? ORDER BY f.path, o.offset, e.idx"),
+    "name": ("SELECT f.path, o.offset, e.kind, e.idx, e.name FROM entries e "
+             "JOIN objects o ON o.id = e.object_id JOIN files f ON f.id = o.file_id "
+             "WHERE e.name LIKE ? ORDER BY f.path, o.offset, e.kind, e.idx"),
+    "hash": ("SELECT f.path, o.offset, e.kind, e.idx, e.name FROM entries e "
+             "JOIN objects o ON o.id = e.object_id JOIN files f ON f.id = o.file_id "
+             "WHERE e.hash = ? ORDER BY f.path, o.offset, e.kind, e.idx"),
+    "partial": ("SELECT f.path, o.offset, o.scores, o.tracks, o.instruments, o.waves FROM objects o "
+                "JOIN files f ON f.id = o.file_id WHERE o.partial ORDER BY f.path, o.offset"),
+    "errors": "SELECT path, message FROM errors ORDER BY path",
+}
+# queries run without an argument
+PLAIN_QUERIES = ("partial", "errors")
+
+
+def connect(filename: str):
+    db = sqlite3.connect(filename)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.executescript(SCHEMA)
+    return db
+
+
+def fileHash(in_buf) -> str:
+    return hashlib.blake2b(in_buf, digest_size=16).hexdigest()
+
+
+def msobEntries(mso) -> tuple:
+    """Return the per-table counts and the entry rows of an MSOB."""
+    rows = []
+    for i, p in mso.scores.defined():
+        d = mso.data(p)
+        rows.append(("score", i, decodeName(mso.name(p)), digest(mso.buf[d:d + 0x22]), None, None))
+    for i, p in mso.tracks.defined():
+        d = mso.data(p)
+        rows.append(("track", i, decodeName(mso.name(p)), digest(mso.buf[d:d + mso.trackLength(p)]), None, None))
+    for i, p in mso.instruments.defined():
+        d = mso.data(p)
+        rows.append(("instrument", i, decodeName(mso.name(p)), digest(mso.buf[d:d + 0x6a]), None, None))
+    for i, p in mso.waves.defined():
+        cycleSize, dummy, octave, fragFactor, isDoubleBufd, data = mso.wave(p)
+        rows.append(("wave", i, decodeName(mso.name(p)), digest(data), cycleSize, octave))
+    counts = tuple(sum(1 for row in rows if row[0] == kind) for kind in ("score", "track", "instrument", "wave"))
+    return counts, rows
+
+
+def pvmsEntries(project) -> tuple:
+    """Return the per-table counts and the entry rows of a PVMS."""
+    rows = []
+    for kind, entries in (("score", project.scores), ("track", project.tracks),
+                          ("instrument", project.instruments), ("wave", project.waves)):
+        for i, entry in enumerate(entries):
+            if entry is None:
+                continue
+            if kind == "wave":
+                rows.append((kind, i, decodeName(entry.name), digest(entry.data), entry.cycleSize, entry.octave))
+            else:
+                rows.append((kind, i, decodeName(entry.name), digest(entry.data if kind == "track" else entry.body), None, None))
+    counts = (PVMS.count(project.scores), PVMS.count(project.tracks),
+              PVMS.count(project.instruments), PVMS.count(project.waves))
+    return counts, rows
+
+
+def objects(in_buf, skipped: list = None):
+    """Yield (offset, format, names, partial, counts, rows) for every
+    object in a file.  Broken objects are left out, and why is appended
+    to skipped if it's given."""
+    if in_buf[0:4] == PVMS_MAGIC:
+        counts, rows = pvmsEntries(PVMS(in_buf))
+        yield 0, "PVMS", None, None, counts, rows
+        return
+    for offset, mso, problems in scan(in_buf):
+        if not problems:
+            try:
+                counts, rows = msobEntries(mso)
+            except (ValueError, IndexError, struct.error) as e:
+                problems = [str(e)]
+        if problems:
+            if skipped is not None:
+                skipped.append(f"object at {offset:#010x}: {', '.join(problems)}")
+            continue
+        yield offset, "MSOB", mso.names, mso.partTables, counts, rows
+
+
+def index(db, filename: str) -> str:
+    """Bring the catalog up to date for one file.  Returns "skipped",
+    "touched" (only the time changed), "indexed" or an error, which is
+    also recorded in the errors table.  A file that fails altogether is
+    dropped from the catalog; one with some broken objects keeps the
+    others."""
+    path = os.path.abspath(filename)
+    try:
+        result = _index(db, path)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        db.execute("DELETE FROM files WHERE path = ?", (path,))
+        result = f"error: {e}"
+    if result.startswith("error"):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        db.execute("INSERT OR REPLACE INTO errors (path, mtime, message) VALUES (?, ?, ?)", (path, mtime, result[7:]))
+    elif result == "indexed":
+        db.execute("DELETE FROM errors WHERE path = ?", (path,))
+    return result
+
+
+def _index(db, path: str) -> str:
+    st = os.stat(path)
+    row = db.execute("SELECT id, size, mtime, hash FROM files WHERE path = ?", (path,)).fetchone()
+    if row and row[1] == st.st_size and row[2] == st.st_mtime_ns:
+        return "skipped"
+    in_buf = loadFile(path)
+    h = fileHash(in_buf)
+    if row and row[1] == st.st_size and row[3] == h:
+        db.execute("UPDATE files SET mtime = ? WHERE id = ?", (st.st_mtime_ns, row[0]))
+        return "touched"
+    skipped = []
+    found = list(objects(in_buf, skipped))
+    if skipped and not found:
+        raise ValueError("; ".join(skipped))
+    if row:
+        db.execute("DELETE FROM files WHERE id = ?", (row[0],))
+    file_id = db.execute("INSERT INTO files (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                         (path, st.st_size, st.st_mtime_ns, h)).lastrowid
+    for offset, fmt, names, partial, counts, rows in found:
+        object_id = db.execute("INSERT INTO objects (file_id, offset, format, names, partial, scores, tracks, instruments, waves) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (file_id, offset, fmt, names, partial) + counts).lastrowid
+        db.executemany("INSERT INTO entries (object_id, kind, idx, name, hash, cycle_size, octave) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(object_id,) + r for r in rows])
+    if skipped:
+        return "error: " + "; ".join(skipped)
+    return "indexed"
+
+
+def prune(db) -> int:
+    """Drop files that no longer exist from the catalog."""
+    gone = [(i,) for i, path in db.execute("SELECT id, path FROM files") if not os.path.exists(path)]
+    db.executemany("DELETE FROM files WHERE id = ?", gone)
+    db.executemany("DELETE FROM errors WHERE path = ?",
+                   [(path,) for path, in db.execute("SELECT path FROM errors") if not os.path.exists(path)])
+    return len(gone)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index a library of Medley Sound objects and projects into SQLite and query it.",
+                                     epilog="Queries: wave NAME, name NAME (any entry), hash HASH, partial, errors, sql STATEMENT.  "
+                                            "NAME is an SQL LIKE pattern, eg. %bass%.")
+    parser.add_argument("-d", "--database", default="medley.db", help="catalog database (default: medley.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    scan_cmd = commands.add_parser("scan", help="add or refresh files, directories or glob patterns")
+    scan_cmd.add_argument("paths", nargs="+")
+    scan_cmd.add_argument("-p", "--prune", action="store_true", help="drop deleted files from the catalog")
+    query_cmd = commands.add_parser("query", help="query the catalog")
+    query_cmd.add_argument("query", choices=sorted(QUERIES) + ["sql"])
+    query_cmd.add_argument("argument", nargs="?", default=None)
+    args = parser.parse_args()
+    if args.command == "query":
+        if args.query in PLAIN_QUERIES and args.argument is not None:
+            parser.error(f"query {args.query} takes no argument")
+        if args.query not in PLAIN_QUERIES and args.argument is None:
+            parser.error(f"query {args.query} needs an argument")
+
+    db = connect(args.database)
+    if args.command == "scan":
+        results = {}
+        with db:
+            for filename in expand(args.paths):
+                result = index(db, filename)
+                if result.startswith("error"):
+                    print(f"{filename}: {result}")
+                    result = "failed"
+                results[result] = results.get(result, 0) + 1
+            if args.prune:
+                results["pruned"] = prune(db)
+        print(", ".join(f"{count:d} {result}" for result, count in sorted(results.items())))
+    else:
+        try:
+            if args.query == "sql":
+                cursor = db.execute(args.argument)
+            elif args.query in PLAIN_QUERIES:
+                cursor = db.execute(QUERIES[args.query])
+            else:
+                cursor = db.execute(QUERIES[args.query], (args.argument,))
+        except sqlite3.Error as e:
+            print(f"Error: {e}")
+            db.close()
+            sys.exit(1)
+        for row in cursor:
+            print("\t".join("" if v is None else str(v) for v in row))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
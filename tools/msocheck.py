@@ -0,0 +1,361 @@
+#!/bin/python
+
+# Check the track data and cross-references of Medley Sound objects and
+# projects for the failure modes listed under "Track Data" in
+# medley_sound_internals.org: SCODEs beyond the jump table, UDATA
+# operands that aren't powers of two, TRACK and RPEAT/LOOP nesting
+# beyond eight levels, the TSIGN value that crashes the editor, and
+# references to undefined tracks, instruments and waves.
+#
+# Each track is checked in one linear pass that also collects its calls,
+# jumps and instrument changes.  The results of the pass only depend on
+# the track data, so they're cached by content hash and an edited
+# project only has its changed tracks checked again, also across runs
+# when the cache is kept in an SQLite file.  The summaries are then
+# joined into one cross-reference graph, and the nesting depths
+# are found by iterating over the graph until they settle.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+from msob import loadFile
+from pvms import loadProject
+from pvmsdedup import digest
+from track import SC_END, SC_INSTR, SC_LOOP, SC_RPEAT, SC_TRACK, SC_TRNSP, SC_TSIGN, SC_UDATA, lines
+
+MAX_NESTING = 8
+MAX_LOOPS = 8
+LAST_SCODE = 0x8f # end of the player's jump table
+
+ERROR = "error"
+WARNING = "warning"
+INFO = "info"
+SEVERITIES = (ERROR, WARNING, INFO)
+
+CACHE = os.path.join(os.path.expanduser("~"), ".cache", "msocheck.sqlite")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    key TEXT PRIMARY KEY,      -- content hash of the track data
+    summary TEXT NOT NULL      -- TrackSummary.asJson()
+);
+"""
+
+
+class Diagnostic:
+    """One finding.  kind and number name the entry it's about, eg.
+    "track" and 0x12, and line is the track line or None.  code is a
+    short stable identifier of the kind of finding."""
+
+    __slots__ = ("severity", "code", "kind", "number", "line", "message")
+
+    def __init__(self, severity: str, code: str, kind: str, number: int, line: int, message: str):
+        self.severity = severity
+        self.code = code
+        self.kind = kind
+        self.number = number
+        self.line = line
+        self.message = message
+
+    def __str__(self) -> str:
+        where = f"{self.kind} {self.number:02x}"
+        if self.line is not None:
+            where += f" line {self.line:04x}"
+        return f"{where}: {self.severity}: {self.message} [{self.code}]"
+
+    def asDict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class TrackSummary:
+    """The result of checking one track's data on its own.
+
+    problems are (severity, code, line, message) tuples.  calls and
+    jumps are (line, track, loop depth) tuples of the TRACK lines and of
+    the tracks UDATA can pick, and instruments (line, instrument) tuples
+    of the INSTR lines.  loops is the deepest RPEAT nesting within the
+    track."""
+
+    __slots__ = ("problems", "calls", "jumps", "instruments", "loops")
+
+    def __init__(self, data):
+        self.problems = []
+        self.calls = []
+        self.jumps = []
+        self.instruments = []
+        self.loops = 0
+        self._check(lines(data))
+
+    @classmethod
+    def fromJson(cls, text: str):
+        """Return a summary saved with asJson() without checking the
+        track again."""
+        summary = cls.__new__(cls)
+        record = json.loads(text)
+        summary.problems = [tuple(problem) for problem in record["problems"]]
+        summary.calls = [tuple(call) for call in record["calls"]]
+        summary.jumps = [tuple(jump) for jump in record["jumps"]]
+        summary.instruments = [tuple(instrument) for instrument in record["instruments"]]
+        summary.loops = record["loops"]
+        return summary
+
+    def asJson(self) -> str:
+        return json.dumps({name: getattr(self, name) for name in self.__slots__})
+
+    def _problem(self, severity: str, code: str, line: int, message: str):
+        self.problems.append((severity, code, line, message))
+
+    def _check(self, words):
+        depth = 0
+        window = 0 # end of the lines covered by a UDATA
+        end = len(words)
+        if not words or words[-1] != SC_END << 8:
+            self._problem(ERROR, "end-missing", None, "track data has no end marker")
+        else:
+            end -= 1
+        for i in range(end):
+            op = words[i] >> 8
+            arg = words[i] & 0xff
+            if i < window:
+                # UDATA only uses the operand, but the line is played as
+                # is if the picked track is undefined.
+                self.jumps.append((i, arg, depth))
+            if op < 0x80:
+                continue
+            if op == SC_TSIGN:
+                if arg & 7 == 7:
+                    self._problem(ERROR, "tsign-128", i, f"TSIGN ${arg:02x} (x/128) crashes the editor")
+            elif op == SC_INSTR:
+                if i >= window:
+                    self.instruments.append((i, arg))
+            elif op == SC_UDATA:
+                self._problem(INFO, "udata-msplay", i, "UDATA is broken in the standalone player (msplay)")
+                if arg == 0:
+                    self._problem(WARNING, "udata-operand", i, "UDATA $00 does nothing")
+                elif arg & (arg - 1):
+                    self._problem(WARNING, "udata-operand", i,
+                                  f"UDATA ${arg:02x} isn't a power of two, only {1 << bin(arg - 1).count('1'):d} "
+                                  f"of the lines can be picked")
+                if i + arg >= end:
+                    self._problem(ERROR, "udata-overrun", i,
+                                  f"UDATA covers {arg:d} lines but only {end - i - 1:d} follow")
+                window = max(window, i + 1 + arg)
+            elif op == SC_TRACK:
+                if i >= window:
+                    self.calls.append((i, arg, depth))
+            elif op == SC_RPEAT:
+                depth += 1
+                if depth == MAX_LOOPS + 1:
+                    self._problem(ERROR, "loop-depth", i, f"RPEAT nests more than {MAX_LOOPS:d} loops")
+                self.loops = max(self.loops, depth)
+            elif op == SC_LOOP:
+                if depth:
+                    depth -= 1
+                else:
+                    self._problem(INFO, "loop-outer", i, "LOOP without a RPEAT closes a loop of the calling track")
+            elif op == SC_END:
+                self._problem(WARNING, "end-early", i, f"${words[i]:04x} ends the track before its end marker")
+            elif op > LAST_SCODE:
+                self._problem(ERROR, "scode-range", i, f"SCODE ${op:02x} is beyond ${LAST_SCODE:02x} and jumps to undefined memory")
+            elif op > SC_TRNSP:
+                self._problem(WARNING, "scode-unused", i, f"SCODE ${op:02x} has no documented function")
+        if depth:
+            self._problem(INFO, "loop-open", None, f"{depth:d} RPEAT left open at the end of the track")
+
+
+class Validator:
+    """Check projects, remembering the track summaries by content hash
+    between calls.  If filename is given, the summaries are also kept
+    in that SQLite file between runs: the known ones are read when it's
+    opened, and save() adds the new ones.  hits and misses count the
+    summary lookups."""
+
+    def __init__(self, filename: str = None):
+        self.cache = {}
+        self.db = None
+        self._added = {}
+        self.hits = 0
+        self.misses = 0
+        if filename:
+            self.db = sqlite3.connect(filename)
+            self.db.executescript(SCHEMA)
+            self._saved = dict(self.db.execute("SELECT key, summary FROM summaries"))
+        else:
+            self._saved = {}
+
+    def summary(self, data) -> TrackSummary:
+        key = digest(data)
+        summary = self.cache.get(key)
+        if summary is None and key in self._saved:
+            summary = self.cache[key] = TrackSummary.fromJson(self._saved[key])
+        if summary is None:
+            self.misses += 1
+            summary = self.cache[key] = TrackSummary(data)
+            self._added[key] = summary
+        else:
+            self.hits += 1
+        return summary
+
+    def save(self):
+        """Write the summaries found since the last save to the file."""
+        if self.db is None:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?)",
+                                ((key, summary.asJson()) for key, summary in self._added.items()))
+        self._added = {}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def open(filename: str = CACHE):
+        """Return a Validator keeping its summaries in filename, or only
+        in memory if the file can't be used."""
+        try:
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            return Validator(filename)
+        except (OSError, sqlite3.Error):
+            return Validator()
+
+    def validate(self, project) -> list:
+        """Return the Diagnostics of a PVMS model, sorted by entry."""
+        out = []
+        tracks = project.tracks
+        instruments = project.instruments
+        summaries = {}
+        for t, track in enumerate(tracks):
+            if track is None:
+                continue
+            summary = summaries[t] = self.summary(track.data)
+            for severity, code, line, message in summary.problems:
+                out.append(Diagnostic(severity, code, "track", t, line, message))
+            for line, target, depth in summary.calls:
+                if target and tracks[target] is None:
+                    out.append(Diagnostic(WARNING, "track-undefined", "track", t, line,
+                                          f"TRACK {target:02x} is undefined and skipped"))
+            for line, target, depth in summary.jumps:
+                if target and tracks[target] is None:
+                    out.append(Diagnostic(WARNING, "track-undefined", "track", t, line,
+                                          f"UDATA target {target:02x} is undefined, the following lines are played"))
+            for line, number in summary.instruments:
+                if number and instruments[number] is None:
+                    out.append(Diagnostic(ERROR, "instrument-undefined", "track", t, line,
+                                          f"INSTR {number:02x} is undefined"))
+            if track.defInstr and instruments[track.defInstr] is None:
+                out.append(Diagnostic(WARNING, "instrument-undefined", "track", t, None,
+                                      f"default instrument {track.defInstr:02x} is undefined"))
+
+        for i, instrument in enumerate(instruments):
+            if instrument is None:
+                continue
+            for slot, w in enumerate(instrument.waveRefs):
+                if w and project.waves[w] is None:
+                    out.append(Diagnostic(ERROR, "wave-undefined", "instrument", i, None,
+                                          f"wave {w:02x} of octave {slot:d} is undefined"))
+
+        nesting, loops = self.depths(summaries)
+        for s, score in enumerate(project.scores):
+            if score is None:
+                continue
+            for ch, t in enumerate(score.tracks):
+                if not t:
+                    continue
+                if tracks[t] is None:
+                    out.append(Diagnostic(WARNING, "track-undefined", "score", s, None,
+                                          f"track {t:02x} of channel {ch + 1:d} is undefined"))
+                    continue
+                if nesting[t] > MAX_NESTING:
+                    out.append(Diagnostic(WARNING, "track-depth", "score", s, None,
+                                          f"TRACK calls from track {t:02x} of channel {ch + 1:d} nest more than "
+                                          f"{MAX_NESTING:d} levels, deeper calls are skipped"))
+                if loops[t] > MAX_LOOPS:
+                    out.append(Diagnostic(ERROR, "loop-depth", "score", s, None,
+                                          f"RPEAT in the calls from track {t:02x} of channel {ch + 1:d} nests more "
+                                          f"than {MAX_LOOPS:d} loops"))
+            for number in set(score.instrs) | {score.defInstr}:
+                if number and instruments[number] is None:
+                    out.append(Diagnostic(ERROR, "instrument-undefined", "score", s, None,
+                                          f"instrument {number:02x} is undefined"))
+        out.sort(key=lambda d: (d.kind != "score", d.kind, d.number, -1 if d.line is None else d.line))
+        return out
+
+    @staticmethod
+    def depths(summaries: dict) -> tuple:
+        """Return the deepest TRACK nesting and RPEAT nesting reached
+        from each track, as 256-entry lists capped one past the limits.
+
+        TRACK adds a nesting level, a UDATA jump doesn't.  The loops
+        open at a call carry over into the called track."""
+        nesting = [0] * 256
+        loops = [0] * 256
+        for t, summary in summaries.items():
+            loops[t] = min(summary.loops, MAX_LOOPS + 1)
+        edges = [(t, target, depth, 1) for t, summary in summaries.items()
+                 for line, target, depth in summary.calls if target in summaries]
+        edges += [(t, target, depth, 0) for t, summary in summaries.items()
+                  for line, target, depth in summary.jumps if target in summaries]
+        changed = True
+        while changed:
+            changed = False
+            for t, target, depth, level in edges:
+                n = min(nesting[target] + level, MAX_NESTING + 1)
+                if n > nesting[t]:
+                    nesting[t] = n
+                    changed = True
+                n = min(loops[target] + depth, MAX_LOOPS + 1)
+                if n > loops[t]:
+                    loops[t] = n
+                    changed = True
+        return nesting, loops
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the track data and cross-references of Medley Sound objects and projects.")
+    parser.add_argument("filenames", nargs="+", help="MSOB or PVMS files")
+    parser.add_argument("-l", "--level", choices=SEVERITIES, default=WARNING,
+                        help="least severe findings to report (default: warning)")
+    parser.add_argument("-j", "--json", action="store_true", help="write one JSON record per finding to stdout as NDJSON")
+    parser.add_argument("-c", "--cache", default=CACHE, help=f"file keeping the track summaries between runs (default: {CACHE})")
+    parser.add_argument("-C", "--no-cache", action="store_true", help="don't keep the track summaries between runs")
+    args = parser.parse_args()
+
+    shown = SEVERITIES[:SEVERITIES.index(args.level) + 1]
+    validator = Validator() if args.no_cache else Validator.open(args.cache)
+    failed = False
+    for filename in args.filenames:
+        try:
+            project = loadProject(loadFile(filename))
+        except (OSError, ValueError) as e:
+            failed = True
+            if args.json:
+                sys.stdout.write(json.dumps({"file": filename, "severity": ERROR, "code": "load", "message": str(e)}) + "\n")
+            else:
+                print(f"{filename}: Error: {e}")
+            continue
+        for diagnostic in validator.validate(project):
+            failed |= diagnostic.severity == ERROR
+            if diagnostic.severity not in shown:
+                continue
+            if args.json:
+                sys.stdout.write(json.dumps({"file": filename, **diagnostic.asDict()}) + "\n")
+            else:
+                print(f"{filename}: {diagnostic}")
+    try:
+        validator.save()
+    except sqlite3.Error as e:
+        print(f"Warning: track summaries not saved: {e}", file=sys.stderr)
+    validator.close()
+    if not args.json:
+        print(f"{validator.misses:d} tracks checked, {validator.hits:d} unchanged tracks skipped.")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -1,125 +1,183 @@
 #!/bin/python
 
+import argparse
+import json
+import struct
 import sys
 
+from msob import HEADER_SIZE, MsobReader, huntMagic, loadFile
+from msoscan import scan
+from probe import NULL, Probe
+from pvms import decodeName
 
-def getBoolean(inBuf: bytes, offset: int) -> bool:
-    if inBuf[offset] == 0:
-        return False
-    return True
 
-
-def getPointer(inBuf: bytes, offset: int) -> int:
-    # calculate an absolute pointer from a relative vector.
-    vector = int(inBuf[offset:offset+4].hex(), base=16)
-    if vector != 0:
-        return vector + offset
-    return 0
-
-
-def getTable(inBuf: bytes, offset: int, partial: bool) -> list:
-    count = 255
-    if partial:
-        count = inBuf[offset - 1]
-        if count == 0:
-            return [0]
-    tbl = [count]
-    for i in range(1, count + 1):
-        tbl.append(getPointer(inBuf, 4 * i + offset))
-    return tbl
-
-
-def huntMagic(inBuf: bytes, inBufLen: int) -> int:
-    i = 0
-    while (i < inBufLen):
-        if inBuf[i] == 77:
-            if inBuf[i:i+4] == b'MSOB':
-                return i
-        i += 1
-    return -1
-
-
-def decode_msob(inBuf: bytes, inBufLen: int):
-    # The pointer to magic bytes is the root for everything else and
-    # may not always be at the beginning of the file!
+def decodeObject(mso: MsobReader, probe=NULL) -> dict:
+    """Return the header flags, table offsets and entries of an object
+    as a JSON-serialisable dict.  The header and each table are
+    measured as sections of probe."""
     msoHeader = dict()
-    msoHeader['base'] = huntMagic(inBuf, inBufLen)
-    if msoHeader['base'] < 0:
+    with probe.section('header') as section:
+        msoHeader['base'] = mso.base
+        msoHeader['scoTable'] = mso.scores.offset
+        msoHeader['trkTable'] = mso.tracks.offset
+        msoHeader['insTable'] = mso.instruments.offset
+        msoHeader['wavTable'] = mso.waves.offset
+        # There's four reserved 4-byte vectors that are expected to be zero.
+        msoHeader['reserved'] = mso.reserved()
+        msoHeader['names'] = mso.names
+        msoHeader['partTables'] = mso.partTables
+        msoHeader['tableCounts'] = [len(mso.scores), len(mso.tracks), len(mso.instruments), len(mso.waves)]
+        section.bytesIn = HEADER_SIZE
+
+    nameSize = 16 if mso.names else 0
+
+    def name(p):
+        return decodeName(mso.name(p)) if mso.names else None
+
+    with probe.section('scores') as section:
+        msoHeader['scores'] = [{'index': i, 'name': name(p)} for i, p in mso.scores.defined()]
+        section.entries = len(msoHeader['scores'])
+        section.bytesIn = 4 * len(mso.scores) + nameSize * section.entries
+    with probe.section('tracks') as section:
+        msoHeader['tracks'] = []
+        for i, p in mso.tracks.defined():
+            try:
+                msoHeader['tracks'].append({'index': i, 'name': name(p), 'lines': mso.trackLength(p) // 2})
+            except IndexError as e:
+                # a problem of the track, not of the whole object
+                msoHeader['tracks'].append({'index': i, 'name': name(p), 'lines': None, 'problem': str(e)})
+        section.entries = len(msoHeader['tracks'])
+        section.bytesIn = 4 * len(mso.tracks) + nameSize * section.entries + sum(2 * t['lines'] + 2 for t in msoHeader['tracks'] if t['lines'] is not None)
+    with probe.section('instruments') as section:
+        msoHeader['instruments'] = [{'index': i, 'name': name(p)} for i, p in mso.instruments.defined()]
+        section.entries = len(msoHeader['instruments'])
+        section.bytesIn = 4 * len(mso.instruments) + nameSize * section.entries
+    with probe.section('waves') as section:
+        msoHeader['waves'] = []
+        for i, p in mso.waves.defined():
+            cycleSize, dummy, octave, fragFactor, isDoubleBufd, data = mso.wave(p)
+            msoHeader['waves'].append({'index': i, 'name': name(p), 'cycleSize': cycleSize, 'octave': octave,
+                                       'fragFactor': fragFactor, 'isDoubleBufd': isDoubleBufd})
+        section.entries = len(msoHeader['waves'])
+        section.bytesIn = 4 * len(mso.waves) + (nameSize + 8) * section.entries
+    return msoHeader
+
+
+def decode_msob(inBuf: bytes, inBufLen: int, probe=NULL, quiet: bool = False) -> dict:
+    # The pointer to magic bytes is the root for everything else and
+    # may not always be at the beginning of the file!  quiet leaves
+    # out the lists of entries.
+    with probe.section('hunt') as section:
+        base = huntMagic(inBuf)
+        section.bytesIn = inBufLen if base < 0 else base + 4
+    if base < 0:
         print('Magic bytes "MSOB" not found!\n')
-        sys.exit()
-    print('Magic bytes "MSOB" found at: ' + f"{msoHeader['base']:#010x}")
-    if msoHeader['base'] > 0:
+        return None
+    print('Magic bytes "MSOB" found at: ' + f"{base:#010x}")
+    if base > 0:
         print('All following offsets are relative to the location of magic bytes!')
-        inBuf = inBuf[msoHeader['base']:-1]   # ...and we can scrap the object header as we have no need for it.
-
-    msoHeader['scoTable'] = getPointer(inBuf, 4)
-    msoHeader['trkTable'] = getPointer(inBuf, 8)
-    msoHeader['insTable'] = getPointer(inBuf, 12)
-    msoHeader['wavTable'] = getPointer(inBuf, 16)
+    msoHeader = decodeObject(MsobReader(inBuf, base), probe)
 
     print('Score/Track/Instrument/Wave tables at: ' + f"{msoHeader['scoTable']:#010x}" + ' / ' + f"{msoHeader['trkTable']:#010x}" + ' / ' + f"{msoHeader['insTable']:#010x}" + ' / ' + f"{msoHeader['wavTable']:#010x}")
 
-    # There's four reserved 4-byte vectors that are expected to be zero.
-    for i in [20, 24, 28, 32]:
-        j = int(inBuf[i:i+4].hex(), base=16)
-        if j != 0:
-            print('Unexpected value of a reserved field at ' + f"{i:#010x}" + ': ' + f"{j:#010x}")
+    for i, j in msoHeader['reserved']:
+        print('Unexpected value of a reserved field at ' + f"{i:#010x}" + ': ' + f"{j:#010x}")
 
-    msoHeader['names'] = getBoolean(inBuf, 36)
-    msoHeader['partTables'] = getBoolean(inBuf, 37)
     print('Flags:\n - Names are included: ' + str(msoHeader['names']) + '\n - Partial tables used: ' + str(msoHeader['partTables']))
 
-    msoScoTable = [] + getTable(inBuf, msoHeader['scoTable'], msoHeader['partTables'])
-    msoTrkTable = [] + getTable(inBuf, msoHeader['trkTable'], msoHeader['partTables'])
-    msoInsTable = [] + getTable(inBuf, msoHeader['insTable'], msoHeader['partTables'])
-    msoWavTable = [] + getTable(inBuf, msoHeader['wavTable'], msoHeader['partTables'])
-
-    if msoHeader['names']:
-        print('\nScore list:')
-        i = 1
-        while i <= msoScoTable[0]:
-            if msoScoTable[i] != 0:
-                p = msoScoTable[i]
-                print(f" - {i:#04x}: {inBuf[p:p + 16].decode()}")
-            i += 1
-
-        print('\nTrack list:')
-        i = 1
-        while i <= msoTrkTable[0]:
-            if msoTrkTable[i] != 0:
-                p = msoTrkTable[i]
-                print(f" - {i:#04x}: {inBuf[p:p + 16].decode()}")
-            i += 1
-
-        print('\nInstrument list:')
-        i = 1
-        while i <= msoInsTable[0]:
-            if msoInsTable[i] != 0:
-                p = msoInsTable[i]
-                print(f" - {i:#04x}: {inBuf[p:p + 16].decode()}")
-            i += 1
-
-        print('\nWave list:')
-        i = 1
-        while i <= msoWavTable[0]:
-            if msoWavTable[i] != 0:
-                p = msoWavTable[i]
-                for j in range(16):
-                    if inBuf[p + j] == 0:
-                        break
-                name = inBuf[p:p + j].decode(encoding="latin_1")
-                print(f" - {i:#04x}: {name:<16} // CycleSize = {inBuf[p + 16:p + 18].hex()} ; Octave = {inBuf[p + 20:p + 21].hex()} ; FragFactor = {inBuf[p + 21:p + 22].hex()} ; IsDoubleBufd = {inBuf[p + 22:p + 23].hex()}")
-            i += 1
+    for entry in msoHeader['tracks']:
+        if 'problem' in entry:
+            print(f"Track {entry['index']:#04x}: {entry['problem']}")
+
+    if msoHeader['names'] and not quiet:
+        with probe.section('listing') as section:
+            print('\nScore list:')
+            for entry in msoHeader['scores']:
+                print(f" - {entry['index']:#04x}: {entry['name']:<16}")
+
+            print('\nTrack list:')
+            for entry in msoHeader['tracks']:
+                print(f" - {entry['index']:#04x}: {entry['name']:<16}")
+
+            print('\nInstrument list:')
+            for entry in msoHeader['instruments']:
+                print(f" - {entry['index']:#04x}: {entry['name']:<16}")
+
+            print('\nWave list:')
+            for entry in msoHeader['waves']:
+                print(f" - {entry['index']:#04x}: {entry['name']:<16} // CycleSize = {entry['cycleSize']:04x} ; Octave = {entry['octave']:02x} ; FragFactor = {entry['fragFactor']:02x} ; IsDoubleBufd = {entry['isDoubleBufd']:02x}")
+            section.entries = sum(len(msoHeader[table]) for table in ('scores', 'tracks', 'instruments', 'waves'))
+    return msoHeader
+
+
+def decodeFile(filename: str):
+    """Yield a record for every valid object in a file, or a single
+    error record if there are none."""
+    try:
+        in_bytes = loadFile(filename)
+    except OSError as e:
+        yield {'file': filename, 'error': str(e)}
+        return
+    found = False
+    errors = []
+    for offset, mso, problems in scan(in_bytes):
+        if problems:
+            errors.append(f'object at {offset:#010x}: {problems[0]}')
+            continue
+        try:
+            record = decodeObject(mso)
+        except (IndexError, struct.error) as e:
+            errors.append(f'object at {offset:#010x}: {e}')
+            continue
+        found = True
+        yield {'file': filename, **record}
+    if not found:
+        yield {'file': filename, 'error': '; '.join(errors) or 'Magic bytes "MSOB" not found!'}
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Display Medley Sound Object flags and names of scores, tracks, instruments, and waves.")
+    parser.add_argument("filenames", nargs="*", help="files to decode")
+    parser.add_argument("-j", "--json", action="store_true",
+                        help="write one JSON record per object (or per file on error) to stdout as NDJSON")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't list the entries")
+    parser.add_argument("-p", "--profile", action="store_true", help="print the time, bytes, entries and allocations of each table")
+    parser.add_argument("-t", "--trace", help="write each table's measurements to this file as NDJSON")
+    args = parser.parse_args()
+
+    if args.json:
+        failed = False
+        for filename in args.filenames:
+            for record in decodeFile(filename):
+                failed |= 'error' in record
+                sys.stdout.write(json.dumps(record) + '\n')
+                sys.stdout.flush()
+        sys.exit(1 if failed else 0)
+
     print('MSOB decoder 0.1 by Archyx.\n')
 
-    if len(sys.argv) > 1:
-        with open(sys.argv[1], 'rb') as f_in:
-            in_bytes = f_in.read()
+    if args.filenames:
+        trace = open(args.trace, 'w') if args.trace else None
+        probe = Probe(trace) if args.profile or trace else NULL
+        failed = False
+        for filename in args.filenames:
+            if len(args.filenames) > 1:
+                print(f'\n{filename}:')
+            in_bytes = loadFile(filename)
             in_bytecount = len(in_bytes)
 
-        decode_msob(in_bytes, in_bytecount)
+            try:
+                decode_msob(in_bytes, in_bytecount, probe, args.quiet)
+            except (ValueError, IndexError, struct.error) as e:
+                failed = True
+                print(f'Error: {e}')
+        if trace:
+            trace.close()
+        if args.profile:
+            print()
+            print(probe.summary())
+        if failed:
+            sys.exit(1)
     else:
         print('No filename given.')
 
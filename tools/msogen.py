@@ -0,0 +1,188 @@
+#!/bin/python
+
+# Generate synthetic Medley Sound objects and projects of a given size
+# for tests and benchmarks.
+#
+# The output is valid for the player and passes msocheck: waves are
+# random data with the octave the editor would give them (0 for
+# samples), instruments use the standard sound mode with a plain
+# envelope, and tracks are notes and rests with INSTR, DYNLV, TRNSP
+# and RPEAT/LOOP lines.  The tracks are laid out in chains where each
+# track calls the next one with TRACK, up to the chosen nesting depth,
+# and the scores play the heads of the chains.  The same seed and sizes
+# always give the same bytes.
+
+import argparse
+import random
+import struct
+import sys
+
+from msob import writeMsob
+from pvms import PVMS, ByteSink, Instrument, Score, Track, Wave
+from pvms2mso import export_instrument, export_score, export_track, export_wave
+from track import SC_DYNLV, SC_INSTR, SC_LOOP, SC_RPEAT, SC_TRACK, SC_TRNSP
+from waveops import octave
+
+MAX_NESTING = 8
+IDENTITY = list(range(256))
+
+
+class Sizes:
+    """The shape of a generated project.  waveSizes are the cycle sizes
+    waves are picked from, trackLines the number of lines per track
+    without the end marker, and depth the length of the TRACK call
+    chains."""
+
+    __slots__ = ("waves", "waveSizes", "instruments", "tracks", "trackLines", "depth", "scores")
+
+    def __init__(self, waves: int = 16, waveSizes=(0x80,), instruments: int = 16, tracks: int = 32,
+                 trackLines: int = 64, depth: int = 2, scores: int = 4):
+        for label, count in (("waves", waves), ("instruments", instruments), ("tracks", tracks), ("scores", scores)):
+            if not 1 <= count <= 255:
+                raise ValueError(f"number of {label} must be 1 to 255.")
+        if not 1 <= depth <= MAX_NESTING + 1:
+            raise ValueError(f"nesting depth must be 1 to {MAX_NESTING + 1:d}.")
+        if trackLines < 1:
+            raise ValueError("tracks need at least one line.")
+        if not waveSizes or any(not 2 <= size <= 0xfffe or size & 1 for size in waveSizes):
+            raise ValueError("wave sizes must be even and 2 to $fffe.")
+        self.waves = waves
+        self.waveSizes = tuple(waveSizes)
+        self.instruments = instruments
+        self.tracks = tracks
+        self.trackLines = trackLines
+        self.depth = depth
+        self.scores = scores
+
+
+def _name(label: str, number: int, names: bool) -> bytes:
+    return f"{label} {number:02x}".encode("latin_1").ljust(16, b"\x00") if names else bytes(16)
+
+
+def _instrument(rng, waves: int) -> bytes:
+    body = bytearray(0x6a)
+    body[0x4:0xc] = bytes(rng.randint(1, waves) for n in range(8)) # ins_WaveRefs
+    # attack to full level, decay to half, slow release
+    struct.pack_into(">BBBBHHHHH", body, 0x14, 0, 0, 0, 0, 0xfc00, 0x8000, 0x4000, 0x0400, 0x0800)
+    return bytes(body)
+
+
+def _track(rng, lines: int, instruments: int, callee: int) -> bytes:
+    """Return track data of lines lines plus the end marker.  If callee
+    is non-zero, the track calls it halfway through."""
+    words = []
+    loops = 0
+    while len(words) < lines:
+        left = lines - len(words)
+        r = rng.random()
+        if callee and len(words) >= lines // 2 and left > loops:
+            words.append(SC_TRACK << 8 | callee)
+            callee = 0
+        elif loops and (left <= loops or r < 0.05):
+            words.append(SC_LOOP << 8)
+            loops -= 1
+        elif r < 0.05 and left > loops + 2 and loops < 2:
+            words.append(SC_RPEAT << 8 | rng.randint(2, 4))
+            loops += 1
+        elif r < 0.10:
+            words.append(SC_INSTR << 8 | rng.randint(1, instruments))
+        elif r < 0.13:
+            words.append(SC_DYNLV << 8 | rng.randint(0x40, 0x7f))
+        elif r < 0.15:
+            words.append(SC_TRNSP << 8 | rng.randint(-12, 12) & 0xff)
+        elif r < 0.25:
+            words.append(rng.choice((0x06, 0x0c, 0x18))) # rest
+        else:
+            words.append(rng.randint(0x0e, 0x4a) << 8 | rng.choice((0x06, 0x0c, 0x18, 0x30)))
+    words.append(0x8000)
+    return struct.pack(f">{len(words):d}H", *words)
+
+
+def generate(sizes: Sizes, seed: int = 0, names: bool = True) -> PVMS:
+    """Return a generated project."""
+    rng = random.Random(seed)
+    project = PVMS()
+    for i in range(1, sizes.waves + 1):
+        size = rng.choice(sizes.waveSizes)
+        project.waves[i] = Wave(_name("wave", i, names), size, size, max(octave(size), 0), 0, 0, rng.randbytes(size))
+    for i in range(1, sizes.instruments + 1):
+        project.instruments[i] = Instrument(_name("instrument", i, names), _instrument(rng, sizes.waves))
+    heads = []
+    for t in range(1, sizes.tracks + 1):
+        level = (t - 1) % sizes.depth
+        if level == 0:
+            heads.append(t)
+        callee = t + 1 if level < sizes.depth - 1 and t < sizes.tracks else 0
+        project.tracks[t] = Track(_name("track", t, names), 1,
+                                  _track(rng, sizes.trackLines, sizes.instruments, callee))
+    for s in range(1, sizes.scores + 1):
+        body = bytearray(0x22)
+        body[0x0:0x4] = bytes(heads[(4 * (s - 1) + ch) % len(heads)] for ch in range(4)) # sco_Tracks
+        struct.pack_into(">H", body, 0x8, 14187)                                       # sco_Tempo, 50 Hz
+        body[0xa:0xe] = bytes(rng.randint(1, sizes.instruments) for ch in range(4))    # sco_Instrs
+        body[0xe] = 1                                                                  # sco_DefInstr
+        body[0x14] = 0x40                                                              # sco_Volume
+        body[0x1e:0x22] = b"\x40\x40\x40\x40"                                          # sco_Volumes
+        project.scores[s] = Score(_name("score", s, names), bytes(body))
+    return project
+
+
+def msobBytes(project, names: bool = True, partial: bool = True) -> bytes:
+    """Return a generated project as a Medley Sound Object, keeping the
+    entry numbers."""
+    tables = ([None if s is None else export_score(s, IDENTITY, IDENTITY) for s in project.scores],
+              [None if t is None else export_track(t, IDENTITY, IDENTITY) for t in project.tracks],
+              [None if i is None else export_instrument(i, IDENTITY) for i in project.instruments],
+              [None if w is None else export_wave(w) for w in project.waves])
+    out = ByteSink()
+    writeMsob(out, tables, names, partial)
+    return bytes(out.getbuffer())
+
+
+def pvmsBytes(project) -> bytes:
+    out = ByteSink()
+    project.save(out)
+    return bytes(out.getbuffer())
+
+
+def _numbers(text: str) -> tuple:
+    return tuple(int(n, 0) for n in text.split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Medley Sound object or project of a given size.",
+                                     epilog="Numbers can be given in hex with a 0x prefix.")
+    parser.add_argument("output", help="output file; a .pvms suffix writes a project, anything else an object")
+    parser.add_argument("-w", "--waves", type=lambda n: int(n, 0), default=16, help="number of waves (default: 16)")
+    parser.add_argument("-z", "--wave-sizes", type=_numbers, default=(0x80,),
+                        help="wave cycle sizes picked at random, separated by commas (default: 0x80)")
+    parser.add_argument("-i", "--instruments", type=lambda n: int(n, 0), default=16, help="number of instruments (default: 16)")
+    parser.add_argument("-t", "--tracks", type=lambda n: int(n, 0), default=32, help="number of tracks (default: 32)")
+    parser.add_argument("-l", "--track-lines", type=lambda n: int(n, 0), default=64, help="lines per track (default: 64)")
+    parser.add_argument("-d", "--depth", type=int, default=2, help="TRACK nesting depth of the track chains (default: 2)")
+    parser.add_argument("-s", "--scores", type=lambda n: int(n, 0), default=4, help="number of scores (default: 4)")
+    parser.add_argument("-n", "--strip-names", action="store_true", help="leave names out")
+    parser.add_argument("-f", "--full-tables", action="store_true", help="write full 255-entry tables in an object")
+    parser.add_argument("-r", "--seed", type=int, default=0, help="random seed (default: 0)")
+    args = parser.parse_args()
+
+    try:
+        sizes = Sizes(args.waves, args.wave_sizes, args.instruments, args.tracks, args.track_lines, args.depth,
+                      args.scores)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    project = generate(sizes, args.seed, not args.strip_names)
+    if args.output.lower().endswith(".pvms"):
+        data = pvmsBytes(project)
+    else:
+        data = msobBytes(project, not args.strip_names, not args.full_tables)
+    with open(args.output, "wb") as f_out:
+        f_out.write(data)
+    print(f"Wrote {len(data):d} bytes.")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,140 @@
+#!/bin/python
+
+# Prelinked replay images of Medley Sound Objects (MSOI), as built by
+# msoimage.py: the layout and a reader.
+#
+# The layout is fixed up to the entries, so nothing needs to be looked
+# up to find a table.  All values are big-endian like in an MSOB, and
+# offsets are from the magic bytes, 0 for an undefined entry.
+#
+# | offset | size      | description                                      |
+# |--------+-----------+--------------------------------------------------|
+# |    0x0 | .l        | magic bytes : "MSOI"                             |
+# |    0x4 | .w        | version (1)                                      |
+# |    0x6 | .b        | flag: names ($00 = stripped; $ff = kept)         |
+# |    0x7 | .b        | reserved (0x00)                                  |
+# |    0x8 | .l        | image size                                       |
+# |    0xc | .l        | reserved (0x00000000)                            |
+# |   0x10 | .l ×0x100 | score table: offsets of the entry data           |
+# |  0x410 | .l ×0x100 | track table                                      |
+# |  0x810 | .l ×0x100 | instrument table                                 |
+# |  0xc10 | .l ×0x100 | wave table                                       |
+# | 0x1010 | .l ×0x100 | track index: offset just past each end marker    |
+# | 0x1410 | .l ×0x200 | wave index: start and end offsets of the sample  |
+# |        |           | data of each wave                                |
+# | 0x1c10 |           | entries, word aligned                            |
+#
+# The table offsets point past the names, at the data the player uses.
+# If names are kept, the 16-byte name of an entry is right before its
+# data.  Index 0 of every table is 0, as in Medley Sound.
+
+import struct
+
+from track import END_MARKER
+
+MAGIC = b"MSOI"
+VERSION = 1
+SCORE_TABLE = 0x10
+TRACK_TABLE = 0x410
+INSTRUMENT_TABLE = 0x810
+WAVE_TABLE = 0xc10
+TRACK_INDEX = 0x1010
+WAVE_INDEX = 0x1410
+ENTRIES = 0x1c10
+MAX_SIZE = 0xffffffff
+
+_header = struct.Struct(">4sHBxLL")
+_tables = struct.Struct(">1024L")
+_trackIndex = struct.Struct(">256L")
+_waveIndex = struct.Struct(">512L")
+_word = struct.Struct(">H")
+
+
+def newImage(size: int, names: bool, tables, trackEnds, waveExtents) -> bytearray:
+    """Return a zeroed image of size bytes with the header, the 1024
+    table offsets (scores, tracks, instruments and waves) and the index
+    filled in.  waveExtents holds the start and end of each wave in
+    turn."""
+    image = bytearray(size)
+    _header.pack_into(image, 0, MAGIC, VERSION, 0xff if names else 0x00, size, 0)
+    _tables.pack_into(image, SCORE_TABLE, *tables)
+    _trackIndex.pack_into(image, TRACK_INDEX, *trackEnds)
+    _waveIndex.pack_into(image, WAVE_INDEX, *waveExtents)
+    return image
+
+
+class ImageReader:
+    """Access to a prelinked image in any buffer.  The tables and the
+    index are read with one unpack each and used as they are.  They
+    were range-checked when the image was built, so loading only makes
+    sure every entry lies within the image and agrees with the index,
+    and raises ValueError if one doesn't.
+
+    scores, tracks, instruments and waves are 256-entry tuples of data
+    offsets.  trackEnds holds the offset just past each track's end
+    marker, and waveStarts and waveEnds the extent of each wave's
+    sample data."""
+
+    __slots__ = ("buf", "names", "size", "scores", "tracks", "instruments", "waves",
+                 "trackEnds", "waveStarts", "waveEnds")
+
+    def __init__(self, inBuf):
+        self.buf = memoryview(inBuf)
+        if len(self.buf) < ENTRIES or self.buf[0:4] != MAGIC:
+            raise ValueError('Magic bytes "MSOI" not found.')
+        magic, version, names, self.size, reserved = _header.unpack_from(self.buf, 0)
+        if version != VERSION:
+            raise ValueError(f"image version {version:d} isn't supported.")
+        if self.size > len(self.buf):
+            raise ValueError(f"image is truncated to {len(self.buf):d} of {self.size:d} bytes.")
+        self.names = names != 0
+        tables = _tables.unpack_from(self.buf, SCORE_TABLE)
+        self.scores = tables[0:256]
+        self.tracks = tables[256:512]
+        self.instruments = tables[512:768]
+        self.waves = tables[768:1024]
+        self.trackEnds = _trackIndex.unpack_from(self.buf, TRACK_INDEX)
+        extents = _waveIndex.unpack_from(self.buf, WAVE_INDEX)
+        self.waveStarts = extents[0::2]
+        self.waveEnds = extents[1::2]
+        self._check(tables)
+
+    def _check(self, tables):
+        # Every entry must fit in the image, with the sizes an MSOB
+        # gives it: the index ends a track just past an end marker and
+        # a wave after the CycleSize bytes of its sample data.
+        first = ENTRIES + (16 if self.names else 0)
+        for label, offsets in (("table", tables), ("track index", self.trackEnds),
+                               ("wave index", self.waveStarts + self.waveEnds)):
+            if max(offsets) > self.size or min((o for o in offsets if o), default=first) < first:
+                raise ValueError(f"image {label} points outside the image.")
+        for label, table, size in (("score", self.scores, 0x22), ("instrument", self.instruments, 0x6a)):
+            for i, offset in self.defined(table):
+                if offset + size > self.size:
+                    raise ValueError(f"image {label} {i:02x} runs past the end of the image.")
+        for i, offset in self.defined(self.tracks):
+            end = self.trackEnds[i]
+            if offset + 2 > end or self.buf[end - 2:end] != END_MARKER:
+                raise ValueError(f"image track {i:02x} doesn't end with an end marker in the index.")
+        for i, offset in self.defined(self.waves):
+            if offset + 8 > self.size:
+                raise ValueError(f"image wave {i:02x} runs past the end of the image.")
+            cycleSize = _word.unpack_from(self.buf, offset)[0]
+            if self.waveStarts[i] != offset + 8 or self.waveEnds[i] - self.waveStarts[i] != cycleSize:
+                raise ValueError(f"image wave {i:02x} has a broken extent in the index.")
+
+    @staticmethod
+    def defined(table):
+        """Yield (index, offset) for every defined entry of a table."""
+        for index, offset in enumerate(table):
+            if offset:
+                yield index, offset
+
+    def name(self, offset: int) -> bytes:
+        """Return the raw 16-byte name of the entry with data at offset,
+        or b"" if names are stripped."""
+        if not self.names:
+            return b""
+        return self.buf[offset - 16:offset].tobytes()
+
+# EOF
@@ -0,0 +1,112 @@
+#!/bin/python
+
+# Build prelinked replay images of Medley Sound Objects.
+#
+# An MSOB has to be relocated before it's played: the tables hold
+# displacements relative to each table entry, partial tables end after
+# the last defined entry, and the end of a track is only found by
+# scanning for its end marker.  An image does all of that once, ahead
+# of time.  Its tables are always full, the offsets in them are
+# absolute and already checked to stay within the image, and the track
+# ends and wave extents are in an index next to the tables.  A replayer
+# reads the whole file into memory in one go and uses it as it is.
+#
+# See msoi.py for the layout of the image.
+
+import argparse
+import struct
+import sys
+
+from msob import MsobReader, huntMagic, loadFile
+from msoi import ENTRIES, MAX_SIZE, ImageReader, newImage
+
+
+def _extents(mso: MsobReader) -> list:
+    """Return the entries of an object as (table number, index, pointer,
+    data, end) tuples, checking that each lies within the object."""
+    limit = len(mso.buf)
+    out = []
+    for n, (label, table) in enumerate((("score", mso.scores), ("track", mso.tracks),
+                                        ("instrument", mso.instruments), ("wave", mso.waves))):
+        for i, p in table.defined():
+            data = mso.data(p)
+            if label == "score":
+                end = data + 0x22
+            elif label == "instrument":
+                end = data + 0x6a
+            elif label == "track":
+                try:
+                    end = data + mso.trackLength(p)
+                except IndexError:
+                    raise ValueError(f"track {i:02x} has no end marker.") from None
+            else:
+                if data + 8 > limit:
+                    raise ValueError(f"wave {i:02x} at {p:#010x} is out of bounds.")
+                end = data + 8 + struct.unpack_from(">H", mso.buf, data)[0]
+            if end > limit:
+                raise ValueError(f"{label} {i:02x} at {p:#010x} runs past the end of the object.")
+            out.append((n, i, p, data, end))
+    return out
+
+
+def buildImage(mso: MsobReader) -> bytearray:
+    """Return a prelinked image of an object.  Raises ValueError if the
+    object is broken."""
+    problems = mso.validate()
+    if problems:
+        raise ValueError(f"broken object: {problems[0]}.")
+    entries = _extents(mso)
+    nameSize = 16 if mso.names else 0
+    tables = [0] * 1024
+    trackEnds = [0] * 256
+    waveExtents = [0] * 512
+    layout = []
+    pos = ENTRIES
+    for n, i, p, data, end in entries:
+        start = pos + nameSize
+        tables[256 * n + i] = start
+        size = nameSize + end - data
+        if n == 1:
+            trackEnds[i] = start + end - data
+        elif n == 3:
+            waveExtents[2 * i] = start + 8
+            waveExtents[2 * i + 1] = start + end - data
+        layout.append((pos, p, end))
+        pos += size + (size & 1) # keep entries word aligned
+    if pos > MAX_SIZE:
+        raise ValueError(f"image of {pos:d} bytes is too big.")
+
+    image = newImage(pos, mso.names, tables, trackEnds, waveExtents)
+    for offset, p, end in layout:
+        image[offset:offset + end - p] = mso.buf[p:end]
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a prelinked replay image of a Medley Sound Object, with full tables of absolute offsets and an index of the track ends and wave extents.")
+    parser.add_argument("filename", help="file containing the object; the first object found is used")
+    parser.add_argument("-o", "--output", help="output file name (default: filename appended with '.msoi')")
+    args = parser.parse_args()
+
+    try:
+        in_bytes = loadFile(args.filename)
+        msoMagic = huntMagic(in_bytes)
+        if msoMagic < 0:
+            raise ValueError("Magic bytes not found!")
+        mso = MsobReader(in_bytes, msoMagic)
+        image = buildImage(mso)
+        with open(args.output or args.filename + ".msoi", "wb") as f_out:
+            f_out.write(image)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    reader = ImageReader(image)
+    counts = [sum(1 for offset in table if offset) for table in (reader.scores, reader.tracks, reader.instruments, reader.waves)]
+    print(f"Wrote {len(image):d} bytes: {counts[0]:d} scores, {counts[1]:d} tracks, {counts[2]:d} instruments, "
+          f"{counts[3]:d} waves.")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
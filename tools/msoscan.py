@@ -0,0 +1,62 @@
+#!/bin/python
+
+# Find Medley Sound Objects embedded in arbitrary files, eg. executables,
+# disk images (ADF/HDF) or memory dumps, and optionally extract them.
+
+import argparse
+import struct
+
+from msob import MsobReader, loadFile, scanMagic
+
+
+def scan(inBuf):
+    """Yield (offset, reader, problems) for every magic bytes occurrence.
+
+    reader is None if the object header is unreadable."""
+    for offset in scanMagic(inBuf):
+        try:
+            mso = MsobReader(inBuf, offset)
+            problems = mso.validate()
+        except (ValueError, IndexError, struct.error) as e:
+            yield offset, None, [str(e)]
+            continue
+        yield offset, mso, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan files of any size for embedded Medley Sound Objects.",
+                                     epilog="Hits are checked against the MSOB header layout. Use --all to also list rejected hits.")
+    parser.add_argument("filenames", nargs="+", help="files to scan")
+    parser.add_argument("-x", "--extract", action="store_true", help="extract valid objects into <filename>.<offset>.mso")
+    parser.add_argument("-a", "--all", action="store_true", help="report magic bytes that fail validation")
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        in_buf = loadFile(filename)
+        found = 0
+        for offset, mso, problems in scan(in_buf):
+            if problems:
+                if args.all:
+                    print(f"{filename}: {offset:#010x}: rejected: {'; '.join(problems)}")
+                continue
+            try:
+                size = mso.size()
+            except (IndexError, struct.error):
+                if args.all:
+                    print(f"{filename}: {offset:#010x}: rejected: track data runs past the end of file")
+                continue
+            found += 1
+            print(f"{filename}: {offset:#010x}: MSOB, {size:d} bytes, "
+                  f"{len(mso.scores)}/{len(mso.tracks)}/{len(mso.instruments)}/{len(mso.waves)} table entries, "
+                  f"names {'kept' if mso.names else 'stripped'}, {'partial' if mso.partTables else 'full'} tables")
+            if args.extract:
+                with open(f"{filename}.{offset:08x}.mso", "wb") as f_out:
+                    f_out.write(mso.buf[:size])
+            del mso
+        print(f"{filename}: {found:d} object(s) found.")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,213 @@
+#!/bin/python
+
+# Convert between Medley Sound projects and objects incrementally, for
+# an edit-export-listen loop on big projects.
+#
+# A sidecar SQLite cache keeps the encoded output of every entry under
+# a content hash of its input.  On the next run only the entries whose
+# hash isn't in the cache are encoded again, and the rest of the output
+# is put together from the cached blocks.  The tables are always laid
+# out anew, so a changed entry size only moves the entries after it.
+#
+# The hash of a PVMS entry bound for an object covers its name and
+# data, plus the renumbering tables it's exported with: a track or
+# score depends on the track and instrument numbers, and an instrument
+# on the wave numbers.  The TRACK, UDATA and INSTR references of each
+# track are cached the same way, as they decide which entries are
+# exported.  An object entry bound for a project is hashed from its raw
+# bytes and, if names are stripped, its number, which the generated
+# name is made of.
+#
+# The cache only keeps the entries of the latest run, so it stays the
+# size of one output.  Deleting it is always safe.
+
+import argparse
+import sqlite3
+import struct
+import sys
+import time
+
+from msob import MsobReader, atomicOpen, huntMagic, loadFile, writeMsob
+from mso2pvms import insBlock, scoBlock, trkBlock, wavBlock
+from pvms import INS, MAGIC as PVMS_MAGIC, PVMS, SCO, TRK, WAV2, PvmsWriter
+from pvms2mso import export_instrument, export_score, export_track, export_wave, parseScores, reachable, substitution
+from pvmsdedup import digest
+from track import references
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    key TEXT PRIMARY KEY,
+    name BLOB NOT NULL,
+    data BLOB NOT NULL         -- the encoded entry after the name
+);
+CREATE TABLE IF NOT EXISTS refs (
+    key TEXT PRIMARY KEY,
+    tracks BLOB NOT NULL,      -- track numbers a track refers to
+    instruments BLOB NOT NULL  -- instrument numbers a track refers to
+);
+"""
+
+
+class Sidecar:
+    """The cache of encoded entries.  Everything is read at once when
+    it's opened, and save() writes the new entries and drops the ones
+    the run didn't use.  hits and misses count the entry lookups."""
+
+    def __init__(self, filename: str):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.blocks = {key: (name, data) for key, name, data in self.db.execute("SELECT key, name, data FROM blocks")}
+        self.refs = {key: (set(tracks), set(instruments))
+                     for key, tracks, instruments in self.db.execute("SELECT key, tracks, instruments FROM refs")}
+        self._used = set()
+        self._added = {}
+        self._addedRefs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def block(self, key: str, encode, *args) -> tuple:
+        """Return the (name, data) of an entry, calling encode(*args)
+        for its (name, *parts) if key isn't cached."""
+        self._used.add(key)
+        block = self.blocks.get(key)
+        if block is None:
+            self.misses += 1
+            name, *parts = encode(*args)
+            block = self.blocks[key] = self._added[key] = (bytes(name), b"".join(parts))
+        else:
+            self.hits += 1
+        return block
+
+    def references(self, data) -> tuple:
+        """Return the track and instrument numbers of track data like
+        track.references()."""
+        key = digest(data)
+        self._used.add(key)
+        refs = self.refs.get(key)
+        if refs is None:
+            refs = self.refs[key] = references(data)
+            self._addedRefs[key] = (bytes(sorted(refs[0])), bytes(sorted(refs[1])))
+        return refs
+
+    def save(self):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)",
+                                ((key, name, data) for key, (name, data) in self._added.items()))
+            self.db.executemany("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)",
+                                ((key, tracks, instruments) for key, (tracks, instruments) in self._addedRefs.items()))
+            for table, cached in (("blocks", self.blocks), ("refs", self.refs)):
+                self.db.executemany(f"DELETE FROM {table} WHERE key = ?",
+                                    ((key,) for key in cached if key not in self._used))
+        self._added = {}
+        self._addedRefs = {}
+
+    def close(self):
+        self.db.close()
+
+
+def toMsob(source, scores, f_out, cache: Sidecar, names: bool = True, partial: bool = True) -> int:
+    """Write the scores of a PVMS model and the data they use as a
+    Medley Sound Object, like pvms2mso.export() does, encoding only the
+    entries not in cache.  Returns the size of the object."""
+    tracks, instruments, waves = reachable(source, scores, cache.references)
+    trackMap = substitution(tracks)
+    instrMap = substitution(instruments)
+    waveMap = substitution(waves)
+    trackKey = bytes(trackMap) + bytes(instrMap)
+    waveKey = bytes(waveMap)
+    scoTable = [None]
+    for i in scores:
+        score = source.scores[i]
+        scoTable.append(cache.block(digest(SCO[0], score.name, score.body, trackKey),
+                                    export_score, score, trackMap, instrMap))
+    trkTable = [None] * (1 + len(tracks))
+    for t in tracks:
+        track = source.tracks[t]
+        trkTable[trackMap[t]] = cache.block(digest(TRK[0], track.name, track.data, trackKey),
+                                            export_track, track, trackMap, instrMap)
+    insTable = [None] * (1 + len(instruments))
+    for i in instruments:
+        instrument = source.instruments[i]
+        insTable[instrMap[i]] = cache.block(digest(INS[0], instrument.name, instrument.body, waveKey),
+                                            export_instrument, instrument, waveMap)
+    wavTable = [None] * (1 + len(waves))
+    for w in waves:
+        wave = source.waves[w]
+        header = struct.pack(">HHBBB", wave.cycleSize, wave.dummy, wave.octave, wave.fragFactor, wave.isDoubleBufd)
+        wavTable[waveMap[w]] = cache.block(digest(WAV2[0], wave.name, header, wave.data), export_wave, wave)
+    return writeMsob(f_out, (scoTable, trkTable, insTable, wavTable), names, partial)
+
+
+def _waveSize(mso: MsobReader, pointer: int) -> int:
+    return 8 + struct.unpack_from(">H", mso.buf, mso.data(pointer))[0]
+
+def toPvms(mso: MsobReader, f_out, cache: Sidecar) -> int:
+    """Write an object as a PVMS project, like mso2pvms.createPVMS()
+    does, encoding only the entries not in cache.  Returns the size of
+    the project."""
+    out = PvmsWriter(f_out)
+    for chunk, table, encode, size in ((WAV2, mso.waves, wavBlock, _waveSize),
+                                       (INS, mso.instruments, insBlock, lambda mso, p: 0x6a),
+                                       (TRK, mso.tracks, trkBlock, MsobReader.trackLength),
+                                       (SCO, mso.scores, scoBlock, lambda mso, p: 0x22)):
+        out.chunk(chunk)
+        for i, p in table.defined():
+            entry = mso.buf[p:mso.data(p) + size(mso, p)]
+            key = digest(chunk[0], entry) if mso.names else digest(chunk[0], bytes((i,)), entry)
+            name, data = cache.block(key, encode, mso, i, p)
+            out.block(i, name, data)
+        out.endChunk()
+    out.close()
+    return out.written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a Medley Sound project to an object or back, encoding only the entries changed since the last run.")
+    parser.add_argument("filename", help="PVMS project or file containing an object")
+    parser.add_argument("-o", "--output", help="output file name (default: filename appended with '.mso' or '.pvms')")
+    parser.add_argument("-c", "--cache", help="cache file (default: output file name appended with '.cache')")
+    parser.add_argument("-s", "--scores", default="", help="scores to export from a project as hex numbers separated by commas (default: all)")
+    parser.add_argument("-n", "--strip-names", action="store_true", help="leave names out of the object")
+    parser.add_argument("-f", "--full-tables", action="store_true", help="write full 255-entry tables instead of partial ones")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        in_bytes = loadFile(args.filename)
+    except OSError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    toObject = in_bytes[0:4] == PVMS_MAGIC
+    output = args.output or args.filename + (".mso" if toObject else ".pvms")
+    try:
+        if toObject:
+            source = PVMS(in_bytes)
+            scores = parseScores(source, args.scores)
+            if not scores:
+                raise ValueError("project has no scores to export.")
+        else:
+            msoMagic = huntMagic(in_bytes)
+            if msoMagic < 0:
+                raise ValueError("Magic bytes not found!")
+            mso = MsobReader(in_bytes, msoMagic)
+        cache = Sidecar(args.cache or output + ".cache")
+        try:
+            with atomicOpen(output) as f_out:
+                if toObject:
+                    size = toMsob(source, scores, f_out, cache, not args.strip_names, not args.full_tables)
+                else:
+                    size = toPvms(mso, f_out, cache)
+            cache.save()
+        finally:
+            cache.close()
+    except (ValueError, IndexError, struct.error, sqlite3.Error) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Wrote {size:d} bytes to {output}: {cache.hits:d} entries reused, {cache.misses:d} encoded "
+          f"in {(time.perf_counter() - start) * 1e3:.1f} ms.")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
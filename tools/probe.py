@@ -0,0 +1,136 @@
+#!/bin/python
+
+# Instrumentation of the converters: time, bytes, entries and
+# allocations per chunk or table.
+#
+# Code to be measured is wrapped in sections:
+#
+#   with probe.section("TRK:") as s:
+#       s.entries += 1
+#       s.bytesIn += size
+#
+# A Probe adds the sections up by name for a summary and can write
+# every section as an NDJSON trace line as it ends.  Allocations are the
+# change of sys.getallocatedblocks(), the number of memory blocks the
+# interpreter holds, so a positive count is memory kept after the
+# section.  The functions taking a probe default to NULL, which measures
+# nothing and costs next to nothing.
+
+import json
+import sys
+import time
+
+
+class Stats:
+    """The totals of the sections of one name."""
+
+    __slots__ = ("name", "calls", "seconds", "bytesIn", "bytesOut", "entries", "blocks")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.entries = 0
+        self.blocks = 0
+
+    def asDict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Section:
+    """One measured run of code.  The code adds to bytesIn, bytesOut
+    and entries."""
+
+    __slots__ = ("probe", "name", "bytesIn", "bytesOut", "entries", "_start", "_blocks")
+
+    def __init__(self, probe, name: str):
+        self.probe = probe
+        self.name = name
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.entries = 0
+
+    def __enter__(self):
+        self._blocks = sys.getallocatedblocks()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        self.probe._record(self, seconds, sys.getallocatedblocks() - self._blocks)
+        return False
+
+
+class _NullSection:
+    __slots__ = ("bytesIn", "bytesOut", "entries")
+
+    def __init__(self):
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.entries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProbe:
+    """A probe measuring nothing."""
+
+    enabled = False
+
+    def section(self, name: str) -> _NullSection:
+        return _NullSection()
+
+
+NULL = NullProbe()
+
+
+class Probe:
+    """Collect sections by name in the order they're first seen.  If
+    trace is given, every section is written to it as a JSON line when
+    it ends."""
+
+    enabled = True
+
+    def __init__(self, trace=None):
+        self.stats = {}
+        self.trace = trace
+        self._origin = time.perf_counter()
+
+    def section(self, name: str) -> Section:
+        return Section(self, name)
+
+    def _record(self, section: Section, seconds: float, blocks: int):
+        stats = self.stats.get(section.name)
+        if stats is None:
+            stats = self.stats[section.name] = Stats(section.name)
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.bytesIn += section.bytesIn
+        stats.bytesOut += section.bytesOut
+        stats.entries += section.entries
+        stats.blocks += blocks
+        if self.trace is not None:
+            end = time.perf_counter() - self._origin
+            self.trace.write(json.dumps({"name": section.name, "start": end - seconds, "seconds": seconds,
+                                         "bytesIn": section.bytesIn, "bytesOut": section.bytesOut,
+                                         "entries": section.entries, "blocks": blocks}) + "\n")
+
+    def summary(self) -> str:
+        """Return a table of the totals with each section's share of
+        the time."""
+        total = sum(stats.seconds for stats in self.stats.values()) or 1.0
+        rows = [f"{'section':<12} {'calls':>6} {'ms':>10} {'share':>6} {'bytes in':>10} {'bytes out':>10} "
+                f"{'entries':>8} {'blocks':>8}"]
+        for stats in self.stats.values():
+            rows.append(f"{stats.name:<12} {stats.calls:6d} {stats.seconds * 1e3:10.3f} "
+                        f"{100 * stats.seconds / total:5.1f}% {stats.bytesIn:10d} {stats.bytesOut:10d} "
+                        f"{stats.entries:8d} {stats.blocks:+8d}")
+        return "\n".join(rows)
+
+# EOF
@@ -0,0 +1,411 @@
+#!/bin/python
+
+# Medley Sound project (PVMS) files: an in-memory model and a
+# streaming writer.
+#
+# The model keeps one slotted record per wave, instrument, track and
+# score, and the payloads are views into the source buffer.  Chunks
+# and blocks are written straight to any object with a write() method,
+# eg. a file or a ByteSink, so the output is never built by
+# concatenating immutable bytes.  See "File formats / PVMS" in
+# medley_sound_internals.org for the layout.
+
+import struct
+
+from msob import MsobReader, huntMagic
+from msoi import MAGIC as IMAGE_MAGIC, ImageReader
+from probe import NULL
+from track import countLines, findEnd
+
+MAGIC = b"PVMS"
+END = b"END."
+
+# chunk ID and header size of each chunk type, in the order msed saves them
+WAV2 = (b"WAV2", 0x1c)
+INS = (b"INS:", 0x7a)
+TRK = (b"TRK:", 0x20)
+SCO = (b"SCO:", 0x32)
+
+_word = struct.Struct(">H")
+_index = struct.Struct(">h")
+
+
+class ByteSink:
+    """A write() target that fills a bytearray in place.
+
+    Give size to preallocate the buffer when the output size is known.
+    The buffer grows in place if more is written."""
+
+    def __init__(self, size: int = 0):
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def write(self, data) -> int:
+        end = self.pos + len(data)
+        self.buf[self.pos:end] = data
+        self.pos = end
+        return len(data)
+
+    def getbuffer(self) -> memoryview:
+        """Return a view of the data written so far."""
+        return memoryview(self.buf)[:self.pos]
+
+
+class PvmsWriter:
+    """Write a PVMS file chunk by chunk and block by block.
+
+    Block payloads are passed as any number of buffers, eg. memoryview
+    slices of the source, and are written out without joining them."""
+
+    def __init__(self, out):
+        self.out = out
+        self.written = 0
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self.out.write(data)
+        self.written += len(data)
+
+    def chunk(self, chunk: tuple):
+        """Start a chunk, eg. chunk(WAV2)."""
+        self._write(chunk[0])
+        self._write(_word.pack(chunk[1]))
+
+    def block(self, index: int, *parts):
+        """Write a data block with an index counter from 0x0001 to 0x00ff."""
+        self._write(_word.pack(index))
+        for part in parts:
+            self._write(part)
+
+    def endChunk(self):
+        self._write(b"\xff\xff")
+
+    def close(self):
+        """Write the file end marker.  The output object isn't closed."""
+        self._write(END)
+
+
+def decodeName(name) -> str:
+    """Return a name field as a string without the NUL padding."""
+    return bytes(name).split(b"\x00", 1)[0].decode(encoding="latin_1")
+
+
+def _signed(byte: int) -> int:
+    return byte - 0x100 if byte & 0x80 else byte
+
+
+class Wave:
+    """A wave or sample.  data is a view of the wave data."""
+
+    __slots__ = ("name", "cycleSize", "dummy", "octave", "fragFactor", "isDoubleBufd", "data")
+
+    def __init__(self, name: bytes, cycleSize: int, dummy: int, octave: int, fragFactor: int, isDoubleBufd: int, data):
+        self.name = name
+        self.cycleSize = cycleSize
+        self.dummy = dummy
+        self.octave = octave
+        self.fragFactor = fragFactor
+        self.isDoubleBufd = isDoubleBufd
+        self.data = data
+
+
+class Instrument:
+    """An instrument.  body is a view of the 0x6a bytes of the
+    instrument structure following ins_Name."""
+
+    __slots__ = ("name", "body")
+
+    SIZE = 0x7a
+
+    def __init__(self, name: bytes, body):
+        self.name = name
+        self.body = body
+
+    # Offsets below are ins_* offsets minus the 0x10 bytes of ins_Name.
+    @property
+    def soundMode(self) -> int:
+        return self.body[0x0]
+
+    @property
+    def bShift(self) -> int:
+        return self.body[0x1]
+
+    @property
+    def dShift(self) -> int:
+        return self.body[0x2]
+
+    @property
+    def transpose(self) -> int:
+        return _signed(self.body[0x3])
+
+    @property
+    def waveRefs(self) -> bytes:
+        return bytes(self.body[0x4:0xc])
+
+    @property
+    def dynFreq(self) -> int:
+        return self.body[0xc]
+
+    @property
+    def envATime(self) -> int:
+        return self.body[0x15]
+
+    @property
+    def envDTime(self) -> int:
+        return self.body[0x16]
+
+    @property
+    def envRTime(self) -> int:
+        return self.body[0x17]
+
+    @property
+    def envTLevel(self) -> int:
+        return _word.unpack_from(self.body, 0x18)[0]
+
+    @property
+    def envSLevel(self) -> int:
+        return _word.unpack_from(self.body, 0x1a)[0]
+
+
+class Track:
+    """A track.  data is a view of the track data including the end
+    marker."""
+
+    __slots__ = ("name", "defInstr", "data")
+
+    def __init__(self, name: bytes, defInstr: int, data):
+        self.name = name
+        self.defInstr = defInstr
+        self.data = data
+
+    @property
+    def lines(self) -> int:
+        return countLines(self.data)
+
+
+class Score:
+    """A score.  body is a view of the 0x22 bytes of the score
+    structure following sco_Name."""
+
+    __slots__ = ("name", "body")
+
+    SIZE = 0x32
+
+    def __init__(self, name: bytes, body):
+        self.name = name
+        self.body = body
+
+    # Offsets below are sco_* offsets minus the 0x10 bytes of sco_Name.
+    @property
+    def tracks(self) -> bytes:
+        return bytes(self.body[0x0:0x4])
+
+    @property
+    def tracks2(self) -> bytes:
+        return bytes(self.body[0x4:0x8])
+
+    @property
+    def tempo(self) -> int:
+        return _word.unpack_from(self.body, 0x8)[0]
+
+    @property
+    def instrs(self) -> bytes:
+        return bytes(self.body[0xa:0xe])
+
+    @property
+    def defInstr(self) -> int:
+        return self.body[0xe]
+
+    @property
+    def transpose(self) -> int:
+        return _signed(self.body[0xf])
+
+    @property
+    def updReduction(self) -> int:
+        return self.body[0x10]
+
+    @property
+    def repeat(self) -> bool:
+        return self.body[0x11] != 0
+
+    @property
+    def volume(self) -> int:
+        return self.body[0x14]
+
+    @property
+    def volumes(self) -> bytes:
+        return bytes(self.body[0x1e:0x22])
+
+
+class PVMS:
+    """A Medley Sound project loaded from a PVMS file.
+
+    Each of waves, instruments, tracks and scores is a list of 256
+    entries where None is an undefined entry.  Index 0 is "undefined"
+    in Medley Sound, so it's always None.  Errors in the source raise
+    ValueError, and problems the project still loads with are listed
+    in warnings."""
+
+    def __init__(self, source_bytes=None, probe=NULL):
+        """Initialise the project from source file bytes, or leave it
+        empty if no source is given.  Each chunk is measured as a
+        section of probe."""
+        self.waves = [None] * 256
+        self.instruments = [None] * 256
+        self.tracks = [None] * 256
+        self.scores = [None] * 256
+        self.warnings = []
+        if source_bytes is None:
+            return
+        source = memoryview(source_bytes)
+        if source[0:4] != MAGIC:
+            raise ValueError("file type unknown.")
+        try:
+            self._load(source, probe)
+        except struct.error:
+            raise ValueError("This PVMS source file is truncated.") from None
+
+    def _load(self, source, probe):
+        pointer = 8
+        while pointer <= len(source):
+            chunk = bytes(source[pointer - 4:pointer])
+            if chunk == END: # The pointer should run past the EOF
+                             # after the last chunk, but this is here
+                             # just in case someone adds extra data
+                             # after the end marker!
+                return
+            for kind, label, entries in ((WAV2, "wave", self.waves), (INS, "instrument", self.instruments),
+                                         (TRK, "track", self.tracks), (SCO, "score", self.scores)):
+                if chunk == kind[0]:
+                    break
+            else:
+                raise ValueError("This PVMS source file is broken.")
+            header_size = _word.unpack_from(source, pointer)[0]
+            if header_size != kind[1]:
+                raise ValueError(f"Specified {label} header size ({header_size:02x}) is incorrect.")
+            pointer += 4
+            with probe.section(kind[0].decode()) as section:
+                start = pointer
+                while True:
+                    index = _index.unpack_from(source, pointer - 2)[0]
+                    if index < 0: # if sign bit is set, end of chunk reached.
+                        pointer += 4
+                        section.bytesIn = pointer - start
+                        break
+                    section.entries += 1
+                    if index < 1 or index > 255:
+                        raise ValueError(f"{label.capitalize()} index ({index:04x}) out of bounds.")
+                    name = source[pointer:pointer + 16].tobytes()
+                    if kind is WAV2:
+                        cycleSize, dummy, isDoubleBufd, fragFactor, octave = struct.unpack_from(">HHBBB", source, pointer + 0x14)
+                        pointer += 0x1c
+                        if pointer + cycleSize > len(source):
+                            raise ValueError(f"wave {index:02x} is truncated.")
+                        entries[index] = Wave(name, cycleSize, dummy, octave, fragFactor, isDoubleBufd,
+                                              source[pointer:pointer + cycleSize])
+                        pointer += cycleSize + 2
+                    elif kind is INS:
+                        # The instrument structure is the same in an MSOB.
+                        entries[index] = Instrument(name, source[pointer + 0x10:pointer + 0x7a])
+                        pointer += 0x7a + 2
+                    elif kind is TRK:
+                        track_length = _word.unpack_from(source, pointer + 0x14)[0]
+                        defInstr = source[pointer + 0x18]
+                        pointer += 0x20
+                        track_end = findEnd(source, pointer)
+                        if track_end < 0:
+                            raise ValueError(f"track {index:02x} has no end marker.")
+                        if track_end - pointer != track_length:
+                            self.warnings.append(f"track {index:02x} – actual track length {track_end - pointer:d} and header data {track_length:d} mismatch.")
+                        entries[index] = Track(name, defInstr, source[pointer:track_end])
+                        pointer = track_end + 2
+                    else:
+                        # The score structure is the same in an MSOB.
+                        entries[index] = Score(name, source[pointer + 0x10:pointer + 0x32])
+                        pointer += 0x32 + 2
+
+    @classmethod
+    def fromMsob(cls, mso):
+        """Build a project from an MsobReader.  Payloads are views into
+        the object, and stripped names are left blank."""
+        project = cls()
+        for i, p in mso.waves.defined():
+            cycleSize, dummy, octave, fragFactor, isDoubleBufd, data = mso.wave(p)
+            project.waves[i] = Wave(mso.name(p) or bytes(16), cycleSize, dummy, octave, fragFactor, isDoubleBufd, data)
+        for i, p in mso.instruments.defined():
+            data = mso.data(p)
+            project.instruments[i] = Instrument(mso.name(p) or bytes(16), mso.buf[data:data + 0x6a])
+        for i, p in mso.tracks.defined():
+            data = mso.data(p)
+            project.tracks[i] = Track(mso.name(p) or bytes(16), 0, mso.buf[data:data + mso.trackLength(p)])
+        for i, p in mso.scores.defined():
+            data = mso.data(p)
+            project.scores[i] = Score(mso.name(p) or bytes(16), mso.buf[data:data + 0x22])
+        return project
+
+    @classmethod
+    def fromImage(cls, image):
+        """Build a project from an ImageReader like fromMsob() does.  The
+        extents come from the image's index without scanning."""
+        project = cls()
+        buf = image.buf
+        for i, data in image.defined(image.waves):
+            cycleSize, dummy, octave, fragFactor, isDoubleBufd = struct.unpack_from(">HHBBB", buf, data)
+            project.waves[i] = Wave(image.name(data) or bytes(16), cycleSize, dummy, octave, fragFactor, isDoubleBufd,
+                                    buf[image.waveStarts[i]:image.waveEnds[i]])
+        for i, data in image.defined(image.instruments):
+            project.instruments[i] = Instrument(image.name(data) or bytes(16), buf[data:data + 0x6a])
+        for i, data in image.defined(image.tracks):
+            project.tracks[i] = Track(image.name(data) or bytes(16), 0, buf[data:image.trackEnds[i]])
+        for i, data in image.defined(image.scores):
+            project.scores[i] = Score(image.name(data) or bytes(16), buf[data:data + 0x22])
+        return project
+
+    @staticmethod
+    def count(entries: list) -> int:
+        """Return the number of defined entries in one of the tables."""
+        return 256 - entries.count(None)
+
+    def save(self, f_out) -> int:
+        """Write the project as a PVMS file and return the byte count."""
+        out = PvmsWriter(f_out)
+        out.chunk(WAV2)
+        for i, wave in enumerate(self.waves):
+            if wave is not None:
+                out.block(i, wave.name, struct.pack(">4xHHBBBx", wave.cycleSize, wave.dummy, wave.isDoubleBufd,
+                                                    wave.fragFactor, wave.octave), wave.data)
+        out.endChunk()
+        out.chunk(INS)
+        for i, instrument in enumerate(self.instruments):
+            if instrument is not None:
+                out.block(i, instrument.name, instrument.body)
+        out.endChunk()
+        out.chunk(TRK)
+        for i, track in enumerate(self.tracks):
+            if track is not None:
+                size = len(track.data)
+                out.block(i, track.name, struct.pack(">4xHHBx4xH", size, size, track.defInstr, 0xffff), track.data)
+        out.endChunk()
+        out.chunk(SCO)
+        for i, score in enumerate(self.scores):
+            if score is not None:
+                out.block(i, score.name, score.body)
+        out.endChunk()
+        out.close()
+        return out.written
+
+
+def loadProject(in_buf):
+    """Return a PVMS model of a PVMS file, a prelinked image or the
+    first MSOB found in a buffer.  Raises ValueError if none is
+    found."""
+    if in_buf[0:4] == MAGIC:
+        return PVMS(in_buf)
+    if in_buf[0:4] == IMAGE_MAGIC:
+        return PVMS.fromImage(ImageReader(in_buf))
+    base = huntMagic(in_buf)
+    if base < 0:
+        raise ValueError("file type unknown.")
+    return PVMS.fromMsob(MsobReader(in_buf, base))
+
+# EOF
@@ -1,177 +1,199 @@
 #!/bin/python
 
 import argparse
+import sqlite3
 import struct
 import sys
 
-class PVMS:
-    """A class to load a PVMS project file into."""
-
-    # Index 0 is "undefined" in Medley Sound, so we'll use it for
-    # something later.  For now it's just a constant 0.
-    instruments = [0] + [[]] * 255
-    scores = [0] + [[]] * 255
-    tracks = [0] + [[]] * 255
-    waves = [0] + [[]] * 255
-
-    def __init__(self, source_bytes):
-        """Initialise class data from source file bytes."""
-        pointer = 8
-        while pointer < len(source_bytes):
-            match source_bytes[pointer - 4:pointer]:
-                case b"WAV2":
-                    header_size = struct.unpack(">h", source_bytes[pointer:pointer + 2])[0]
-                    if header_size != 0x1c:
-                        print(f"Error: Specified wave header size ({header_size:02x}) is incorrect.")
-                        sys.exit(-1)
-                    pointer += 4
-                    while True:
-                        wave_index = struct.unpack(">h", source_bytes[pointer - 2:pointer])[0]
-                        if wave_index < 0: # if sign bit is set, end of chunk reached.
-                            pointer += 4
-                            break
-                        if wave_index < 1 or wave_index > 255:
-                            print(f"Error: Wave index ({wave_index:04x}) out of bounds.")
-                            sys.exit(-1)
-                        self.waves[0] += 1
-                        wave = [source_bytes[pointer:pointer + 16].decode(encoding="latin_1")] # 0 = ww_Name (str)
-                        wave += [struct.unpack(">H", source_bytes[pointer + 20:pointer + 22])[0]] # 1 = ww_CycleSize (int)
-                        wave += [source_bytes[pointer + 26]]                                   # 2 = ww_Octave
-                        wave += [source_bytes[pointer + 25]]                                   # 3 = ww_FragFactor
-                        wave += [source_bytes[pointer + 24]]                                   # 4 = ww_IsDoubleBufd
-                        pointer += 0x1c
-                        wave += [source_bytes[pointer:pointer + wave[1]]]                      # 5 = wave data
-                        pointer += wave[1] + 2
-                        self.waves[wave_index] = wave
-                        
-                case b"INS:":
-                    header_size = struct.unpack(">h", source_bytes[pointer:pointer + 2])[0]
-                    if header_size != 0x7a:
-                        print(f"Error: Specified instrument header size ({header_size:02x}) is incorrect.")
-                        sys.exit(-1)
-                    pointer += 4
-                    while True:
-                        inst_index = struct.unpack(">h", source_bytes[pointer - 2:pointer])[0]
-                        if inst_index < 0: # if sign bit is set, end of chunk reached.
-                            pointer += 4
-                            break
-                        if inst_index < 1 or inst_index > 255:
-                            print(f"Error: Track index ({inst_index:04x}) out of bounds.")
-                            sys.exit(-1)
-                        self.instruments[0] += 1
-                        # Let's copy the instrument structure raw as
-                        # it's the same in an MSOB.
-                        self.instruments[inst_index] = source_bytes[pointer:pointer + 0x7a]
-                        pointer += 0x7a + 2
-
-                case b"TRK:":
-                    header_size = struct.unpack(">h", source_bytes[pointer:pointer + 2])[0]
-                    if header_size != 0x20:
-                        print(f"Error: Specified track header size ({header_size:02x}) is incorrect.")
-                        sys.exit(-1)
-                    pointer += 4
-                    while True:
-                        track_index = struct.unpack(">h", source_bytes[pointer - 2:pointer])[0]
-                        if track_index < 0: # if sign bit is set, end of chunk reached.
-                            pointer += 4
-                            break
-                        if track_index < 1 or track_index > 255:
-                            print(f"Error: Track index ({track_index:04x}) out of bounds.")
-                            sys.exit(-1)
-                        self.tracks[0] += 1
-                        track = [source_bytes[pointer:pointer + 16].decode(encoding="latin_1")]
-                        track_length = struct.unpack(">H", source_bytes[pointer + 20:pointer + 22])[0]
-                        pointer += 0x22
-                        track_data = b""
-                        track_line = b""
-                        i = 0
-                        while track_line != b"\x80\x00":
-                            track_line = source_bytes[pointer - 2:pointer]
-                            pointer += 2
-                            i += 2
-                            # The logic below should be expanded to
-                            # everything else skipped by the player
-                            # routine to reduce redundant track data.
-                            if track_line != b"\x00\x00":    # skip zero length rests
-                                if track_line[0] != b"\x81": # skip TSIGN lines
-                                    track_data += track_line
-                        if i is not track_length:
-                            print(f"Warning: track {track_index:02x} – actual track length {i:d} and header data {track_length:d} mismatch.")
-                        track += [track_data]
-                        self.tracks[track_index] = track
-                        
-                case b"SCO:":
-                    header_size = struct.unpack(">h", source_bytes[pointer:pointer + 2])[0]
-                    if header_size != 0x32:
-                        print(f"Error: Specified score header size ({header_size:02x}) is incorrect.")
-                        sys.exit(-1)
-                    pointer += 4
-                    while True:
-                        score_index = struct.unpack(">h", source_bytes[pointer - 2:pointer])[0]
-                        if score_index < 0: # if sign bit is set, end of chunk reached.
-                            pointer += 4
-                            break
-                        if score_index < 1 or score_index > 255:
-                            print(f"Error: Score index ({score_index:04x}) out of bounds.")
-                            sys.exit(-1)
-                        self.scores[0] += 1
-                        # Let's copy the score structure raw as it's
-                        # the same in an MSOB.
-                        self.scores[score_index] = source_bytes[pointer:pointer + 0x7a]
-                        pointer += 0x32 + 2
-
-                case b"END.": # This shouldn't be needed as the
-                              # pointer will run past the EOF but it's
-                              # here just in case someone adds extra
-                              # data after the end marker!
-                    return
-                case _:
-                    print("Error: This PVMS source file is broken.")
-                    sys.exit(-1)
-
-    def export_instrument(instrument) -> bytes:
-        """Export a single instrument for a Medley Sound Object."""
-        pass
-
-    def export_score(score) -> bytes:
-        """Export a single score for a Medley Sound Object."""
-        pass
-
-    def export_track(track) -> bytes:
-        """Export a single track for a Medley Sound Object."""
-        pass
-
-    def export_wave(wave) -> bytes:
-        """Export a single wave for a Medley Sound Object."""
-        pass
+from msob import writeMsob
+from msocheck import ERROR, INFO, Validator
+from probe import NULL, Probe
+from pvms import PVMS, decodeName
+from track import compact, references, renumber
+
+def export_instrument(instrument, waveMap) -> tuple:
+    """Export a single instrument for a Medley Sound Object."""
+    body = bytearray(instrument.body)
+    body[0x4:0xc] = bytes(waveMap[w] for w in body[0x4:0xc]) # ins_WaveRefs
+    return (instrument.name, body)
+
+def export_score(score, trackMap, instrMap) -> tuple:
+    """Export a single score for a Medley Sound Object."""
+    body = bytearray(score.body)
+    body[0x0:0x8] = bytes(trackMap[t] for t in body[0x0:0x8]) # sco_Tracks, sco_Tracks2
+    body[0xa:0xf] = bytes(instrMap[i] for i in body[0xa:0xf]) # sco_Instrs, sco_DefInstr
+    return (score.name, body)
+
+def export_track(track, trackMap, instrMap) -> tuple:
+    """Export a single track for a Medley Sound Object."""
+    return (track.name, renumber(compact(track.data), trackMap, instrMap))
+
+def export_wave(wave) -> tuple:
+    """Export a single wave for a Medley Sound Object."""
+    return (wave.name, struct.pack(">HHBBBx", wave.cycleSize, wave.dummy, wave.octave, wave.fragFactor, wave.isDoubleBufd), wave.data)
 
 
 def askScores(source) -> tuple:
-    pass
+    """List the scores of a project and ask which ones to export."""
+    print("Scores in project:")
+    for i, score in enumerate(source.scores):
+        if score is not None:
+            print(f" - {i:02x} : {decodeName(score.name)}")
+    while True:
+        answer = input("Scores to export (hex numbers separated by spaces, empty for all): ")
+        try:
+            return parseScores(source, answer)
+        except ValueError as e:
+            print(f"Error: {e}")
+
+
+def parseScores(source, text: str) -> tuple:
+    """Parse a list of hex score numbers.  An empty list selects all scores."""
+    numbers = [int(n, 16) for n in text.replace(",", " ").split()]
+    if not numbers:
+        return tuple(i for i, score in enumerate(source.scores) if score is not None)
+    for n in numbers:
+        if n < 1 or n > 255 or source.scores[n] is None:
+            raise ValueError(f"score {n:02x} is undefined.")
+    return tuple(dict.fromkeys(numbers))
+
+
+def reachable(source, scores, references=references) -> tuple:
+    """Return the sets of tracks, instruments and waves reachable from
+    the given scores through TRACK, UDATA and INSTR lines and
+    instrument wave references.  references returns the track and
+    instrument numbers of track data, see track.references()."""
+    tracks = set()
+    instruments = set()
+    pending = []
+    for i in scores:
+        score = source.scores[i]
+        pending += score.tracks
+        instruments.update(score.instrs)
+        instruments.add(score.defInstr)
+    while pending:
+        t = pending.pop()
+        if t in tracks or source.tracks[t] is None:
+            continue
+        tracks.add(t)
+        calls, instrs = references(source.tracks[t].data)
+        pending += calls
+        instruments.update(instrs)
+    instruments = {i for i in instruments if source.instruments[i] is not None}
+    waves = {w for i in instruments for w in source.instruments[i].waveRefs if source.waves[w] is not None}
+    return tracks, instruments, waves
+
+
+def substitution(used) -> list:
+    """Return a 256-entry table that renumbers the used entries from 1
+    upwards in their original order.  Everything else maps to 0,
+    which the player treats as undefined."""
+    table = [0] * 256
+    for new, old in enumerate(sorted(used), 1):
+        table[old] = new
+    return table
+
+
+def export(source, scores, f_out, names: bool = True, partial: bool = True) -> int:
+    """Write the scores and the data they use as a Medley Sound Object.
+
+    Returns the size of the object."""
+    tracks, instruments, waves = reachable(source, scores)
+    trackMap = substitution(tracks)
+    instrMap = substitution(instruments)
+    waveMap = substitution(waves)
+    scoTable = [None] + [export_score(source.scores[i], trackMap, instrMap) for i in scores]
+    trkTable = [None] * (1 + len(tracks))
+    for t in tracks:
+        trkTable[trackMap[t]] = export_track(source.tracks[t], trackMap, instrMap)
+    insTable = [None] * (1 + len(instruments))
+    for i in instruments:
+        insTable[instrMap[i]] = export_instrument(source.instruments[i], waveMap)
+    wavTable = [None] * (1 + len(waves))
+    for w in waves:
+        wavTable[waveMap[w]] = export_wave(source.waves[w])
+    for new, old in enumerate(scores, 1):
+        print(f" -- Score {old:02x} -> {new:02x} : {decodeName(source.scores[old].name)}")
+    print(f"Kept {len(tracks)}/{PVMS.count(source.tracks)} tracks, "
+          f"{len(instruments)}/{PVMS.count(source.instruments)} instruments, "
+          f"{len(waves)}/{PVMS.count(source.waves)} waves.")
+    return writeMsob(f_out, (scoTable, trkTable, insTable, wavTable), names, partial)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Optimising converter to convert Medley Sound projects to Medley Sound objects.",
                                      epilog="See https://github.com/the1stArchyx/medley-sound-docs for the latest iteration.")
     parser.add_argument("filename", help="Medley Sound project (the PVMS format Medley Sound Editor writes) file to convert")
+    parser.add_argument("-s", "--scores", help="scores to export as hex numbers separated by commas, eg. 1,3 (default: ask)")
+    parser.add_argument("-n", "--strip-names", action="store_true", help="leave names out of the object")
+    parser.add_argument("-f", "--full-tables", action="store_true", help="write full 255-entry tables instead of partial ones")
+    parser.add_argument("-c", "--check", action="store_true", help="check the project with msocheck first and stop on errors")
+    parser.add_argument("-o", "--output", help="output file name (default: filename appended with '.mso')")
+    parser.add_argument("-p", "--profile", action="store_true", help="print the time, bytes, entries and allocations of each chunk read and of the export")
+    parser.add_argument("-t", "--trace", help="write the measurements to this file as NDJSON")
     args = parser.parse_args()
 
     with open(args.filename, "rb") as f_in:
         pvms_bytes = f_in.read()
 
+    trace = open(args.trace, "w") if args.trace else None
+    try:
+        convert(args, pvms_bytes, Probe(trace) if args.profile or trace else NULL)
+    finally:
+        if trace:
+            trace.close()
+
+
+def convert(args, pvms_bytes, probe):
+    """Run the conversion the command line asks for."""
     # check magic bytes
     if pvms_bytes[0:4] == b"PVMS":
         # 1. Read PVMS into an object and sanity check it.
-        pvms = PVMS(pvms_bytes)
+        try:
+            pvms = PVMS(pvms_bytes, probe)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(-1)
+        for warning in pvms.warnings:
+            print(f"Warning: {warning}")
+        if args.check:
+            validator = Validator.open()
+            diagnostics = [d for d in validator.validate(pvms) if d.severity != INFO]
+            try:
+                validator.save()
+            except sqlite3.Error:
+                pass # the summaries are only a cache
+            validator.close()
+            for diagnostic in diagnostics:
+                print(diagnostic)
+            if any(d.severity == ERROR for d in diagnostics):
+                print("Error: project failed the checks.")
+                sys.exit(-1)
         # 2. Start interactive mode to choose scores to export.
-        scores = askScores(pvms)
-        # 3. Create substitution tables to skip unused tracks, instruments, and waves.
+        if args.scores is None:
+            scores = askScores(pvms)
+        else:
+            try:
+                scores = parseScores(pvms, args.scores)
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(-1)
+        if not scores:
+            print("Error: project has no scores to export.")
+            sys.exit(-1)
+        # 3. Create substitution tables to skip unused tracks,
+        # instruments, and waves.
         # 4. Export data.
-        pass
+        with open(args.output or args.filename + ".mso", "wb") as f_out, probe.section("export") as section:
+            size = export(pvms, scores, f_out, not args.strip_names, not args.full_tables)
+            section.entries = len(scores)
+            section.bytesOut = size
+        print(f"Wrote {size:d} bytes.")
+        if args.profile:
+            print(probe.summary())
     else:
         print("\nError: file type unknown.\n")
 
-
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,210 @@
+#!/bin/python
+
+# Merge identical waves, instruments and tracks in Medley Sound
+# projects, and optionally store the unique payloads of many projects
+# in a shared content-addressed pool.
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import sys
+import uuid
+
+from pvms import PVMS, Instrument, Score, Track, Wave
+from track import compact, renumber
+
+
+def digest(*parts) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part)
+    return h.hexdigest()
+
+
+def waveKey(wave) -> str:
+    """Hash the wave data and the header fields affecting playback."""
+    return digest(struct.pack(">HBB", wave.cycleSize, wave.octave, wave.isDoubleBufd), wave.data)
+
+
+def instrumentKey(instrument) -> str:
+    """Hash the instrument structure without its name."""
+    return digest(instrument.body)
+
+
+def trackKey(track) -> str:
+    """Hash the track data with the lines the player skips removed."""
+    return digest(compact(track.data))
+
+
+def _merge(entries: list, key) -> list:
+    """Drop entries identical to an earlier one and return a 256-entry
+    map from every index to the index of the entry kept."""
+    table = list(range(256))
+    seen = {}
+    for i, entry in enumerate(entries):
+        if entry is None:
+            continue
+        k = key(entry)
+        if k in seen:
+            table[i] = seen[k]
+            entries[i] = None
+        else:
+            seen[k] = i
+    return table
+
+
+def dedupProject(source) -> tuple:
+    """Merge identical entries of a project in place.
+
+    References in instruments, tracks and scores are rewritten to the
+    entry kept, which is the one with the lowest index.  Returns the
+    number of waves, instruments and tracks dropped."""
+    counts = (PVMS.count(source.waves), PVMS.count(source.instruments), PVMS.count(source.tracks))
+    waveMap = _merge(source.waves, waveKey)
+    for i, instrument in enumerate(source.instruments):
+        if instrument is not None and any(waveMap[w] != w for w in instrument.waveRefs):
+            body = bytearray(instrument.body)
+            body[0x4:0xc] = bytes(waveMap[w] for w in body[0x4:0xc])
+            source.instruments[i] = Instrument(instrument.name, body)
+    instrMap = _merge(source.instruments, instrumentKey)
+    trackMap = list(range(256))
+    # Merging tracks can make the tracks calling them identical, so
+    # repeat until nothing changes.
+    while True:
+        for i, track in enumerate(source.tracks):
+            if track is not None:
+                source.tracks[i] = Track(track.name, instrMap[track.defInstr], renumber(track.data, trackMap, instrMap))
+        merged = _merge(source.tracks, trackKey)
+        if merged == list(range(256)):
+            break
+        trackMap = [merged[t] for t in trackMap]
+    for i, score in enumerate(source.scores):
+        if score is not None:
+            body = bytearray(score.body)
+            body[0x0:0x8] = bytes(trackMap[t] for t in body[0x0:0x8])
+            body[0xa:0xf] = bytes(instrMap[n] for n in body[0xa:0xf])
+            source.scores[i] = Score(score.name, body)
+    return (counts[0] - PVMS.count(source.waves), counts[1] - PVMS.count(source.instruments),
+            counts[2] - PVMS.count(source.tracks))
+
+
+class Pool:
+    """A content-addressed store of payloads in a directory.
+
+    Every payload is stored once as <directory>/<2 hex digits>/<hash>.
+    A project is described by a JSON manifest referring to the pool."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.added = 0
+        self.stored = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, payload) -> str:
+        key = digest(payload)
+        self.added += len(payload)
+        path = self._path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # a unique temporary name, as other runs may be storing the
+            # same payload into the pool at the same time
+            tmp = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp, "xb") as f_out:
+                    f_out.write(payload)
+                os.replace(tmp, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+                raise
+            self.stored += len(payload)
+        return key
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as f_in:
+            return f_in.read()
+
+    def addProject(self, source) -> dict:
+        """Store the payloads of a project and return its manifest."""
+        manifest = {"waves": {}, "instruments": {}, "tracks": {}, "scores": {}}
+        for i, wave in enumerate(source.waves):
+            if wave is not None:
+                manifest["waves"][i] = {"name": wave.name.hex(), "dummy": wave.dummy, "octave": wave.octave,
+                                        "fragFactor": wave.fragFactor, "isDoubleBufd": wave.isDoubleBufd,
+                                        "data": self.put(wave.data)}
+        for i, instrument in enumerate(source.instruments):
+            if instrument is not None:
+                manifest["instruments"][i] = {"name": instrument.name.hex(), "body": self.put(instrument.body)}
+        for i, track in enumerate(source.tracks):
+            if track is not None:
+                manifest["tracks"][i] = {"name": track.name.hex(), "defInstr": track.defInstr,
+                                         "data": self.put(track.data)}
+        for i, score in enumerate(source.scores):
+            if score is not None:
+                manifest["scores"][i] = {"name": score.name.hex(), "body": self.put(score.body)}
+        return manifest
+
+    def restore(self, manifest: dict):
+        """Rebuild a project from its manifest."""
+        project = PVMS()
+        for i, w in manifest["waves"].items():
+            data = self.get(w["data"])
+            project.waves[int(i)] = Wave(bytes.fromhex(w["name"]), len(data), w["dummy"], w["octave"],
+                                         w["fragFactor"], w["isDoubleBufd"], data)
+        for i, n in manifest["instruments"].items():
+            project.instruments[int(i)] = Instrument(bytes.fromhex(n["name"]), self.get(n["body"]))
+        for i, t in manifest["tracks"].items():
+            project.tracks[int(i)] = Track(bytes.fromhex(t["name"]), t["defInstr"], self.get(t["data"]))
+        for i, s in manifest["scores"].items():
+            project.scores[int(i)] = Score(bytes.fromhex(s["name"]), self.get(s["body"]))
+        return project
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge identical waves, instruments and tracks in Medley Sound projects.",
+                                     epilog="Each project is written to <filename>.dedup.pvms, or with --pool, to a pool and <filename>.manifest.json.")
+    parser.add_argument("filenames", nargs="*", help="PVMS project files")
+    parser.add_argument("-p", "--pool", help="directory of a shared content-addressed pool")
+    parser.add_argument("-r", "--restore", metavar="MANIFEST", help="rebuild <MANIFEST>.pvms from a manifest in --pool")
+    args = parser.parse_args()
+
+    pool = Pool(args.pool) if args.pool else None
+    if args.restore:
+        if pool is None:
+            print("Error: --restore needs --pool.")
+            sys.exit(1)
+        with open(args.restore) as f_in:
+            project = pool.restore(json.load(f_in))
+        with open(args.restore + ".pvms", "wb") as f_out:
+            project.save(f_out)
+        return
+
+    for filename in args.filenames:
+        with open(filename, "rb") as f_in:
+            try:
+                project = PVMS(f_in.read())
+            except ValueError as e:
+                print(f"{filename}: Error: {e}")
+                continue
+        waves, instruments, tracks = dedupProject(project)
+        print(f"{filename}: merged {waves:d} waves, {instruments:d} instruments, {tracks:d} tracks.")
+        if pool is None:
+            with open(filename + ".dedup.pvms", "wb") as f_out:
+                project.save(f_out)
+        else:
+            with open(filename + ".manifest.json", "w") as f_out:
+                json.dump(pool.addProject(project), f_out)
+    if pool is not None and pool.added:
+        print(f"Pool: {pool.added:d} bytes added, {pool.stored:d} bytes stored "
+              f"({100 - 100 * pool.stored // pool.added:d}% shared).")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
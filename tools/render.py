@@ -0,0 +1,459 @@
+#!/bin/python
+
+# Render scores of Medley Sound objects and projects to WAV files.
+#
+# Each channel keeps the state of a Sound Channel Structure (see "Sound
+# Channel Structure" and "msplay internals / Player logic" in
+# medley_sound_internals.org) and is updated once per player tick.  The
+# period and the volume are constant within a tick, so the audio of a
+# tick is synthesized as one block with C-level slicing and
+# bytes.translate() instead of sample by sample:
+#
+# - the wave is stretched by a power of two D, so resampling at a
+#   period is an extended slice with an integer step,
+# - the signed 8-bit samples are scaled by the hardware volume with two
+#   translate tables giving the low and high bytes of a 16-bit sample,
+# - channels are mixed by adding their samples as lanes of one big
+#   integer: each sample is offset by $8000 and kept in a 32-bit lane,
+#   so the sums can't carry into the next lane and the low 16 bits of
+#   a lane are the two's complement sum.
+#
+# Channels are independent until the final mix, so they can be
+# rendered in parallel processes.  Paula's channels 1 and 4 play on the
+# left and 2 and 3 on the right.
+#
+# The period and slope tables of msplay haven't been extracted yet.
+# Pitch follows equal temperament with A-4 ($2f) at 440 Hz, taking a
+# wave of octave n to hold one cycle in 0x100 >> n bytes, which puts
+# octave 0 samples close to the usual Amiga note periods.  The <bsm>
+# and <dyn> waves are placeholder approximations, see dynwave.py.  The
+# flanger and the Fx settings aren't rendered.
+
+import argparse
+import contextlib
+import math
+import os
+import sys
+import time
+import wave as wavefile
+from concurrent.futures import ProcessPoolExecutor
+
+from dynwave import WaveCache, bsmWave, dynWave
+from flatten import Compiler
+from instrument import MG_AM, MG_BSHIFT, MG_DSHIFT, MG_DYNFREQ, MG_FM, MG_FMDOWN, MG_FMUP, Patch, PatchCache
+from msob import loadFile
+from pvms import decodeName, loadProject
+
+PAL_CLOCK = 3546895   # Paula audio clock, Hz
+CIA_CLOCK = 709379    # CIA timer clock; score tempo is the timer period
+MIN_PERIOD = 124      # shortest period audio DMA can keep up with
+NOMINAL_CYCLE = 0x100 # cycle length of an octave 0 wave, see above
+A4 = 0x2f
+
+SM_STD = 0
+SM_BSM = 1
+SM_DYN = 2
+
+# a stretched copy of a wave is kept below this size
+MAX_STRETCH = 1 << 22
+# the resampling step is at least this, ie. pitch is within 1/512 of a
+# step of the period
+MIN_STEP = 0x100
+
+
+def _scaleTables() -> tuple:
+    """Return the translate tables giving the low and high byte of
+    sample * volume * 2 + $8000 for each hardware volume 0..64."""
+    lo = []
+    hi = []
+    for volume in range(65):
+        values = [((b - 0x100 if b & 0x80 else b) * volume * 2 + 0x8000) & 0xffff for b in range(0x100)]
+        lo.append(bytes(v & 0xff for v in values))
+        hi.append(bytes(v >> 8 for v in values))
+    return lo, hi
+
+
+_LO, _HI = _scaleTables()
+_SILENCE = b"\x00\x80\x00\x00" # one lane at zero
+
+
+def notePeriod(note: int, octave: int) -> int:
+    """Return the Paula period playing note from a wave of octave."""
+    frequency = 440.0 * 2.0 ** ((note - A4) / 12)
+    period = round(PAL_CLOCK / (frequency * (NOMINAL_CYCLE >> min(max(octave, 0), 7))))
+    return min(max(period, MIN_PERIOD), 0xffff)
+
+
+class Bank:
+    """The instruments and waves a score plays, in a form that can be
+    sent to worker processes.  Parsed instruments, generated <bsm> and
+    <dyn> waves and stretched waves are cached here, so channels playing
+    the same project share them."""
+
+    def __init__(self, project):
+        self.patches = {i: bytes(ins.body) for i, ins in enumerate(project.instruments) if ins is not None}
+        self.waves = {i: (w.octave, bytes(w.data)) for i, w in enumerate(project.waves) if w is not None and len(w.data)}
+        self.generated = WaveCache()
+        self._patches = PatchCache()
+        self._stretched = {}
+
+    def patch(self, number: int) -> Patch:
+        body = self.patches.get(number)
+        return None if body is None else self._patches.get(number, body)
+
+    def stretch(self, data: bytes, factor: int) -> bytes:
+        """Return data with every byte repeated factor times."""
+        key = (data, factor)
+        stretched = self._stretched.get(key)
+        if stretched is None:
+            if len(self._stretched) > 0x40:
+                self._stretched.clear()
+            buf = bytearray(len(data) * factor)
+            for j in range(factor):
+                buf[j::factor] = data
+            stretched = self._stretched[key] = bytes(buf)
+        return stretched
+
+
+class Channel:
+    """The state of one channel, after the sch_* fields of the SCH."""
+
+    __slots__ = ("number", "bank", "isActive", "logNote", "gate", "trig", "instrument", "patch",
+                 "envLevel", "envStatus", "envPos", "period", "prePeriod", "amplitude", "bShift", "dShift", "dynFreq",
+                 "mgPars", "flagLR", "flagLH", "updRate", "volume", "volTable", "transpose",
+                 "mustFetchWave", "outWave", "outLoop", "pos")
+
+    def __init__(self, number: int, bank: Bank, masterVolume: int):
+        self.number = number
+        self.bank = bank
+        self.flagLR = number in (1, 2)
+        self.flagLH = number in (1, 3)
+        self.reset(masterVolume)
+
+    def reset(self, masterVolume: int):
+        """Silence the channel and clear its state."""
+        self.isActive = False
+        self.logNote = 0
+        self.gate = False
+        self.trig = False
+        self.instrument = 0
+        self.patch = None
+        self.envLevel = 0
+        self.envStatus = False
+        self.envPos = -1 # update count since the trigger, -1 when off the envelope curve
+        self.period = 0
+        self.prePeriod = 0
+        self.amplitude = 0
+        self.bShift = 0
+        self.dShift = 0
+        self.dynFreq = 0
+        self.mgPars = [[0, 0, 0] for n in range(4)] # update count since the trigger, mgPar_DelayTime, start level
+        self.updRate = 0
+        self.volume = -1
+        self.volTable = bytes(0x40)
+        self.transpose = 0
+        self.mustFetchWave = False
+        self.outWave = None
+        self.outLoop = True
+        self.pos = 0.0
+        self.setVolume(0, masterVolume)
+
+    def setVolume(self, volume: int, masterVolume: int):
+        """Set sch_Volume and rebuild sch_VolTable, which maps the six
+        most significant bits of the amplitude to a hardware volume."""
+        volume = min(volume, 0x3f)
+        if volume != self.volume:
+            self.volume = volume
+            self.volTable = bytes(i * volume * min(masterVolume, 0x3f) // (0x3f * 0x3f) for i in range(0x40))
+
+    def setInstrument(self, number: int):
+        if number != self.instrument or self.patch is None:
+            self.instrument = number
+            self.patch = self.bank.patch(number)
+            self.mustFetchWave = True
+
+    def noteOn(self, note: int, tied: bool):
+        if note == 0: # a rest releases the note
+            self.gate = False
+            return
+        self.isActive = True
+        self.gate = True
+        if note != self.logNote:
+            self.mustFetchWave = True
+        self.logNote = note
+        if not tied:
+            self.trig = True
+            self.mustFetchWave = True
+
+    def update(self, scoreTranspose: int, updReduction: int):
+        """Update the channel for one player tick, like UpdSCH()."""
+        self.updRate -= 1
+        if self.updRate > 0:
+            return
+        self.updRate = updReduction
+        patch = self.patch
+        if patch is None or not self.isActive:
+            self.amplitude = 0
+            self.trig = False
+            return
+        if self.mustFetchWave:
+            self.mustFetchWave = False
+            self._fetchWave(scoreTranspose)
+        self.period = self.prePeriod
+
+        # volume envelope, from the precomputed curve while it's followed
+        envelope = patch.envelope
+        if self.trig:
+            self.envPos = 0
+        if not self.gate:
+            if self.envPos >= 0:
+                self.envStatus = 0 <= envelope.peakAt < self.envPos
+                self.envPos = -1
+            self.envLevel = envelope.release(self.envLevel)
+        elif self.envPos >= 0:
+            self.envLevel = envelope.curve.value(self.envPos)
+            self.envPos += 1
+        else: # the gate opened again without a trigger
+            self.envLevel, self.envStatus = envelope.step((self.envLevel, self.envStatus))
+        amplitude = self.envLevel
+
+        # modulation generators
+        bShift = dShift = dynFreq = 0
+        for n, mg in patch.active:
+            par = self.mgPars[n]
+            if self.trig:
+                par[1] = mg.delayTime
+                if not mg.trigMode:
+                    par[0] = 0
+                    par[2] = mg.start(self.flagLR, self.flagLH)
+            if par[1] > 0:
+                par[1] -= 1
+            else:
+                par[0] += 1
+            value = mg.curve(par[2]).value(par[0])
+            dest = mg.destination
+            if dest == MG_AM:
+                amplitude -= value
+            elif dest == MG_BSHIFT:
+                bShift += value >> 8
+            elif dest == MG_DSHIFT:
+                dShift += value >> 8
+            elif dest == MG_DYNFREQ:
+                dynFreq += value >> 8
+            elif dest == MG_FMUP:
+                self.period += value >> 5
+            elif dest == MG_FMDOWN:
+                self.period -= value >> 5
+            elif dest == MG_FM:
+                fm = (mg.level >> 1) - value
+                self.period += fm >> 8 # arithmetic shift
+        self.amplitude = min(max(amplitude, 0), 0xffff)
+        self.period = min(max(self.period, MIN_PERIOD), 0xffff)
+        if patch.soundMode in (SM_BSM, SM_DYN) and (bShift, dShift, dynFreq) != (self.bShift, self.dShift, self.dynFreq):
+            self.bShift, self.dShift, self.dynFreq = bShift, dShift, dynFreq
+            self._fetchWave(scoreTranspose, retrigger=False)
+        self.trig = False
+
+    def _fetchWave(self, scoreTranspose: int, retrigger: bool = True):
+        """Pick or generate the wave for the current note, and set
+        sch_PrePeriod."""
+        patch = self.patch
+        note = min(max(self.logNote + scoreTranspose + self.transpose + patch.transpose, 1), 0x7f)
+        octave = min(max((note - 2) // 12, 0), 7)
+        mode = patch.soundMode
+        ref = patch.waveRefs[0] if mode == SM_DYN else patch.waveRefs[octave] or patch.waveRefs[0]
+        entry = self.bank.waves.get(ref)
+        if entry is None:
+            self.outWave = None
+            return
+        waveOctave, data = entry
+        if mode == SM_DYN:
+            lsr = max(octave - waveOctave, 0)
+            shift = (patch.dShift + self.dShift) & 0xff
+            freq = (patch.dynFreq + self.dynFreq) & 0xff
+            data = self.bank.generated.get((ref, lsr, shift, freq), dynWave, data, shift, freq, lsr)
+            waveOctave += lsr
+        elif mode == SM_BSM:
+            shift = (patch.bShift + self.bShift) % len(data)
+            data = self.bank.generated.get((ref, -1, shift, 0), bsmWave, data, shift)
+            waveOctave += 1
+        self.outWave = data
+        self.outLoop = mode in (SM_STD, SM_BSM, SM_DYN)
+        self.prePeriod = notePeriod(note, waveOctave)
+        if self.period == 0:
+            self.period = self.prePeriod
+        if retrigger and self.trig:
+            self.pos = 0.0
+
+    def block(self, n: int, rate: int) -> bytes:
+        """Return n output samples as mixing lanes, see above."""
+        data = self.outWave
+        volume = self.volTable[self.amplitude >> 10] if self.gate or self.amplitude else 0
+        if data is None or volume == 0 or n <= 0:
+            if data is not None and self.period:
+                self.pos += n * PAL_CLOCK / (self.period * rate)
+            return _SILENCE * max(n, 0)
+        ratio = PAL_CLOCK / (self.period * rate) # source samples per output sample
+        size = len(data)
+        factor = 1
+        while factor * ratio < MIN_STEP and size * factor * 2 <= MAX_STRETCH:
+            factor <<= 1
+        step = max(round(factor * ratio), 1)
+        stretched = self.bank.stretch(data, factor)
+        length = len(stretched)
+        if self.outLoop:
+            self.pos %= size
+        p = int(self.pos * factor)
+        end = p + (n - 1) * step + 1
+        if self.outLoop and end > length:
+            stretched = stretched * -(-end // length)
+        samples = stretched[p:end:step]
+        if len(samples) < n: # a single-shot sample ended
+            samples += bytes(n - len(samples))
+        self.pos = (p + n * step) / factor
+        out = bytearray(4 * n)
+        out[0::4] = samples.translate(_LO[volume])
+        out[1::4] = samples.translate(_HI[volume])
+        return out
+
+
+def mix(channels: list) -> bytes:
+    """Mix the lanes of the four channels to interleaved stereo
+    little-endian 16-bit PCM."""
+    lanes = [int.from_bytes(pcm, "little") for pcm in channels]
+    size = len(channels[0])
+    left = (lanes[0] + lanes[3]).to_bytes(size, "little")
+    right = (lanes[1] + lanes[2]).to_bytes(size, "little")
+    out = bytearray(size)
+    out[0::4] = left[0:size:4]
+    out[1::4] = left[1:size:4]
+    out[2::4] = right[0:size:4]
+    out[3::4] = right[1:size:4]
+    return bytes(out)
+
+
+def renderChannel(task: tuple) -> bytes:
+    """Render one channel to mixing lanes, see above.
+
+    task is (bank, stream, settings) where stream is the EventStream of
+    the channel and settings the dict made by renderScore()."""
+    bank, stream, settings = task
+    rate = settings["rate"]
+    tickRate = settings["tickRate"]
+    ticks = settings["ticks"]
+    channel = Channel(stream.channel, bank, settings["masterVolume"])
+    channel.setInstrument(settings["instrument"])
+    channel.setVolume(settings["volume"], settings["masterVolume"])
+    out = bytearray()
+    event = 0
+    events = len(stream)
+    sample = 0
+    for tick in range(ticks):
+        while event < events and stream.tick[event] == tick:
+            channel.setInstrument(stream.instrument[event])
+            channel.setVolume(stream.volume[event], settings["masterVolume"])
+            channel.transpose = stream.transpose[event]
+            channel.noteOn(stream.note[event], stream.tied[event])
+            event += 1
+        channel.update(settings["transpose"], settings["updReduction"])
+        nextSample = int((tick + 1) * rate / tickRate)
+        out += channel.block(nextSample - sample, rate)
+        sample = nextSample
+    return bytes(out)
+
+
+def renderScore(project, number: int, rate: int = 22050, seconds: float = None, tail: float = 1.0,
+                seed=None, executor=None, bank: Bank = None) -> bytes:
+    """Render a score to interleaved stereo little-endian 16-bit PCM.
+
+    Without seconds the score is rendered once, plus tail seconds to
+    let the notes release.  executor, eg. a ProcessPoolExecutor, runs
+    the channels in parallel.  Pass a bank to share its caches between
+    the scores of a project."""
+    score = project.scores[number] if 0 < number < 256 else None
+    if score is None:
+        raise ValueError(f"score {number:02x} is undefined.")
+    tickRate = CIA_CLOCK / max(score.tempo, 1)
+    maxTicks = None if seconds is None else math.ceil(seconds * tickRate)
+    streams = Compiler.forProject(project, seed).compileScore(score, maxTicks)
+    ticks = maxTicks if maxTicks is not None else max(s.length for s in streams) + math.ceil(tail * tickRate)
+    bank = bank or Bank(project)
+    settings = []
+    for stream in streams:
+        settings.append({"rate": rate, "tickRate": tickRate, "ticks": ticks, "transpose": score.transpose,
+                         "updReduction": score.updReduction, "masterVolume": score.volume,
+                         "instrument": score.instrs[stream.channel] or score.defInstr,
+                         "volume": score.volumes[stream.channel]})
+    tasks = [(bank, stream, s) for stream, s in zip(streams, settings)]
+    return mix(list((executor.map if executor else map)(renderChannel, tasks)))
+
+
+def writeWav(f_out, pcm: bytes, rate: int):
+    with wavefile.open(f_out, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm)
+
+
+def renderFiles(args, executor) -> bool:
+    """Render the scores the command line asks for.  Returns True if
+    any of them failed."""
+    failed = False
+    for filename in args.filenames:
+        try:
+            project = loadProject(loadFile(filename))
+        except (OSError, ValueError) as e:
+            print(f"{filename}: Error: {e}")
+            failed = True
+            continue
+        numbers = [args.score] if args.score is not None else [i for i, s in enumerate(project.scores) if s is not None]
+        bank = Bank(project)
+        for number in numbers:
+            start = time.perf_counter()
+            try:
+                pcm = renderScore(project, number, args.rate, args.seconds, seed=args.seed, executor=executor, bank=bank)
+            except ValueError as e:
+                print(f"{filename}: Error: {e}")
+                failed = True
+                continue
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            if args.output and len(numbers) > 1:
+                outName = f"{os.path.splitext(args.output)[0]}.{number:02x}.wav"
+            else:
+                outName = args.output or f"{os.path.splitext(filename)[0]}.{number:02x}.wav"
+            with open(outName, "wb") as f_out:
+                writeWav(f_out, pcm, args.rate)
+            length = len(pcm) / 4 / args.rate
+            print(f"{outName}: score {number:02x} ({decodeName(project.scores[number].name)}), "
+                  f"{length:.1f} s rendered in {elapsed:.2f} s ({length / elapsed:.0f}x real time).")
+        if executor is None and bank.generated.hits + bank.generated.misses:
+            print(f"{filename}: <bsm>/<dyn> {bank.generated.stats()}.")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render scores of Medley Sound objects and projects to WAV files.",
+                                     epilog="Each file is written to <filename>.<score>.wav unless -o is given.")
+    parser.add_argument("filenames", nargs="+", help="MSOB or PVMS files")
+    parser.add_argument("-s", "--score", type=lambda n: int(n, 16), default=None, help="score number in hex (default: every score)")
+    parser.add_argument("-o", "--output", help="output file name for a single file; with several scores, <stem>.<score>.wav")
+    parser.add_argument("-r", "--rate", type=int, default=22050, help="sample rate (default: 22050)")
+    parser.add_argument("-t", "--seconds", type=float, default=None, help="render this long, following repeats")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for UDATA")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="render channels in this many processes (default: 1)")
+    args = parser.parse_args()
+
+    if args.output and len(args.filenames) > 1:
+        parser.error("-o needs a single file")
+
+    with ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else contextlib.nullcontext() as executor:
+        failed = renderFiles(args, executor)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,285 @@
+#!/bin/python
+
+# Import WAV or raw recordings of any length as HUNK files for the
+# Medley Sound editor.
+#
+# Sources are read in chunks, so a long recording is never held in
+# memory.  Each chunk is mixed down to mono, resampled to the rate of
+# the target Paula period and converted to 8-bit signed with optional
+# normalisation and dither.  Samples longer than the 32 KiB limit are
+# truncated, split into several HUNK files, or trimmed at a zero
+# crossing so they loop cleanly.
+#
+# The per-sample work is done by C-level map() calls over whole chunks:
+# resampling looks up a fixed point index range, and gain, dither,
+# clipping and the 8-bit conversion are a single lookup table.
+
+import argparse
+import contextlib
+import itertools
+import os
+import random
+import re
+import sys
+import wave as wavefile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from add_sample_header import createHunk
+from batch import expand, outputNames
+from msob import atomicOpen
+from render import PAL_CLOCK, notePeriod
+
+HUNK_LIMIT = 0x8000 # longest sample the editor loads
+CHUNK_FRAMES = 0x10000
+FIXED = 16          # fraction bits of the resampling position
+
+# raw source formats and their bytes per sample
+RAW_FORMATS = {"s8": 1, "u8": 1, "s16le": 2, "s16be": 2}
+
+# a rising zero crossing of 8-bit signed data
+_risingZero = re.compile(b"[\x80-\xff][\x00-\x7f]")
+
+
+class Source:
+    """A sample source read in chunks.  chunks() yields arrays of mono
+    sample values, where a value of fullScale is the full level."""
+
+    def __init__(self, filename: str, rawFormat: str = "s8", rawRate: int = None, rawChannels: int = 1):
+        self.filename = filename
+        self.wav = filename.lower().endswith(".wav")
+        if self.wav:
+            try:
+                with wavefile.open(filename, "rb") as w:
+                    self.channels = w.getnchannels()
+                    self.width = w.getsampwidth()
+                    self.rate = w.getframerate()
+            except (wavefile.Error, EOFError) as e:
+                raise ValueError(f"not a PCM WAV file ({str(e) or 'truncated'}).")
+            if self.width not in (1, 2, 3, 4):
+                raise ValueError(f"unsupported sample width {self.width:d}.")
+            self.rawFormat = None
+        else:
+            if rawFormat not in RAW_FORMATS:
+                raise ValueError(f"unknown raw format {rawFormat}.")
+            self.rawFormat = rawFormat
+            self.width = RAW_FORMATS[rawFormat]
+            self.channels = rawChannels
+            self.rate = rawRate
+        # 8-bit sources stay 8-bit, wider ones are reduced to 16 bits
+        self.bits = 8 if self.width == 1 else 16
+        self.fullScale = (1 << (self.bits - 1)) * self.channels
+
+    def _frames(self):
+        """Yield raw chunks of CHUNK_FRAMES frames."""
+        size = self.width * self.channels
+        if self.wav:
+            with wavefile.open(self.filename, "rb") as w:
+                while True:
+                    data = w.readframes(CHUNK_FRAMES)
+                    if not data:
+                        return
+                    yield data
+        else:
+            with open(self.filename, "rb") as f_in:
+                while True:
+                    data = f_in.read(CHUNK_FRAMES * size)
+                    data = data[:len(data) - len(data) % size]
+                    if not data:
+                        return
+                    yield data
+
+    def _decode(self, data: bytes) -> array:
+        width = self.width
+        if width == 1:
+            # WAV 8-bit is unsigned
+            unsigned = self.wav or self.rawFormat == "u8"
+            samples = array("b", data.translate(_flipSign) if unsigned else data)
+        else:
+            if width > 2: # keep the two most significant bytes
+                top = bytearray(2 * (len(data) // width))
+                top[0::2] = data[width - 2::width]
+                top[1::2] = data[width - 1::width]
+                data = top
+            samples = array("h")
+            samples.frombytes(data)
+            if (self.rawFormat == "s16be") != (sys.byteorder == "big"):
+                samples.byteswap()
+        if self.channels > 1:
+            mixed = samples[0::self.channels]
+            mixed = array("i", mixed)
+            for ch in range(1, self.channels):
+                mixed = array("i", map(int.__add__, mixed, samples[ch::self.channels]))
+            samples = mixed
+        return samples
+
+    def chunks(self):
+        for data in self._frames():
+            yield self._decode(data)
+
+    def peak(self) -> int:
+        """Return the largest absolute sample value, reading the whole
+        source once."""
+        peak = 0
+        for samples in self.chunks():
+            if samples:
+                peak = max(peak, max(samples), -min(samples))
+        return peak
+
+
+_flipSign = bytes(b ^ 0x80 for b in range(0x100))
+
+
+def resample(chunks, ratio: float):
+    """Resample a stream of chunks by ratio (source samples per output
+    sample), picking the nearest earlier sample."""
+    if ratio == 1.0:
+        yield from chunks
+        return
+    step = max(round(ratio * (1 << FIXED)), 1)
+    pos = 0
+    for samples in chunks:
+        end = len(samples) << FIXED
+        if pos < end:
+            yield array(samples.typecode, map(samples.__getitem__, map(FIXED.__rrshift__, range(pos, end, step))))
+            pos += -(-(end - pos) // step) * step
+        pos -= end
+
+
+class Quantiser:
+    """Convert sample values to 8-bit signed with gain, TPDF dither and
+    clipping, through one lookup table."""
+
+    def __init__(self, fullScale: int, gain: float = 1.0, dither: bool = True, seed=None):
+        lsb = max(fullScale >> 7, 1) # one 8-bit step in source units
+        self.pad = lsb if dither else 0
+        offset = fullScale + self.pad
+        scale = gain * 0x80 / fullScale
+        self.table = bytes(min(max(round((i - offset) * scale), -0x80), 0x7f) & 0xff
+                           for i in range(2 * offset))
+        if dither:
+            rng = random.Random(seed)
+            noise = [offset + rng.randint(-lsb, 0) + rng.randint(0, lsb) for n in range(0x1000)]
+            self.noise = itertools.cycle(noise)
+        else:
+            self.noise = itertools.repeat(offset)
+
+    def __call__(self, samples) -> bytes:
+        return bytes(map(self.table.__getitem__, map(int.__add__, samples, self.noise)))
+
+
+def loopTrim(data: bytes, limit: int) -> bytes:
+    """Cut data at the last rising zero crossing before limit, but no
+    earlier than half of it, so the sample loops without a click."""
+    data = data[:limit]
+    cut = None
+    for match in _risingZero.finditer(data, limit // 2):
+        cut = match.start() + 1
+    return data[:cut] if cut else data
+
+
+def importSample(filename: str, outBase: str, options: dict) -> list:
+    """Convert one source file and return the list of (file name,
+    sample length) written."""
+    source = Source(filename, options.get("rawFormat", "s8"), options.get("rawRate"), options.get("rawChannels", 1))
+    period = options.get("period") or notePeriod(options.get("note", 0x0e), 0)
+    rate = PAL_CLOCK / period
+    if source.rate is None:
+        source.rate = rate # raw data is taken to be at the target rate
+    gain = 1.0
+    if options.get("normalise"):
+        peak = source.peak()
+        gain = source.fullScale / peak if peak else 1.0
+    dither = options.get("dither", True) and (source.fullScale > 0x80 or gain != 1.0)
+    quantise = Quantiser(source.fullScale, gain, dither, options.get("seed", 0))
+    fit = options.get("fit", "truncate")
+    limit = options.get("limit", HUNK_LIMIT)
+
+    written = []
+    pieces = (quantise(samples) for samples in resample(source.chunks(), source.rate / rate))
+    buf = bytearray()
+    for piece in pieces:
+        buf += piece
+        if fit == "split":
+            while len(buf) >= limit:
+                written.append(_writePiece(f"{outBase}.{len(written) + 1:d}.hunk", buf[:limit]))
+                del buf[:limit]
+        elif len(buf) >= limit:
+            break # nothing after the limit is used
+    if fit == "split":
+        if buf or not written:
+            written.append(_writePiece(f"{outBase}.{len(written) + 1:d}.hunk", buf))
+        return written
+    data = bytes(buf)
+    if fit == "loop" and len(data) >= limit:
+        data = loopTrim(data, limit)
+    written.append(_writePiece(outBase + ".hunk", data[:limit]))
+    return written
+
+
+def _writePiece(outName: str, data) -> tuple:
+    out_bytes, truncated = createHunk(bytes(data))
+    with atomicOpen(outName) as f_out:
+        f_out.write(out_bytes)
+    return outName, len(data)
+
+
+def _convert(task: tuple) -> tuple:
+    filename, outBase, options = task
+    try:
+        return filename, importSample(filename, outBase, options), None
+    except (OSError, ValueError) as e:
+        return filename, [], str(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import WAV or raw samples as HUNK files for the Medley Sound editor.",
+                                     epilog="WAV files are recognised by the .wav suffix; other files are raw data.  "
+                                            f"Samples are limited to {HUNK_LIMIT:d} bytes.")
+    parser.add_argument("paths", nargs="+", help="files, directories (searched recursively) or glob patterns")
+    parser.add_argument("-p", "--period", type=int, default=None, help="target Paula period")
+    parser.add_argument("-n", "--note", type=lambda n: int(n, 16), default=0x0e,
+                        help="play the sample at its recorded pitch on this note, in hex (default: 0e, C-2)")
+    parser.add_argument("-N", "--normalise", action="store_true", help="scale the sample to full level")
+    parser.add_argument("--no-dither", action="store_true", help="round instead of dithering")
+    parser.add_argument("-f", "--fit", choices=("truncate", "split", "loop"), default="truncate",
+                        help="handling of samples over the limit (default: truncate)")
+    parser.add_argument("--raw-format", choices=sorted(RAW_FORMATS), default="s8", help="format of raw data (default: s8)")
+    parser.add_argument("--raw-rate", type=int, default=None, help="sample rate of raw data (default: the target rate)")
+    parser.add_argument("--raw-channels", type=int, default=1, help="interleaved channels of raw data (default: 1)")
+    parser.add_argument("-o", "--output-dir", help="write the HUNK files here instead of next to the sources")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    options = {"period": args.period, "note": args.note, "normalise": args.normalise, "dither": not args.no_dither,
+               "fit": args.fit, "rawFormat": args.raw_format, "rawRate": args.raw_rate, "rawChannels": args.raw_channels}
+    files = [f for f in expand(args.paths, ".hunk") if not f.endswith(".hunk")]
+    try:
+        outBases = outputNames(files, "", args.output_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    tasks = []
+    for filename, outBase in zip(files, outBases):
+        if args.output_dir:
+            os.makedirs(os.path.dirname(outBase), exist_ok=True)
+        tasks.append((filename, outBase, options))
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) if args.jobs != 1 and len(tasks) > 1 else contextlib.nullcontext() as pool:
+        results = map(_convert, tasks) if pool is None else pool.map(_convert, tasks)
+        for filename, written, error in results:
+            if error:
+                failed += 1
+                print(f"{filename}: Error: {error}")
+                continue
+            for outName, length in written:
+                print(f"{outName}: {length:d} bytes")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,292 @@
+#!/bin/python
+
+# Stream scores of Medley Sound objects and projects as PCM chunks.
+#
+# A Song holds what every listener of a score shares: the compiled
+# event streams of the channels and the Bank of instruments and waves.
+# A Player holds the state of one listener, ie. four Channels and a
+# position per channel, and renders ticks on demand with the block
+# synthesis of render.py.  Player.chunks() is an async generator of
+# fixed-size chunks.  It renders the next chunk only when the consumer
+# asks for it, so a slow sink holds up its own stream and nothing
+# else, and with realtime set it never runs further than lead seconds
+# ahead of the wall clock.
+#
+# Seeking, swapping instruments and DYNLV changes are queued and
+# applied between chunks.
+
+import argparse
+import asyncio
+import math
+import sys
+import time
+import wave as wavefile
+from bisect import bisect_left
+
+from flatten import Compiler
+from msob import loadFile
+from pvms import loadProject
+from render import CIA_CLOCK, Bank, Channel, mix
+
+BYTES_PER_FRAME = 4 # stereo 16-bit
+
+
+class Song:
+    """A score prepared for streaming.  Share one Song between all the
+    Players of a score."""
+
+    def __init__(self, project, number: int, seed=None, bank: Bank = None):
+        score = project.scores[number] if 0 < number < 256 else None
+        if score is None:
+            raise ValueError(f"score {number:02x} is undefined.")
+        self.number = number
+        self.tickRate = CIA_CLOCK / max(score.tempo, 1)
+        self.transpose = score.transpose
+        self.updReduction = score.updReduction
+        self.masterVolume = score.volume
+        self.repeat = score.repeat
+        self.instrs = [score.instrs[ch] or score.defInstr for ch in range(4)]
+        self.volumes = bytes(score.volumes)
+        self.streams = Compiler.forProject(project, seed).compileScore(score)
+        self.length = max(s.length for s in self.streams)
+        self.bank = bank or Bank(project)
+
+
+class Player:
+    """One listener of a Song.
+
+    chunkFrames is the number of stereo frames per chunk.  Playback
+    stops after seconds, or if the score doesn't repeat, tail seconds
+    after the last note."""
+
+    def __init__(self, song: Song, rate: int = 22050, chunkFrames: int = 1024, seconds: float = None,
+                 tail: float = 1.0):
+        self.song = song
+        self.rate = rate
+        self.chunkFrames = chunkFrames
+        self.channels = [Channel(n, song.bank, song.masterVolume) for n in range(4)]
+        self.instrumentMap = {}
+        self.pending = []
+        if seconds is not None:
+            self.endTick = math.ceil(seconds * song.tickRate)
+        elif song.repeat:
+            self.endTick = None
+        else:
+            self.endTick = song.length + math.ceil(tail * song.tickRate)
+        self._seek(0)
+
+    # Changes requested by the listener.  They're applied before the
+    # next chunk is rendered.
+
+    def seek(self, seconds: float):
+        self.pending.append((self._seek, int(seconds * self.song.tickRate)))
+
+    def swapInstrument(self, number: int, replacement: int):
+        """Play instrument replacement wherever the score plays number."""
+        self.pending.append((self._swapInstrument, number, replacement))
+
+    def setDynlv(self, channel: int, operand: int):
+        """Set the volume of a channel like a DYNLV SCODE would.  The
+        track data overrides it at its next DYNLV."""
+        self.pending.append((self._setDynlv, channel, operand))
+
+    def _seek(self, tick: int):
+        song = self.song
+        self.tick = tick
+        self.sample = int(tick * self.rate / song.tickRate)
+        self.buf = bytearray()
+        self.cursors = []
+        self.bases = []
+        self.sources = list(song.instrs)
+        for n, (channel, stream) in enumerate(zip(self.channels, song.streams)):
+            channel.reset(song.masterVolume)
+            channel.setInstrument(self.instrumentMap.get(song.instrs[n], song.instrs[n]))
+            channel.setVolume(song.volumes[n], song.masterVolume)
+            base = 0
+            if stream.loopTick is not None and tick >= stream.length > stream.loopTick:
+                period = stream.length - stream.loopTick
+                base = (tick - stream.loopTick) // period * period
+            local = tick - base
+            i = stream.seek(local)
+            if i >= 0:
+                self._start(n, i)
+                if stream.note[i] and local < stream.tick[i] + stream.duration[i]:
+                    channel.noteOn(stream.note[i], False)
+            self.cursors.append(i + 1)
+            self.bases.append(base)
+
+    def _swapInstrument(self, number: int, replacement: int):
+        self.instrumentMap[number] = replacement
+        for n, channel in enumerate(self.channels):
+            if self.sources[n] == number:
+                channel.setInstrument(replacement)
+
+    def _setDynlv(self, channel: int, operand: int):
+        self.channels[channel].setVolume(operand >> 1, self.song.masterVolume)
+
+    def _start(self, n: int, i: int):
+        """Set the channel state of event i of channel n."""
+        stream = self.song.streams[n]
+        channel = self.channels[n]
+        source = self.sources[n] = stream.instrument[i]
+        channel.setInstrument(self.instrumentMap.get(source, source))
+        channel.setVolume(stream.volume[i], self.song.masterVolume)
+        channel.transpose = stream.transpose[i]
+
+    def _renderTick(self):
+        """Render one player tick into the buffer."""
+        song = self.song
+        tick = self.tick
+        nextSample = int((tick + 1) * self.rate / song.tickRate)
+        n = nextSample - self.sample
+        blocks = []
+        for ch, (channel, stream) in enumerate(zip(self.channels, song.streams)):
+            local = tick - self.bases[ch]
+            if stream.loopTick is not None and local >= stream.length > stream.loopTick:
+                self.bases[ch] += stream.length - stream.loopTick
+                local = tick - self.bases[ch]
+                self.cursors[ch] = bisect_left(stream.tick, stream.loopTick)
+            i = self.cursors[ch]
+            while i < len(stream) and stream.tick[i] == local:
+                self._start(ch, i)
+                channel.noteOn(stream.note[i], stream.tied[i])
+                i += 1
+            self.cursors[ch] = i
+            channel.update(song.transpose, song.updReduction)
+            blocks.append(channel.block(n, self.rate))
+        self.buf += mix(blocks)
+        self.tick += 1
+        self.sample = nextSample
+
+    @property
+    def finished(self) -> bool:
+        return self.endTick is not None and self.tick >= self.endTick
+
+    def nextChunk(self) -> bytes:
+        """Apply pending changes and return the next chunk, or b"" at
+        the end.  The last chunk is padded with silence."""
+        for change, *args in self.pending:
+            change(*args)
+        self.pending.clear()
+        size = self.chunkFrames * BYTES_PER_FRAME
+        while len(self.buf) < size and not self.finished:
+            self._renderTick()
+        if not self.buf:
+            return b""
+        chunk = bytes(self.buf[:size]).ljust(size, b"\x00")
+        del self.buf[:size]
+        return chunk
+
+    async def chunks(self, realtime: bool = False, lead: float = 0.2):
+        """Yield chunks until the end of the song.
+
+        With realtime, each chunk is held back until it's due to play
+        in lead seconds, which bounds the audio buffered downstream."""
+        start = time.monotonic()
+        played = 0.0
+        while True:
+            chunk = self.nextChunk()
+            if not chunk:
+                return
+            if realtime:
+                ahead = played - (time.monotonic() - start) - lead
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+            else:
+                await asyncio.sleep(0) # let other streams run
+            played += self.chunkFrames / self.rate
+            yield chunk
+
+
+class NullSink:
+    """A stand-in for a listener.  Consumes chunks, optionally at the
+    pace of playback, and keeps statistics."""
+
+    def __init__(self, rate: int, paced: bool = False):
+        self.rate = rate
+        self.paced = paced
+        self.chunks = 0
+        self.bytes = 0
+        self.firstChunk = None
+
+    async def consume(self, player: Player):
+        start = time.perf_counter()
+        async for chunk in player.chunks(realtime=self.paced):
+            if self.firstChunk is None:
+                self.firstChunk = time.perf_counter() - start
+            self.chunks += 1
+            self.bytes += len(chunk)
+            if self.paced:
+                await asyncio.sleep(len(chunk) / BYTES_PER_FRAME / self.rate)
+
+
+class WavSink(NullSink):
+    """A stand-in listener writing the chunks to a WAV file."""
+
+    def __init__(self, filename: str, rate: int):
+        super().__init__(rate)
+        self.filename = filename
+
+    async def consume(self, player: Player):
+        with wavefile.open(self.filename, "wb") as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(self.rate)
+            start = time.perf_counter()
+            async for chunk in player.chunks():
+                if self.firstChunk is None:
+                    self.firstChunk = time.perf_counter() - start
+                self.chunks += 1
+                self.bytes += len(chunk)
+                w.writeframes(chunk)
+
+
+async def serve(song: Song, listeners: int, rate: int, chunkFrames: int, seconds: float, paced: bool,
+                output: str = None) -> list:
+    sinks = [WavSink(output, rate) if output and n == 0 else NullSink(rate, paced) for n in range(listeners)]
+    players = [Player(song, rate, chunkFrames, seconds) for n in range(listeners)]
+    await asyncio.gather(*(sink.consume(player) for sink, player in zip(sinks, players)))
+    return sinks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a score of a Medley Sound object or project to stand-in listeners.")
+    parser.add_argument("filename", help="MSOB or PVMS file")
+    parser.add_argument("-s", "--score", type=lambda n: int(n, 16), default=None, help="score number in hex (default: first score)")
+    parser.add_argument("-n", "--listeners", type=int, default=1, help="number of simultaneous listeners (default: 1)")
+    parser.add_argument("-c", "--chunk", type=int, default=1024, help="frames per chunk (default: 1024)")
+    parser.add_argument("-r", "--rate", type=int, default=22050, help="sample rate (default: 22050)")
+    parser.add_argument("-t", "--seconds", type=float, default=None, help="stop after this many seconds")
+    parser.add_argument("-p", "--paced", action="store_true", help="consume at the pace of playback")
+    parser.add_argument("-o", "--output", help="write the first listener's stream to this WAV file")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for UDATA")
+    args = parser.parse_args()
+
+    try:
+        project = loadProject(loadFile(args.filename))
+        number = args.score
+        if number is None:
+            number = next((i for i, s in enumerate(project.scores) if s is not None), 0)
+        song = Song(project, number, args.seed)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if song.repeat and args.seconds is None:
+        print("Error: the score repeats forever, give --seconds.")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    sinks = asyncio.run(serve(song, args.listeners, args.rate, args.chunk, args.seconds, args.paced, args.output))
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    audio = sum(s.bytes for s in sinks) / BYTES_PER_FRAME / args.rate
+    first = [s.firstChunk for s in sinks if s.firstChunk is not None]
+    print(f"{len(sinks):d} listeners, {sum(s.chunks for s in sinks):d} chunks, {audio:.1f} s of audio in {elapsed:.2f} s "
+          f"({audio / elapsed:.0f}x real time).")
+    if first:
+        print(f"Time to first chunk: {1000 * sum(first) / len(first):.1f} ms average, {1000 * max(first):.1f} ms max.")
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
@@ -0,0 +1,127 @@
+#!/bin/python
+
+# Bulk operations on Medley Sound track data.
+#
+# Track data is a sequence of big-endian words, one per line: a note
+# or SCODE in the high byte and its operand in the low byte.  The
+# functions below work on whole buffers with C-level searches instead
+# of stepping through the data two bytes at a time.  See "Track Data"
+# in medley_sound_internals.org.
+
+import re
+import sys
+from array import array
+
+END_MARKER = b"\x80\x00"
+
+SC_END = 0x80
+SC_TSIGN = 0x81
+SC_DYNLV = 0x82
+SC_INSTR = 0x83
+SC_UDATA = 0x84
+SC_TRACK = 0x85
+SC_RPEAT = 0x86
+SC_LOOP = 0x87
+SC_TRNSP = 0x88
+
+_endMarker = re.compile(re.escape(END_MARKER))
+_tsign = re.compile(bytes([SC_TSIGN]))
+_udata = re.compile(bytes([SC_UDATA]))
+_track = re.compile(bytes([SC_TRACK]))
+_instr = re.compile(bytes([SC_INSTR]))
+_zero = re.compile(b"\x00")
+
+
+def findEnd(buf, start: int) -> int:
+    """Return the offset just past the end marker of the track data
+    starting at start, or -1 if there's no end marker.
+
+    buf can be any buffer, including a memoryview or an mmap."""
+    match = _endMarker.search(buf, start)
+    while match:
+        pos = match.start()
+        if (pos - start) & 1 == 0: # only word aligned hits are lines
+            return pos + 2
+        match = _endMarker.search(buf, pos + 1)
+    return -1
+
+
+def lines(data) -> array:
+    """Return track data as an array of unsigned line words."""
+    words = array("H")
+    words.frombytes(data[:len(data) & ~1])
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words
+
+
+def countLines(data) -> int:
+    return len(data) // 2
+
+
+def _window(ops, operands) -> set:
+    # indexes of the lines covered by a UDATA
+    window = set()
+    for m in _udata.finditer(ops):
+        i = m.start()
+        window.update(range(i + 1, min(i + 1 + operands[i], len(ops))))
+    return window
+
+
+def references(data) -> tuple:
+    """Return the sets of track and instrument numbers referred to by
+    track data.
+
+    The operands of the lines covered by a UDATA are track numbers,
+    whatever their SCODE is, so an INSTR among them is no reference."""
+    ops = bytes(data[0::2])
+    operands = bytes(data[1::2])
+    window = _window(ops, operands)
+    tracks = {operands[i] for i in window}
+    tracks.update(operands[m.start()] for m in _track.finditer(ops))
+    instruments = {operands[m.start()] for m in _instr.finditer(ops) if m.start() not in window}
+    tracks.discard(0)
+    instruments.discard(0)
+    return tracks, instruments
+
+
+def renumber(data, trackMap, instrMap) -> bytearray:
+    """Return a copy of track data with TRACK, UDATA and INSTR operands
+    translated through the given 256-entry maps."""
+    out = bytearray(data)
+    ops = bytes(data[0::2])
+    window = _window(ops, bytes(data[1::2]))
+    for i in window:
+        out[2 * i + 1] = trackMap[out[2 * i + 1]]
+    for m in _track.finditer(ops):
+        if m.start() not in window:
+            out[2 * m.start() + 1] = trackMap[out[2 * m.start() + 1]]
+    for m in _instr.finditer(ops):
+        if m.start() not in window:
+            out[2 * m.start() + 1] = instrMap[out[2 * m.start() + 1]]
+    return out
+
+
+def compact(data) -> bytes:
+    """Drop zero length rests ($0000) and TSIGN ($81xx) lines.
+
+    Both are skipped by the player.  Lines covered by a UDATA are kept
+    as is, because UDATA picks its target by line count."""
+    ops = bytes(data[0::2])
+    operands = bytes(data[1::2])
+    drop = {m.start() for m in _tsign.finditer(ops)}
+    drop.update(i for i in (m.start() for m in _zero.finditer(ops)) if operands[i] == 0)
+    if not drop:
+        return bytes(data)
+    for m in _udata.finditer(ops):
+        i = m.start()
+        drop.difference_update(range(i + 1, i + 1 + operands[i]))
+    chunks = []
+    start = 0
+    for i in sorted(drop):
+        chunks.append(data[2 * start:2 * i])
+        start = i + 1
+    chunks.append(data[2 * start:])
+    return b"".join(chunks)
+
+# EOF
@@ -0,0 +1,262 @@
+#!/bin/python
+
+# Reproduce the Wave Editor operations and presets on 8-bit signed
+# wave data, and rebuild or verify the waves of projects from recipes.
+#
+# The operations follow "Wave Editor / Operations" and "msed internals
+# / Wave editor operations" in medley_sound_internals.org, in the
+# editor's order: adjust the Result length (RE), offset Source A (FQ,
+# SX and SY), mix in Source B (MX), adjust the amplitude (AM) and
+# recalculate the octave.  Whole buffers are processed at once:
+# per-sample mappings are bytes.translate() tables, resampling is an
+# extended slice of a stretched copy, and mixing adds two buffers as
+# lanes of one big integer like render.py does.
+#
+# A recipe describes how a wave was made:
+#
+#   {"a": SOURCE, "b": SOURCE, "ops": {"SX": 0, "SY": 0, "AM": 16, ...}}
+#
+# where a SOURCE is {"preset": "sine"}, {"preset": "RA", "duty": 128},
+# {"preset": "PU", "duty": 128}, a nested recipe, or the number of
+# another wave of the project.  "b" and any operation can be left out.
+
+import argparse
+import json
+import math
+import sys
+
+from msob import loadFile
+from pvms import Wave, decodeName, loadProject
+
+PRESET_LENGTH = 0x80 # length of the generated presets, as loaded by the editor
+
+# operation defaults, ie. "no change"
+DEFAULTS = {"SX": 0x00, "SY": 0x00, "AM": 0x10, "FQ": 0x10, "MX": 0x00, "RE": 0x10}
+
+_presets = {}
+_addTables = {}
+_ampTables = {}
+_weightTables = {}
+
+
+def _signed(byte: int) -> int:
+    return byte - 0x100 if byte & 0x80 else byte
+
+
+def octave(length: int) -> int:
+    """Return the octave number the editor gives a buffer of length:
+    the length is shifted right until it's 2 or less, counting down
+    from 7.  Buffers longer than 0x17e give negative octaves."""
+    number = 7
+    while length > 2:
+        length >>= 1
+        number -= 1
+    return number
+
+
+def preset(kind: str, duty: int = 0x80, length: int = PRESET_LENGTH) -> bytes:
+    """Return a preset waveform: "sine", "RA" (saw/triangle, duty $80
+    is a pure triangle) or "PU" (pulse, duty $80 is a square wave).
+    Tables are cached."""
+    key = (kind, duty if kind != "sine" else 0, length)
+    data = _presets.get(key)
+    if data is not None:
+        return data
+    if kind == "sine":
+        values = [round(127 * math.sin(2 * math.pi * i / length)) for i in range(length)]
+    elif kind == "RA":
+        peak = duty * length // 0x100 # samples spent rising
+        values = []
+        for i in range(length):
+            if i < peak:
+                values.append(-0x80 + 0xff * i // peak)
+            else:
+                values.append(0x7f - 0xff * (i - peak) // (length - peak))
+    elif kind == "PU":
+        high = duty * length // 0x100
+        values = [0x7f if i < high else -0x80 for i in range(length)]
+    else:
+        raise ValueError(f"unknown preset {kind}.")
+    data = _presets[key] = bytes(v & 0xff for v in values)
+    return data
+
+
+def _addTable(value: int) -> bytes:
+    """Translate table adding a signed value, wrapping like add.b."""
+    table = _addTables.get(value)
+    if table is None:
+        table = _addTables[value] = bytes((b + value) & 0xff for b in range(0x100))
+    return table
+
+
+def _ampTable(value: int) -> bytes:
+    """Translate table multiplying by value / $10, clipped to a byte."""
+    table = _ampTables.get(value)
+    if table is None:
+        table = _ampTables[value] = bytes(min(max(_signed(b) * value // 0x10, -0x80), 0x7f) & 0xff for b in range(0x100))
+    return table
+
+
+def _weightTable(weight: int) -> tuple:
+    """Translate tables giving the low and high bytes of
+    sample * weight + $8000 for 32-bit mixing lanes."""
+    tables = _weightTables.get(weight)
+    if tables is None:
+        values = [(_signed(b) * weight + 0x8000) & 0xffff for b in range(0x100)]
+        tables = _weightTables[weight] = (bytes(v & 0xff for v in values), bytes(v >> 8 for v in values))
+    return tables
+
+
+def _lanes(data: bytes, weight: int) -> int:
+    lo, hi = _weightTable(weight)
+    buf = bytearray(4 * len(data))
+    buf[0::4] = data.translate(lo)
+    buf[1::4] = data.translate(hi)
+    return int.from_bytes(buf, "little")
+
+
+def mix(a: bytes, b: bytes, mx: int) -> bytes:
+    """Mix two buffers of equal length, $00 = a, $80 = half and half,
+    $ff = b."""
+    if mx == 0x00:
+        return a
+    if mx == 0xff:
+        return b
+    size = 4 * len(a)
+    lanes = (_lanes(a, 0x100 - mx) + _lanes(b, mx)).to_bytes(size, "little")
+    return lanes[1:size:4] # high byte of each 16-bit sum
+
+
+def resample(data: bytes, length: int, step: int, offset: int = 0) -> bytes:
+    """Return length samples of data looped, starting at offset and
+    advancing step / $10 samples at a time."""
+    stretched = bytearray(len(data) * 0x10)
+    for j in range(0x10):
+        stretched[j::0x10] = data
+    start = (offset % len(data)) * 0x10
+    end = start + (length - 1) * step + 1
+    if end > len(stretched):
+        stretched *= -(-end // len(stretched))
+    return bytes(stretched[start:end:step])
+
+
+def apply(a, b=None, ops: dict = None) -> bytes:
+    """Apply the operations to Source A and Source B and return the
+    Result buffer."""
+    a = bytes(a)
+    if not a:
+        raise ValueError("Source A is empty.")
+    op = dict(DEFAULTS)
+    op.update(ops or {})
+    length = max(len(a) * op["RE"] // 0x10, 1)
+    result = resample(a, length, max(op["FQ"], 1), op["SX"])
+    if op["SY"]:
+        result = result.translate(_addTable(_signed(op["SY"])))
+    if op["MX"]:
+        # Source B isn't looped, it ends in silence.
+        source = bytes(b or b"")[:length]
+        result = mix(result, source + bytes(length - len(source)), op["MX"])
+    if op["AM"] != 0x10:
+        result = result.translate(_ampTable(op["AM"]))
+    return result
+
+
+def build(recipe, project=None) -> bytes:
+    """Return the wave data a recipe or source describes."""
+    if isinstance(recipe, int):
+        if project is None or not 0 < recipe < 256 or project.waves[recipe] is None:
+            raise ValueError(f"wave {recipe:02x} is undefined.")
+        return bytes(project.waves[recipe].data)
+    if "preset" in recipe:
+        return preset(recipe["preset"], recipe.get("duty", 0x80), recipe.get("length", PRESET_LENGTH))
+    b = recipe.get("b")
+    return apply(build(recipe["a"], project), None if b is None else build(b, project), recipe.get("ops"))
+
+
+def identify(data) -> dict:
+    """Return the preset recipe matching wave data exactly, or None."""
+    data = bytes(data)
+    if len(data) != PRESET_LENGTH:
+        return None
+    if data == preset("sine"):
+        return {"preset": "sine"}
+    for kind in ("RA", "PU"):
+        for duty in range(1, 0x100):
+            if data == preset(kind, duty):
+                return {"preset": kind, "duty": duty}
+    return None
+
+
+def rebuild(project, recipes: dict, verify: bool = False) -> dict:
+    """Regenerate, or with verify only compare, every wave of a project
+    that has a recipe.  recipes maps wave numbers to recipes.  Returns
+    a dict of wave number to "ok", "differs", "rebuilt" or an error."""
+    results = {}
+    for number, recipe in sorted(recipes.items()):
+        if not 0 < number < 256:
+            results[number] = "error: wave number out of range."
+            continue
+        try:
+            data = build(recipe, project)
+        except (ValueError, KeyError) as e:
+            results[number] = f"error: {e}"
+            continue
+        old = project.waves[number]
+        if verify:
+            results[number] = "ok" if old is not None and bytes(old.data) == data else "differs"
+            continue
+        if old is None:
+            project.waves[number] = Wave(bytes(16), len(data), len(data), octave(len(data)), 0, 0, data)
+        else:
+            project.waves[number] = Wave(old.name, len(data), old.dummy, octave(len(data)), old.fragFactor,
+                                         old.isDoubleBufd, data)
+        results[number] = "rebuilt"
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild or verify the waves of a Medley Sound project from Wave Editor recipes.",
+                                     epilog="Recipes are a JSON object of wave numbers (decimal strings) to recipes; see the source for the format.")
+    parser.add_argument("filename", help="MSOB or PVMS file")
+    parser.add_argument("-r", "--recipes", help="JSON recipe file")
+    parser.add_argument("-v", "--verify", action="store_true", help="compare the waves with their recipes instead of rebuilding")
+    parser.add_argument("-i", "--identify", action="store_true", help="print recipes for the waves that match a preset")
+    parser.add_argument("-o", "--output", help="write the rebuilt project here (default: <filename>.waves.pvms)")
+    args = parser.parse_args()
+
+    try:
+        project = loadProject(loadFile(args.filename))
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    if args.identify:
+        found = {}
+        for i, wave in enumerate(project.waves):
+            if wave is not None:
+                recipe = identify(wave.data)
+                if recipe is not None:
+                    found[i] = recipe
+        print(json.dumps(found, indent=1))
+        return
+
+    if not args.recipes:
+        print("Error: no recipes given.")
+        sys.exit(1)
+    with open(args.recipes) as f_in:
+        recipes = {int(i): recipe for i, recipe in json.load(f_in).items()}
+    results = rebuild(project, recipes, args.verify)
+    for number, result in results.items():
+        wave = project.waves[number] if 0 < number < 256 else None
+        print(f" -- Wave {number:02x} {decodeName(wave.name) if wave else '':<16} {result}")
+    if not args.verify:
+        with open(args.output or args.filename + ".waves.pvms", "wb") as f_out:
+            project.save(f_out)
+    if any(r != "ok" and r != "rebuilt" for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF